@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2011 Alf Lervåg. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY ALF LERVÅG ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL ALF LERVÅG OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be interpreted
+# as representing official policies, either expressed or implied, of
+# Alf Lervåg.
+
+"""Benchmarks for ct.core.
+
+Run with ``python benchmarks.py [name ...]`` with ``src`` on the path.
+The end to end benchmarks run against a local FakeCurrentTime server
+with ``ROWS`` projects and ``LATENCY`` seconds added to every request.
+"""
+
+import datetime
+import os
+import subprocess
+import sys
+import time
+from decimal import Decimal
+
+from ct.core import testing
+from ct.core.activity import Activity
+from ct.core.apis import BaseAPI, RangeAPI
+from ct.core.limiter import AdaptiveLimiter, set_limiter
+from ct.core.parser import CurrentTimeParser, IncrementalParser
+from ct.core.retry import RetryPolicy
+from ct.core import xpaths
+from ct.core.session import SessionPool
+from ct.core.project import Project
+
+ROWS = 10
+LATENCY = 0.005
+TODAY = datetime.date(2011, 12, 15)
+
+
+def deep_sizeof(objects):
+    """Bytes used by ``objects`` and everything they refer to, counted once."""
+    seen = set()
+    stack = list(objects)
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for name in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, name):
+                stack.append(getattr(obj, name))
+    return size
+
+
+def _make_activities(count):
+    start = datetime.date(2011, 1, 1)
+    activities = []
+    for i in range(count):
+        # Ids and comments are built per record, like the parser does.
+        project_id = ",".join(str(x) for x in (100 + i % 40, 1, 0, i % 3))
+        activities.append(Activity(
+            start + datetime.timedelta(days=i // 40),
+            project_id,
+            Decimal("%d.%02d" % (i % 8, (i * 25) % 100)),
+            u"",
+            salary_id=str(i % 2)))
+    return activities
+
+
+def bench_record_memory(count=100000):
+    started = time.time()
+    activities = _make_activities(count)
+    elapsed = time.time() - started
+
+    # Dates are shared with the rest of the program, so leave them out.
+    size = deep_sizeof(activities) - deep_sizeof(set(a.date for a in activities))
+    report("activity", count, elapsed,
+           "%.1f bytes/record" % (float(size - sys.getsizeof(activities)) / count))
+
+    started = time.time()
+    projects = [Project([u"Project %d" % i, u"Task", u"Sub", u""],
+                        [str(i), "1", "0", "0"]) for i in range(count // 100)]
+    elapsed = time.time() - started
+    size = deep_sizeof(projects) - sys.getsizeof(projects)
+    report("project", len(projects), elapsed,
+           "%.1f bytes/record" % (float(size) / len(projects)))
+
+
+def bench_record_access(count=100000):
+    activities = _make_activities(count)
+
+    started = time.time()
+    for activity in activities:
+        activity.full_project_id
+        activity.project_id
+    report("full_project_id", count, time.time() - started)
+
+    started = time.time()
+    sorted(activities)
+    report("sort", count, time.time() - started)
+
+
+def _serve(rows=ROWS, latency=LATENCY, encodings=()):
+    server = testing.FakeCurrentTime(rows, latency, today=TODAY,
+                                     encodings=encodings).start()
+    # Measure the client, not the pacing meant for the real server.
+    set_limiter(server.url, AdaptiveLimiter(rate=None))
+    return server
+
+
+def _report_server(name, count, elapsed, server):
+    stats = server.stats
+    report(name, count, elapsed, "%d requests, %d bytes sent, %d received" % (
+        stats["requests"], stats["bytes_sent"], stats["bytes_received"]))
+
+
+def bench_get_month(months=12):
+    server = _serve()
+    api = BaseAPI(server.url)
+    try:
+        api.login("user", "secret")
+        server.reset_stats()
+
+        started = time.time()
+        for i in range(months):
+            month = TODAY.month - i - 1
+            api.get_month(TODAY.year + month // 12, month % 12 + 1)
+        _report_server("get_month", months, time.time() - started, server)
+    finally:
+        api.close()
+        server.stop()
+
+
+def bench_get_activities(concurrency=(1, 4)):
+    from_date = datetime.date(TODAY.year, 1, 1)
+    to_date = datetime.date(TODAY.year, 12, 31)
+    for workers in concurrency:
+        server = _serve()
+        api = RangeAPI(server.url, concurrency=workers)
+        try:
+            api.login("user", "secret")
+            server.reset_stats()
+
+            started = time.time()
+            activities = api.get_activities(from_date, to_date)
+            _report_server("get_activities/%d" % workers, len(activities),
+                           time.time() - started, server)
+        finally:
+            api.close()
+            server.stop()
+
+
+def bench_compression(months=12):
+    for encodings in ((), ("gzip",), ("deflate",)):
+        server = _serve(encodings=encodings)
+        api = BaseAPI(server.url)
+        try:
+            api.login("user", "secret")
+            transfer = api._browser.transfer
+            wire, decoded = transfer.wire, transfer.decoded
+
+            started = time.time()
+            for i in range(months):
+                month = TODAY.month - i - 1
+                api.get_month(TODAY.year + month // 12, month % 12 + 1)
+            report("get_month/%s" % (encodings and encodings[0] or "identity"),
+                   months, time.time() - started,
+                   "%d bytes on the wire, %d decoded" % (
+                       transfer.wire - wire, transfer.decoded - decoded))
+        finally:
+            api.close()
+            server.stop()
+
+
+def _month_page(rows, changed=None, comment=u""):
+    first = TODAY.replace(day=1)
+    last = TODAY.replace(day=31)
+    timesheet = []
+    for i in range(rows):
+        cells = dict((first + datetime.timedelta(days=n), ("7,5", u""))
+                     for n in range(0, 31, rows))
+        if i == changed:
+            cells[first] = ("1", comment)
+        timesheet.append((testing.project_value("%d,1,0,0" % (i + 1)), cells))
+    return testing.timesheet_page(first, last, timesheet).encode("utf-8")
+
+
+def bench_incremental_parse(polls=50):
+    page = _month_page(ROWS)
+    changed = [_month_page(ROWS, i % ROWS, u"poll %d" % i) for i in range(polls)]
+    for parser in (CurrentTimeParser(cache_size=0), IncrementalParser(cache_size=0)):
+        name = parser.__class__.__name__
+        started = time.time()
+        for i in range(polls):
+            parser.parse_activities(page)
+        report("%s/same" % name, polls, time.time() - started)
+
+        started = time.time()
+        for changed_page in changed:
+            parser.parse_activities(changed_page)
+        report("%s/one row" % name, polls, time.time() - started)
+
+
+def bench_session_pool(users=20, months=3):
+    passwords = dict(("user%d" % i, "secret") for i in range(users))
+    tasks = [(user, TODAY.year, month + 1)
+             for user in passwords for month in range(months)]
+    for workers in (1, 8):
+        server = testing.FakeCurrentTime(ROWS, LATENCY, today=TODAY,
+                                         users=passwords).start()
+        set_limiter(server.url, AdaptiveLimiter(rate=None, limit=workers,
+                                                maximum=workers))
+        pool = SessionPool(server.url, passwords, workers=workers)
+        try:
+            started = time.time()
+            for result in pool.fetch(tasks):
+                pass
+            _report_server("session_pool/%d" % workers, len(tasks),
+                           time.time() - started, server)
+        finally:
+            pool.close()
+            server.stop()
+
+
+def bench_report_burst(count=20):
+    server = _serve()
+    api = RangeAPI(server.url)
+    try:
+        api.login("user", "secret")
+        first = TODAY.replace(day=1)
+        last = TODAY.replace(day=28)
+        previous = [a for a in api.get_activities(first, last) if a.duration]
+        server.reset_stats()
+
+        started = time.time()
+        for i, old in enumerate(previous[:count]):
+            activity = Activity(old.date, old.project_id, old.duration,
+                                u"burst %d" % i, salary_id=old.salary_id)
+            api.report_activity(activity, old)
+        _report_server("report_activity", min(count, len(previous)),
+                       time.time() - started, server)
+    finally:
+        api.close()
+        server.stop()
+
+
+def bench_slow_hops(months=12, every=10, delay=1.0):
+    """A year of months where every tenth request stalls for a second."""
+    for name, policy in (("none", None),
+                         ("retry", RetryPolicy(timeout=delay / 4))):
+        server = _serve()
+        api = BaseAPI(server.url)
+        try:
+            api.login("user", "secret")
+            api.set_retry_policy(policy)
+            server.reset_stats()
+            for i in range(months * 4):
+                server.add_fault(delay=delay if i % every == every // 2 else 0)
+
+            started = time.time()
+            for i in range(months):
+                month = TODAY.month - i - 1
+                api.get_month(TODAY.year + month // 12, month % 12 + 1)
+            _report_server("slow_hops/%s" % name, months,
+                           time.time() - started, server)
+        finally:
+            api.close()
+            server.stop()
+
+
+def bench_import(runs=10):
+    """Time ``import ct.core.apis`` in fresh interpreters."""
+    code = ("import time; started = time.time(); import ct.core.apis; "
+            "print time.time() - started")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    times = sorted(float(subprocess.check_output([sys.executable, "-c", code],
+                                                 env=env))
+                   for _ in range(runs))
+    report("import/apis", runs, sum(times),
+           "median %.1f ms" % (times[runs // 2] * 1000))
+
+
+# What the parser used to pass to cssselect() for the same lookups.
+CSS = [
+    "input[name='sessionid']",
+    "body[class=login]",
+    "table table script",
+    "td[class=accept]",
+    "td[class=date]",
+    "td[class=week]",
+]
+
+
+def bench_selectors(pages=200):
+    root = CurrentTimeParser().page(_month_page(ROWS)).root
+
+    started = time.time()
+    for _ in range(pages):
+        for css in CSS:
+            root.cssselect(css)
+    report("selectors/cssselect", pages, time.time() - started)
+
+    started = time.time()
+    for _ in range(pages):
+        for name in ('session_id', 'login_body', 'navigation_script', 'range'):
+            xpaths.select(name, root)
+        xpaths.select('day_cell', root, day=15)
+        xpaths.select('week_cell', root, week=50)
+    report("selectors/compiled", pages, time.time() - started)
+
+
+def bench_parse_page(pages=50):
+    """Everything BaseAPI reads from a freshly fetched month page."""
+    response = _month_page(ROWS)
+    parser = CurrentTimeParser(cache_size=0)
+    started = time.time()
+    for _ in range(pages):
+        page = parser.page(response)
+        parser.parse_session_id(page)
+        parser.parse_navigation(page)
+        parser.get_day_command(page, 15)
+        parser.parse_activities(page)
+    report("parse_page", pages, time.time() - started)
+
+
+def report(name, count, elapsed, extra=""):
+    print "%-20s %8d  %8.3fs  %s" % (name, count, elapsed, extra)
+
+
+BENCHMARKS = [
+    bench_record_memory,
+    bench_record_access,
+    bench_get_month,
+    bench_get_activities,
+    bench_compression,
+    bench_incremental_parse,
+    bench_session_pool,
+    bench_report_burst,
+    bench_slow_hops,
+    bench_import,
+    bench_selectors,
+    bench_parse_page,
+]
+
+
+def main(names):
+    for bench in BENCHMARKS:
+        if not names or bench.__name__[len("bench_"):] in names:
+            bench()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -33,7 +33,39 @@
 import datetime
 import decimal
 
+__all__ = ["Activity"]
+
+# Project and salary ids repeat across every day of a timesheet row, so
+# all activities share one copy of each.
+_interned = {}
+_full_project_ids = {}
+
+
+def _intern(value):
+    return _interned.setdefault(value, value)
+
+
+
+def _to_centihours(duration):
+    if not duration.is_finite():
+        raise ValueError("duration must be a finite number")
+
+    sign, digits, exponent = duration.as_tuple()
+    value = int("".join(map(str, digits)))
+    exponent += 2
+    if exponent >= 0:
+        value *= 10 ** exponent
+    else:
+        value, remainder = divmod(value, 10 ** -exponent)
+        if remainder:
+            raise ValueError("duration can't have more than two decimals")
+    return sign and -value or value
+
+
 class Activity(object):
+    __slots__ = ('_date', '_project_id', '_salary_id', '_centihours',
+                 '_comment', '_read_only')
+
     def __init__(self, date, project_id, duration, comment, salary_id="", read_only=False):
         if not isinstance(date, datetime.date):
             raise TypeError("date argument should be a date object")
@@ -41,14 +73,18 @@ class Activity(object):
         if not isinstance(duration, decimal.Decimal):
             raise TypeError("duration argument should be a decimal")
 
-        self._dict = {
-            'date': date,
-            'project_id': project_id,
-            'salary_id': salary_id,
-            'duration': duration,
-            'comment': comment,
-            'read_only': read_only,
-        }
+        centihours = _to_centihours(duration)
+
+        init = super(Activity, self).__setattr__
+        init('_date', date)
+        init('_project_id', _intern(project_id))
+        init('_salary_id', _intern(salary_id))
+        init('_centihours', centihours)
+        init('_comment', comment)
+        init('_read_only', read_only)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Activity objects are immutable")
 
     def __cmp__(self, other):
         return cmp(
@@ -56,48 +92,77 @@ class Activity(object):
             (other.date, other.project_id))
 
     def __eq__(self, other):
-        return self._dict == other._dict
+        return self._values() == other._values()
 
     def __ne__(self, other):
         return not self == other
 
     def __hash__(self):
-        return hash((self.date, self.project_id))
+        return hash((self._date, self._project_id))
 
     def __str__(self):
         return str(self._dict)
 
+    def __getstate__(self):
+        return self._values()
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            super(Activity, self).__setattr__(name, value)
+
+    def _values(self):
+        return (self._date, self._project_id, self._salary_id,
+                self._centihours, self._comment, self._read_only)
+
+    @property
+    def _dict(self):
+        return {
+            'date': self._date,
+            'project_id': self._project_id,
+            'salary_id': self._salary_id,
+            'duration': self.duration,
+            'comment': self._comment,
+            'read_only': self._read_only,
+        }
+
     @property
     def day(self):
         """DEPRECATED"""
-        return self._dict['date']
+        return self._date
 
     @property
     def date(self):
-        return self._dict['date']
+        return self._date
 
     @property
     def full_project_id(self):
-        parts = tuple(self.project_id.split(","))
-        return "projectid=%s,taskid=%s,subtaskid=%s,activityid=%s" % parts
+        project_id = self._project_id
+        if project_id not in _full_project_ids:
+            parts = tuple(project_id.split(","))
+            _full_project_ids[project_id] = (
+                "projectid=%s,taskid=%s,subtaskid=%s,activityid=%s" % parts)
+        return _full_project_ids[project_id]
 
     @property
     def project_id(self):
-        return self._dict['project_id']
+        return self._project_id
 
     @property
     def salary_id(self):
-        return self._dict['salary_id']
+        return self._salary_id
 
     @property
     def duration(self):
-        return self._dict['duration']
+        return decimal.Decimal(self._centihours) / 100
+
+    @property
+    def centihours(self):
+        return self._centihours
 
     @property
     def comment(self):
-        return self._dict['comment']
+        return self._comment
 
     @property
     def is_read_only(self):
-        return self._dict['read_only']
-
+        return self._read_only
@@ -0,0 +1,614 @@
+# -*- coding: utf-8 -*-
+# Copyright 2011 Alf Lervåg. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY ALF LERVÅG ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL ALF LERVÅG OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be interpreted
+# as representing official policies, either expressed or implied, of
+# Alf Lervåg.
+
+"""Non-blocking CurrentTime client.
+
+AsyncRangeAPI mirrors RangeAPI, but every call returns a Future instead
+of blocking, so one thread can drive many sessions at once::
+
+    loop = EventLoop()
+    apis = [AsyncRangeAPI(server, loop) for _ in users]
+    logins = [api.login(u, p) for api, (u, p) in zip(apis, users)]
+    loop.run_until_complete(gather(*logins))
+
+The transport is a small HTTP client on top of asyncore, and coroutines
+are generators that yield Futures and finish with ``raise Return(value)``.
+"""
+
+import asyncore
+import cStringIO
+import cookielib
+import datetime
+import errno
+import functools
+import heapq
+import mimetools
+import socket
+import ssl
+import sys
+import time
+import types
+import urllib2
+import urlparse
+
+from apis import check_for_conflicts
+from browser import CurrentTimeBrowser
+from navigation import NavigationPlan, check_month_view, is_month_view
+from parser import CurrentTimeParser
+
+__all__ = ["AsyncRangeAPI", "AsyncCurrentTimeBrowser", "EventLoop",
+           "Future", "Return", "coroutine", "gather"]
+
+
+class Return(Exception):
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Future(object):
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError("Future is not done yet")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exc_info(self):
+        return self._exc_info
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def set_exception(self, exception):
+        self.set_exc_info((type(exception), exception, None))
+
+    def add_done_callback(self, callback):
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def _finish(self):
+        if self._done:
+            raise RuntimeError("Future is already done")
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+def coroutine(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        future = Future()
+        try:
+            result = func(*args, **kwargs)
+        except Return, e:
+            future.set_result(e.value)
+        except Exception:
+            future.set_exc_info(sys.exc_info())
+        else:
+            if isinstance(result, types.GeneratorType):
+                _Task(result, future).step()
+            else:
+                future.set_result(result)
+        return future
+    return wrapper
+
+
+class _Task(object):
+    def __init__(self, generator, future):
+        self._generator = generator
+        self._future = future
+
+    def step(self, value=None, exc_info=None):
+        while True:
+            try:
+                if exc_info is not None:
+                    yielded = self._generator.throw(*exc_info)
+                else:
+                    yielded = self._generator.send(value)
+            except Return, e:
+                self._future.set_result(e.value)
+                return
+            except StopIteration:
+                self._future.set_result(None)
+                return
+            except Exception:
+                self._future.set_exc_info(sys.exc_info())
+                return
+
+            if isinstance(yielded, list):
+                yielded = gather(*yielded)
+            if not yielded.done():
+                yielded.add_done_callback(self._wakeup)
+                return
+            value, exc_info = yielded._result, yielded.exc_info()
+
+    def _wakeup(self, future):
+        self.step(future._result, future.exc_info())
+
+
+def gather(*futures):
+    """A Future for the results of all ``futures``, in order."""
+    result = Future()
+    pending = [len(futures)]
+
+    def done(future):
+        if result.done():
+            return
+        if future.exc_info() is not None:
+            result.set_exc_info(future.exc_info())
+            return
+        pending[0] -= 1
+        if not pending[0]:
+            result.set_result([f.result() for f in futures])
+
+    if not futures:
+        result.set_result([])
+    for future in futures:
+        future.add_done_callback(done)
+    return result
+
+
+class EventLoop(object):
+    def __init__(self, poll_interval=0.05):
+        self.map = {}
+        self._poll_interval = poll_interval
+        self._timers = []
+
+    def sleep(self, seconds):
+        """A Future that is done after ``seconds``."""
+        future = Future()
+        heapq.heappush(self._timers, (time.time() + seconds, future))
+        return future
+
+    def run_until_complete(self, future):
+        while not future.done():
+            if not self.map and not self._timers:
+                raise RuntimeError("Future can't complete, nothing is running")
+
+            timeout = self._poll_interval
+            if self._timers:
+                timeout = max(0, min(timeout, self._timers[0][0] - time.time()))
+            if self.map:
+                asyncore.loop(timeout, map=self.map, count=1)
+            else:
+                time.sleep(timeout)
+
+            now = time.time()
+            for connection in self.map.values():
+                if connection.deadline < now:
+                    connection.fail(socket.timeout("timed out"))
+            while self._timers and self._timers[0][0] <= now:
+                heapq.heappop(self._timers)[1].set_result(None)
+
+        return future.result()
+
+
+class Response(object):
+    def __init__(self, url, code, msg, headers, body):
+        self.url = url
+        self.code = code
+        self.msg = msg
+        self.headers = headers
+        self.body = body
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+    def read(self):
+        return self.body
+
+
+class _Connection(asyncore.dispatcher):
+    """A single HTTP/1.0 request and its response."""
+
+    def __init__(self, loop, request, timeout):
+        asyncore.dispatcher.__init__(self, map=loop.map)
+        self.future = Future()
+        self.deadline = time.time() + timeout
+        self._request = request
+        self._output = self._format_request(request)
+        self._input = []
+        self._received = 0
+        self._head = None
+        self._handshaking = False
+
+        host, port = urllib2.splitport(request.get_host())
+        self._tls = request.get_type() == "https"
+        self._host = host
+        if port is None:
+            port = self._tls and 443 or 80
+
+        try:
+            family, _, _, _, address = socket.getaddrinfo(
+                host, int(port), 0, socket.SOCK_STREAM)[0]
+            self.create_socket(family, socket.SOCK_STREAM)
+            self.connect(address)
+        except socket.error:
+            self.fail()
+
+    def _format_request(self, request):
+        lines = ["%s %s HTTP/1.0" % (request.get_method(), request.get_selector())]
+        headers = dict(request.unredirected_hdrs)
+        headers.update(request.headers)
+        headers["Host"] = request.get_host()
+        headers["Connection"] = "close"
+        if request.has_data():
+            headers.setdefault(
+                "Content-type", "application/x-www-form-urlencoded")
+            headers["Content-length"] = str(len(request.get_data()))
+        for name, value in headers.items():
+            lines.append("%s: %s" % (name.title(), value))
+        return "\r\n".join(lines) + "\r\n\r\n" + (request.get_data() or "")
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return not self.connected or self._handshaking or bool(self._output)
+
+    def handle_connect(self):
+        if self._tls:
+            context = ssl.create_default_context()
+            self.socket = context.wrap_socket(
+                self.socket, server_hostname=self._host,
+                do_handshake_on_connect=False)
+            self._handshaking = True
+
+    def _handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLError, e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE):
+                return
+            raise
+        self._handshaking = False
+
+    def handle_write(self):
+        if self._handshaking:
+            return self._handshake()
+
+        try:
+            sent = self.socket.send(self._output)
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                return
+            raise
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        self._output = self._output[sent:]
+
+    def handle_read(self):
+        if self._handshaking:
+            return self._handshake()
+
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except ssl.SSLError, e:
+                if e.args[0] == ssl.SSL_ERROR_WANT_READ:
+                    return
+                raise
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            if not data:
+                return self.handle_close()
+            self._input.append(data)
+            self._received += len(data)
+            if self._is_complete():
+                return self.handle_close()
+            if not self._tls or not self.socket.pending():
+                return
+
+    def _is_complete(self):
+        if self._head is None:
+            data = "".join(self._input)
+            end = data.find("\r\n\r\n")
+            if end < 0:
+                return False
+            self._head = (end + 4, mimetools.Message(
+                cStringIO.StringIO(data[data.find("\r\n") + 2:end + 2])))
+
+        offset, headers = self._head
+        length = headers.getheader("content-length")
+        return length is not None and self._received - offset >= int(length)
+
+    def handle_close(self):
+        self.close()
+        if self.future.done():
+            return
+
+        complete = self._is_complete()
+        if self._head is None:
+            return self.fail(urllib2.URLError("incomplete response"))
+
+        offset, headers = self._head
+        length = headers.getheader("content-length")
+        if length is not None and not complete:
+            return self.fail(urllib2.URLError("incomplete response"))
+
+        data = "".join(self._input)
+        self._input = []
+        status, _, _ = data.partition("\r\n")
+        _, code, msg = (status.split(" ", 2) + [""])[:3]
+        body = data[offset:]
+        if length is not None:
+            body = body[:int(length)]
+
+        self.future.set_result(Response(
+            self._request.get_full_url(), int(code), msg, headers, body))
+
+    def handle_error(self):
+        self.fail()
+
+    def fail(self, exception=None):
+        self.close()
+        if self.future.done():
+            return
+        if exception is None:
+            self.future.set_exc_info(sys.exc_info())
+        else:
+            self.future.set_exception(exception)
+
+
+class AsyncHTTPClient(object):
+    MAX_REDIRECTS = 5
+
+    # How often to look for a free limiter slot while all are taken.
+    LIMITER_POLL = 0.01
+
+    def __init__(self, loop, cookie_jar, timeout=60, limiter=None):
+        self._loop = loop
+        self._cookie_jar = cookie_jar
+        self._timeout = timeout
+        self._limiter = limiter
+
+    @coroutine
+    def open(self, url, data=None):
+        for _ in range(self.MAX_REDIRECTS + 1):
+            request = urllib2.Request(url, data)
+            self._cookie_jar.add_cookie_header(request)
+            response = yield self._send(request)
+            self._cookie_jar.extract_cookies(response, request)
+
+            location = response.headers.getheader("location")
+            if response.code in (301, 302, 303, 307) and location:
+                url = urlparse.urljoin(url, location)
+                data = None
+                continue
+
+            if response.code >= 400:
+                raise urllib2.HTTPError(
+                    url, response.code, response.msg, response.headers,
+                    cStringIO.StringIO(response.body))
+            raise Return(response)
+
+        raise urllib2.URLError("too many redirects")
+
+    @coroutine
+    def _send(self, request):
+        if self._limiter is None:
+            response = yield _Connection(self._loop, request, self._timeout).future
+            raise Return(response)
+
+        # Share the limiter with the blocking browsers, without ever
+        # blocking the loop in it.
+        slot = self._limiter.try_acquire()
+        while slot is None:
+            yield self._loop.sleep(self.LIMITER_POLL)
+            slot = self._limiter.try_acquire()
+        delay, started = slot
+        if delay:
+            yield self._loop.sleep(delay)
+
+        try:
+            response = yield _Connection(
+                self._loop, request, self._timeout).future
+        except Exception:
+            self._limiter.release(started, False)
+            raise
+        self._limiter.release(started, response.code < 500)
+        raise Return(response)
+
+
+class AsyncCurrentTimeBrowser(CurrentTimeBrowser):
+    """CurrentTimeBrowser whose requests return Futures."""
+
+    def __init__(self, server, loop, timeout=60):
+        CurrentTimeBrowser.__init__(self, server)
+        self._loop = loop
+        self._timeout = timeout
+
+    @property
+    def _client(self):
+        if not hasattr(self, '_cookie_jar'):
+            self._cookie_jar = cookielib.CookieJar()
+        return AsyncHTTPClient(self._loop, self._cookie_jar, self._timeout,
+                               self.limiter)
+
+    @property
+    def current_page(self):
+        return getattr(self, '_current_page', None)
+
+    @coroutine
+    def get_current_page(self):
+        if not self.current_page:
+            yield self.get_current_month()
+        raise Return(self._current_page)
+
+    @coroutine
+    def login(self, username, password):
+        login_url = self._get_url('login')
+        data = self._get_login_data(username, password)
+
+        response = yield self._client.open(login_url, data)
+
+        is_logged_in = response.geturl() != login_url
+        if is_logged_in:
+            self._current_page = response.read()
+
+        raise Return(is_logged_in)
+
+    @coroutine
+    def get(self, command):
+        url = self._get_command_url(command)
+        page = yield self._read(url)
+        self._current_page = page
+        raise Return(page)
+
+    @coroutine
+    def update(self, session_id, activity):
+        page = yield self.update_many(session_id, [activity])
+        raise Return(page)
+
+    @coroutine
+    def update_many(self, session_id, activities):
+        url = self._get_url('rpc')
+        page = yield self._read(url, self._get_save_data(session_id, activities))
+        self._current_page = page
+        raise Return(page)
+
+    @coroutine
+    def _read(self, url, data=None):
+        response = yield self._client.open(url, data)
+        raise Return(response.read())
+
+
+class AsyncRangeAPI(object):
+    def __init__(self, server, loop, timeout=60):
+        self._browser = AsyncCurrentTimeBrowser(server, loop, timeout)
+        self._parser = CurrentTimeParser()
+
+    def login(self, username, password):
+        return self._browser.login(username, password)
+
+    @coroutine
+    def valid_session(self):
+        page = yield self._browser.get_current_page()
+        raise Return(self._parser.valid_session(page))
+
+    @coroutine
+    def get_projects(self):
+        response = yield self._browser.get_projects()
+        raise Return(self._parser.parse_projects(response))
+
+    @coroutine
+    def get_activities(self, from_date, to_date):
+        activities = []
+        year, month = from_date.year, from_date.month
+        while (year, month) <= (to_date.year, to_date.month):
+            for activity in (yield self._get_month(year, month)):
+                if from_date <= activity.date and activity.date <= to_date:
+                    activities.append(activity)
+
+            month += 1
+            if month > 12:
+                month = 1
+                year += 1
+
+        raise Return(activities)
+
+    @coroutine
+    def report_activity(self, activity, previous=None):
+        yield self._show(activity.date)
+        check_for_conflicts(activity, previous, self._get_displayed_cell,
+                            lambda previous, actual: previous != actual)
+
+        session_id = self._parser.parse_session_id(self._browser.current_page)
+        response = yield self._browser.update(session_id, activity)
+        raise Return(response)
+
+    @coroutine
+    def _get_month(self, year, month):
+        page = yield self._browser.get_current_page()
+        start, end = self._parser._get_current_range(page)
+        if not is_month_view(start, end, year, month):
+            yield self._goto(year, month)
+            page = yield self._browser.get_current_month()
+            start, end = self._parser._get_current_range(page)
+
+        check_month_view(start, end, year, month)
+        raise Return(self._parser.parse_activities(page))
+
+    @coroutine
+    def _goto(self, year, month):
+        page = yield self._browser.get_current_page()
+        current = self._parser.parse_navigation(page)
+        plan = NavigationPlan(current, datetime.date(year, month, 1))
+        for step in plan.steps:
+            page = yield getattr(self._browser, step)()
+
+        step = plan.fallback_step(self._parser.parse_navigation(page))
+        while step is not None:
+            page = yield getattr(self._browser, step)()
+            step = plan.fallback_step(self._parser.parse_navigation(page))
+
+        raise Return(plan)
+
+    @coroutine
+    def _show(self, date):
+        page = yield self._browser.get_current_page()
+        start, end = self._parser._get_current_range(page)
+        if not (start <= date and date <= end):
+            yield self._goto(date.year, date.month)
+            command = self._parser.get_day_command(
+                self._browser.current_page, date.day)
+            yield self._browser.get(command)
+
+    def _get_displayed_cell(self, date, project_id):
+        index = self._parser.parse_activity_index(self._browser.current_page)
+        return list(index.get((date, project_id), []))
@@ -30,39 +30,124 @@
 # as representing official policies, either expressed or implied, of
 # Alf Lervåg.
 
+import collections
 import datetime
-import unittest
+import httplib
+import os
 
-from parser import CurrentTimeParser
+from cache import TTLCache
+from catalog import ProjectCatalog
+from parser import CurrentTimeParser, IncrementalParser
 from browser import CurrentTimeBrowser
+from navigation import FetchPlan, NavigationError, NavigationPlan
+from navigation import check_month_view, check_range, is_month_view
 
 __all__ = ["BaseAPI", "SimpleAPI"]
 
 
+ReportResult = collections.namedtuple("ReportResult", "activity saved error")
+
+
 class BaseAPI(object):
-    def __init__(self, server):
+    def __init__(self, server, incremental=False):
         self._browser = CurrentTimeBrowser(server)
-        self._parser = CurrentTimeParser()
+        if incremental:
+            self._parser = IncrementalParser()
+        else:
+            self._parser = CurrentTimeParser()
+        self.last_navigation = None
+        self.round_trips_saved = 0
+        self._catalog = None
+        self.stats = None
+
+    def clone(self, session=True):
+        api = BaseAPI(None, isinstance(self._parser, IncrementalParser))
+        api._browser = self._browser.clone(session)
+        api.instrument(self.stats)
+        return api
+
+    def close(self):
+        self._browser.close()
+
+    def instrument(self, stats):
+        """Record requests, parse timings and navigation in ``stats``.
+
+        Pass None to turn instrumentation off again.
+        """
+        self.stats = stats
+        self._browser.stats = stats
+        self._parser.stats = stats
+
+    def set_retry_policy(self, policy):
+        """Retry, and maybe hedge, GET commands with a RetryPolicy.
+
+        Saves are never retried.  Pass None to send every request once.
+        """
+        self._browser.retry = policy
 
     def login(self, username, password):
         return self._browser.login(username, password)
 
-    def valid_session(self):
-        return self._parser.valid_session(self._browser.current_page)
+    def valid_session(self, trust_for=None):
+        """Whether the server still accepts the session.
+
+        Cookie expiry and the last accepted request are trusted for
+        ``trust_for`` seconds, after that the server is probed.
+        """
+        if trust_for is None:
+            trust_for = self._browser.TRUST_FOR
+
+        state = self._browser.session_state(trust_for)
+        if state is None:
+            state = self._browser.probe_session()
+        return state
+
+    def resume(self, username, password, store):
+        """Continue the session saved in ``store``, or log in again.
+
+        The saved session is only used if the server still accepts it.
+        A fresh login is saved for the next process to use.
+        """
+        server = self._browser._server
+        state = store.load(server, username)
+        if state is not None:
+            self._browser.restore(state)
+            if self.valid_session():
+                store.save(server, username, self._browser.__getstate__())
+                return True
+            store.discard(server, username)
+
+        if not self.login(username, password):
+            return False
+
+        store.save(server, username, self._browser.__getstate__())
+        return True
+
+    @property
+    def _page(self):
+        return self._parser.page(self._browser.current_page)
 
     def get_day(self, year, month, day):
-        start, end = self._parser._get_current_range(self._browser.current_page)
+        page = self._page
+        start, end = self._parser._get_current_range(page)
         current = datetime.date(year, month, day)
         if start <= current and current <= end:
-            activities = self._parser.parse_activities(self._browser.current_page)
+            activities = self._parser.parse_activities(page)
             return [a for a in activities if a.date == current]
         else:
             self._goto(year, month)
             page = self._browser._current_page
             command = self._parser.get_day_command(page, day)
-            page = self._browser.get(command)
+            page = self._get_view(command, [current])
             return self._parser.parse_activities(page)
 
+    def get_cell(self, date, project_id):
+        if not self._is_in_correct_state(date):
+            self.get_day(date.year, date.month, date.day)
+
+        index = self._parser.parse_activity_index(self._page)
+        return list(index.get((date, project_id), []))
+
     def get_week(self, year, week):
         date = datetime.date(year, 1, 1) + datetime.timedelta(weeks=week)
         self._goto(year, date.month)
@@ -71,51 +156,186 @@ class BaseAPI(object):
         page = self._browser.get(command)
         return self._parser.parse_activities(page)
 
+    def get_week_of(self, date):
+        """Show the calendar week holding ``date`` in its own month."""
+        self._goto(date.year, date.month)
+        week = date.isocalendar()[1]
+        command = self._parser.get_week_command(self._page, week)
+        page = self._get_view(command, [date])
+        return self._parser.parse_activities(page)
+
+    def _get_view(self, command, dates):
+        """Show the week or day view ``command``, which must hold ``dates``."""
+        if command is None:
+            # The calendar doesn't link to the view.
+            start, end = self._parser._get_current_range(self._page)
+            raise NavigationError(dates[0], start)
+
+        page = self._browser.get(command)
+        start, end = self._parser._get_current_range(page)
+        check_range(start, end, dates)
+        return page
+
+    def get_view_state(self):
+        """Return the calendar month and the range the timesheet shows."""
+        page = self._page
+        return (self._parser.parse_navigation(page),
+                self._parser._get_current_range(page))
+
+    def get_displayed_activities(self):
+        return self._parser.parse_activities(self._page)
+
     def get_month(self, year, month):
-        start, end = self._parser._get_current_range(self._browser.current_page)
-        if start.year != year or start.month != month:
+        start, end = self._parser._get_current_range(self._page)
+        if not is_month_view(start, end, year, month):
             self._goto(year, month)
             self._browser.get_current_month()
-            start, end = self._parser._get_current_range(self._browser.current_page)
 
-        if not (start.day == 1 and end.day >= 28):
-            self._browser.get_current_month()
+        page = self._page
+        start, end = self._parser._get_current_range(page)
+        check_month_view(start, end, year, month)
+        return self._parser.parse_activities(page)
 
-        return self._parser.parse_activities(self._browser.current_page)
+    def iter_month(self, year, month):
+        start, end = self._parser._get_current_range(self._page)
+        if start.year != year or start.month != month:
+            self._goto(year, month)
+        elif start.day == 1 and end.day >= 28:
+            for activity in self._parser.parse_activities(self._page):
+                yield activity
+            return
+
+        command = self._browser.COMMANDS.get('get_current_month')
+        stream = self._parser.iter_activities(self._browser.stream(command))
+        for activity in stream:
+            if (activity.date.year, activity.date.month) != (year, month):
+                raise NavigationError(datetime.date(year, month, 1), activity.date)
+            yield activity
+
+    def get_displayed_month(self):
+        page = self._page
+        start, end = self._parser._get_current_range(page)
+        next_day = end + datetime.timedelta(days=1)
+        if start.day != 1 or next_day.day != 1 or start.month != end.month:
+            return None
+
+        return (start.year, start.month), self._parser.parse_activities(page)
         
     def report_activity(self, activity):
-        session_id = self._parser.parse_session_id(self._browser.current_page)
+        session_id = self._parser.parse_session_id(self._page)
         if not self._is_in_correct_state(activity.date):
             raise ValueError(
                 "Date argument is not withing the currently displayed date.")
 
         return self._browser.update(session_id, activity)
 
+    def report_activities(self, activities):
+        months = {}
+        for i, activity in enumerate(activities):
+            month = (activity.date.year, activity.date.month)
+            months.setdefault(month, []).append(i)
+
+        results = [None] * len(activities)
+        for month in sorted(months):
+            indexes = months[month]
+            group = [activities[i] for i in indexes]
+            for i, (saved, error) in zip(indexes, self._report_month(month, group)):
+                results[i] = ReportResult(activities[i], saved, error)
+
+        return results
+
+    def _report_month(self, month, activities):
+        try:
+            if not all(self._is_in_correct_state(a.date) for a in activities):
+                self.get_month(*month)
+        except (IOError, httplib.HTTPException, NavigationError), e:
+            return [(False, e)] * len(activities)
+
+        outcomes = []
+        for batch in self._get_batches(activities):
+            try:
+                session_id = self._parser.parse_session_id(self._page)
+                page = self._browser.update_many(session_id, batch)
+            except (IOError, httplib.HTTPException), e:
+                outcomes.extend([(False, e)] * len(batch))
+                continue
+
+            shown = set(self._get_saved_values(a)
+                        for a in self._parser.parse_activities(page))
+            for activity in batch:
+                outcomes.append((self._get_saved_values(activity) in shown, None))
+
+        return outcomes
+
+    def _get_batches(self, activities):
+        batches = []
+        for activity in activities:
+            cell = (activity.full_project_id, activity.date)
+            for batch, cells in batches:
+                if cell not in cells:
+                    break
+            else:
+                batch, cells = [], set()
+                batches.append((batch, cells))
+            batch.append(activity)
+            cells.add(cell)
+
+        return [batch for batch, _ in batches]
+
+    def _get_saved_values(self, activity):
+        return (activity.date, activity.project_id, activity.duration,
+                activity.comment.strip())
+
     def get_projects(self):
         response = self._browser.get_projects()
         return self._parser.parse_projects(response)
 
+    def get_catalog(self, max_age=3600, path=None):
+        # A catalog stored at path lets a fresh process skip the
+        # projects page as long as the file is recent enough.
+        catalog = self._catalog
+        if catalog is None or catalog.age > max_age:
+            catalog = None
+            if path and os.path.exists(path):
+                try:
+                    catalog = ProjectCatalog.load(path)
+                except (EnvironmentError, ValueError, KeyError, TypeError,
+                        IndexError):
+                    # A corrupt or foreign file is replaced below.
+                    catalog = None
+                if catalog is not None and catalog.age > max_age:
+                    catalog = None
+
+        if catalog is None:
+            catalog = ProjectCatalog(self.get_projects())
+            if path:
+                catalog.save(path)
+
+        self._catalog = catalog
+        return catalog
+
     def _goto(self, year, month):
         assert month > 0 and month <= 12
 
-        current = self._parser.parse_navigation(self._browser.current_page)
-
-        offset = abs(current.year - year)
-        if current.year < year:
-            for _ in range(offset):
-                self._goto_next_year()
-        else:
-            for _ in range(offset):
-                self._goto_prev_year()
-
-        offset = abs(current.month - month)
-        if current.month < month:
-            for _ in range(offset):
-                self._goto_next_month()
-        else:
-            for _ in range(offset):
-                self._goto_prev_month()
-
+        current = self._parser.parse_navigation(self._page)
+        plan = NavigationPlan(current, datetime.date(year, month, 1))
+        for step in plan.steps:
+            getattr(self._browser, step)()
+
+        # Fall back to stepping month by month if the calendar did not end
+        # up where the plan said it would.
+        step = plan.fallback_step(self._parser.parse_navigation(self._page))
+        while step is not None:
+            current = getattr(self, "_" + step)()
+            step = plan.fallback_step(current)
+
+        self.last_navigation = plan
+        self.round_trips_saved += plan.saved
+        if self.stats is not None:
+            self.stats.incr('navigation.steps', len(plan.steps) + plan.fallback_steps)
+            self.stats.incr('navigation.fallback_steps', plan.fallback_steps)
+            self.stats.incr('navigation.saved', plan.saved)
+        return plan
 
     def _goto_next_month(self):
         response = self._browser.goto_next_month()
@@ -134,55 +354,323 @@ class BaseAPI(object):
         return self._parser.parse_navigation(response)
 
     def _is_in_correct_state(self, date):
-        start, end = self._parser._get_current_range(self._browser.current_page)
+        start, end = self._parser._get_current_range(self._page)
         return start <= date and date <= end
 
 
 class SimpleAPI(object):
-    def __init__(self, server):
-        self._ct = BaseAPI(server)
+    def __init__(self, server, incremental=False):
+        self._ct = BaseAPI(server, incremental)
+
+    def clone(self, session=True):
+        api = SimpleAPI.__new__(SimpleAPI)
+        api._ct = self._ct.clone(session)
+        return api
+
+    def close(self):
+        self._ct.close()
+
+    def instrument(self, stats):
+        self._ct.instrument(stats)
+
+    def set_retry_policy(self, policy):
+        self._ct.set_retry_policy(policy)
 
     def login(self, username, password):
         return self._ct.login(username, password)
 
-    def valid_session(self):
-        return self._ct.valid_session()
+    def resume(self, username, password, store):
+        return self._ct.resume(username, password, store)
+
+    def valid_session(self, trust_for=None):
+        return self._ct.valid_session(trust_for)
 
     def get_projects(self, *args, **kwargs):
         return self._ct.get_projects(*args, **kwargs)
 
+    def get_catalog(self, *args, **kwargs):
+        return self._ct.get_catalog(*args, **kwargs)
+
     def get_activities(self, year, month):
         return self._ct.get_month(year, month)
 
+    def iter_activities(self, year, month):
+        return self._ct.iter_month(year, month)
+
+    def get_displayed_month(self):
+        return self._ct.get_displayed_month()
+
+    def get_displayed_activities(self):
+        return self._ct.get_displayed_activities()
+
+    def get_view_state(self):
+        return self._ct.get_view_state()
+
+    def get_day(self, date):
+        return self._ct.get_day(date.year, date.month, date.day)
+
+    def get_week_of(self, date):
+        return self._ct.get_week_of(date)
+
+    def get_cell(self, date, project_id):
+        return self._ct.get_cell(date, project_id)
+
     def report_activity(self, activity):
         return self._ct.report_activity(activity)
 
+    def report_activities(self, activities):
+        return self._ct.report_activities(activities)
+
 
 class RangeAPI(object):
-    def __init__(self, server):
-        self._ct = SimpleAPI(server)
+    def __init__(self, server, concurrency=1, cache_ttl=None, cache_size=24,
+                 incremental=False):
+        self._ct = SimpleAPI(server, incremental)
+        self._concurrency = concurrency
+        self._credentials = None
+
+        self.last_plan = None
+        self.cache = None
+        if cache_ttl is not None:
+            self.cache = TTLCache(cache_size, cache_ttl)
+
+    def close(self):
+        self._ct.close()
+
+    def instrument(self, stats):
+        self._ct.instrument(stats)
+
+    def set_retry_policy(self, policy):
+        self._ct.set_retry_policy(policy)
 
     def login(self, username, password):
-        return self._ct.login(username, password)
+        logged_in = self._ct.login(username, password)
+        if logged_in:
+            self._credentials = (username, password)
+        return logged_in
 
-    def valid_session(self):
-        return self._ct.valid_session()
+    def resume(self, username, password, store):
+        resumed = self._ct.resume(username, password, store)
+        if resumed:
+            self._credentials = (username, password)
+        return resumed
+
+    def valid_session(self, trust_for=None):
+        return self._ct.valid_session(trust_for)
 
     def get_projects(self, *args, **kwargs):
         return self._ct.get_projects(*args, **kwargs)
 
-    def get_activities(self, from_date, to_date):
+    def get_catalog(self, *args, **kwargs):
+        return self._ct.get_catalog(*args, **kwargs)
+
+    def get_displayed_month(self):
+        return self._ct.get_displayed_month()
+
+    def get_activities(self, from_date, to_date, concurrency=None):
+        if concurrency is None:
+            concurrency = self._concurrency
+
+        months = list(self._get_months_in_range(from_date, to_date))
+        fetched = dict((m, self._get_cached_month(m)) for m in months)
+        missing = [m for m in months if fetched[m] is None]
+        # Parallel workers log in on their own, since copies of one
+        # session would move each other's calendar.
+        parallel = concurrency > 1 and self._credentials is not None
+        if parallel and len(missing) > 1:
+            results = self._get_months_in_parallel(missing, concurrency)
+            for month, result in zip(missing, results):
+                fetched[month] = result
+                if self.cache is not None:
+                    self.cache.put(month, result)
+        elif missing:
+            wanted = set(missing)
+            dates = [d for d in self._get_dates_in_range(from_date, to_date)
+                     if (d.year, d.month) in wanted]
+            for month in missing:
+                fetched[month] = []
+            for activity in self._get_planned(dates):
+                fetched[activity.date.year, activity.date.month].append(activity)
+            for month in missing:
+                fetched[month].sort()
+
         activities = []
-        for year, month in self._get_months_in_range(from_date, to_date):
-            for activity in self._ct.get_activities(year, month):
+        for month in months:
+            for activity in fetched[month]:
                 if from_date <= activity.date and activity.date <= to_date:
                     activities.append(activity)
 
         return activities
 
+    def plan_fetch(self, from_date, to_date):
+        """The views get_activities would use for the uncached dates."""
+        dates = [d for d in self._get_dates_in_range(from_date, to_date)
+                 if self._get_cached_month((d.year, d.month)) is None]
+        return self._plan(dates)
+
+    def _plan(self, dates):
+        current, displayed = self._ct.get_view_state()
+        return FetchPlan(dates, current, displayed)
+
+    def _get_planned(self, dates):
+        plan = self.last_plan = self._plan(dates)
+
+        activities = []
+        for step in plan.steps:
+            if step.view == 'month':
+                result = self._ct.get_activities(step.date.year, step.date.month)
+                if self.cache is not None:
+                    self.cache.put((step.date.year, step.date.month), result)
+            elif step.view in ('week', 'day'):
+                try:
+                    if step.view == 'week':
+                        result = self._ct.get_week_of(step.date)
+                    else:
+                        result = self._ct.get_day(step.date)
+                    start, end = self._ct.get_view_state()[1]
+                    check_range(start, end, step.dates)
+                except NavigationError:
+                    # The month view shows every date the smaller view
+                    # should have.
+                    result = self._ct.get_activities(
+                        step.date.year, step.date.month)
+                    if self.cache is not None:
+                        self.cache.put((step.date.year, step.date.month),
+                                       result)
+            else:
+                result = self._ct.get_displayed_activities()
+                self._update_cache_from_displayed_month()
+
+            dates = set(step.dates)
+            activities.extend(a for a in result if a.date in dates)
+        return activities
+
+    def iter_activities(self, from_date, to_date):
+        """Yield the activities between two dates a month at a time.
+
+        Each month is fetched only when the previous one has been
+        consumed, so nothing more is fetched once the caller stops.
+        Months are fetched one after another in this session.
+        """
+        for month in self._get_months_in_range(from_date, to_date):
+            activities = self._get_cached_month(month)
+            if activities is None:
+                activities = self._ct.get_activities(*month)
+                if self.cache is not None:
+                    self.cache.put(month, activities)
+
+            for activity in activities:
+                if from_date <= activity.date and activity.date <= to_date:
+                    yield activity
+
+    def _get_cached_month(self, month):
+        if self.cache is not None:
+            return self.cache.get(month)
+
+    def _get_months_in_parallel(self, months, concurrency):
+        workers = min(concurrency, len(months))
+        size = -(-len(months) // workers)
+        chunks = [months[i:i + size] for i in range(0, len(months), size)]
+
+        # multiprocessing is only worth importing when it is used.
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(len(chunks))
+        try:
+            results = pool.map(self._get_months_in_clone, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+        # Months a worker could not log in for or navigate to are
+        # fetched again by the original session.
+        fetched = []
+        for chunk, result in zip(chunks, results):
+            for (year, month), activities in zip(chunk, result):
+                if activities is None:
+                    activities = self._ct.get_activities(year, month)
+                fetched.append(activities)
+        return fetched
+
+    def _get_months_in_clone(self, months):
+        api = self._ct.clone(session=False)
+        try:
+            if not api.login(*self._credentials):
+                return [None] * len(months)
+
+            result = []
+            for year, month in months:
+                try:
+                    result.append(api.get_activities(year, month))
+                except NavigationError:
+                    result.append(None)
+            return result
+        finally:
+            api.close()
+
     def report_activity(self, activity, previous=None):
         self._perform_optimistic_concurrency_validation(activity, previous)
-        return self._ct.report_activity(activity)
+        if self.cache is not None:
+            self.cache.invalidate((activity.date.year, activity.date.month))
+
+        response = self._ct.report_activity(activity)
+        self._update_cache_from_displayed_month()
+        return response
+
+    def report_activities(self, activities, previous=None):
+        if previous is None:
+            previous = [None] * len(activities)
+
+        months = {}
+        for i, activity in enumerate(activities):
+            month = (activity.date.year, activity.date.month)
+            months.setdefault(month, []).append(i)
+
+        results = [None] * len(activities)
+        for month in sorted(months):
+            # Show the whole month once, so that validating and saving
+            # its activities needs no further navigation.
+            try:
+                self._ct.get_activities(*month)
+            except (IOError, httplib.HTTPException, NavigationError), e:
+                for i in months[month]:
+                    results[i] = ReportResult(activities[i], False, e)
+                continue
+
+            valid = []
+            for i in months[month]:
+                try:
+                    self._perform_optimistic_concurrency_validation(
+                        activities[i], previous[i])
+                except (ActivityConflict, IOError, httplib.HTTPException,
+                        NavigationError), e:
+                    results[i] = ReportResult(activities[i], False, e)
+                else:
+                    valid.append(i)
+
+            if self.cache is not None:
+                self.cache.invalidate(month)
+
+            reported = self._ct.report_activities([activities[i] for i in valid])
+            for i, result in zip(valid, reported):
+                results[i] = result
+
+            self._update_cache_from_displayed_month()
+
+        return results
+
+    def _update_cache_from_displayed_month(self):
+        # The response to a save is the updated timesheet, so it can
+        # replace the cached month when it shows the whole month.
+        if self.cache is not None:
+            displayed = self._ct.get_displayed_month()
+            if displayed is not None:
+                self.cache.put(*displayed)
+
+    def _get_dates_in_range(self, from_date, to_date):
+        current = from_date
+        while current <= to_date:
+            yield current
+            current += datetime.timedelta(days=1)
 
     def _get_months_in_range(self, from_date, to_date):
         year, month = from_date.year, from_date.month
@@ -195,47 +683,33 @@ class RangeAPI(object):
                 year += 1
 
     def _perform_optimistic_concurrency_validation(self, activity, previous):
-        activities = self.get_activities(activity.date, activity.date)
-        if not previous and activity in activities:
-            index = activities.index(activity)
-            previous = activities[index]
-            raise ActivityAlreadyExists(activity, previous)
-
-        if not previous in activities:
-            raise PreviousActivityNotFound(activity, previous)
-
-        index = activities.index(previous)
-        actual_previous = activities[index]
-        if self._has_changed(previous, actual_previous):
-            raise PreviousActivityChanged(activity, actual_previous)
+        check_for_conflicts(
+            activity, previous, self._ct.get_cell, self._has_changed)
 
     def _has_changed(self, form_previous, actual_previous):
         return form_previous != actual_previous
 
 
-class TestRangeAPI(unittest.TestCase):
-    def test_1_month_in_same_month_and_year(self):
-        api = RangeAPI("no-server")
-        from_date = to_date = datetime.date(2011, 6, 1)
-        months = list(api._get_months_in_range(from_date, to_date))
-
-        self.assertEquals(1, len(months))
+def check_for_conflicts(activity, previous, get_cell, has_changed):
+    # Only the cell being written is looked at, which get_cell reads
+    # from the displayed page when it covers the date.
+    activities = get_cell(activity.date, activity.project_id)
+    if not previous and activity in activities:
+        index = activities.index(activity)
+        previous = activities[index]
+        raise ActivityAlreadyExists(activity, previous)
 
-    def test_2_months_in_same_year_and_following_month(self):
-        api = RangeAPI("no-server")
-        from_date = datetime.date(2011, 6, 1)
-        to_date = datetime.date(2011, 7, 1)
-        months = list(api._get_months_in_range(from_date, to_date))
+    if not previous or previous.date != activity.date:
+        raise PreviousActivityNotFound(activity, previous)
 
-        self.assertEquals(2, len(months))
+    activities = get_cell(previous.date, previous.project_id)
+    if not previous in activities:
+        raise PreviousActivityNotFound(activity, previous)
 
-    def test_13_months_in_same_month_and_following_year(self):
-        api = RangeAPI("no-server")
-        from_date = datetime.date(2011, 6, 1)
-        to_date = datetime.date(2012, 6, 1)
-        months = list(api._get_months_in_range(from_date, to_date))
-
-        self.assertEquals(13, len(months))
+    index = activities.index(previous)
+    actual_previous = activities[index]
+    if has_changed(previous, actual_previous):
+        raise PreviousActivityChanged(activity, actual_previous)
 
 
 class ActivityConflict(Exception):
@@ -254,6 +728,3 @@ class PreviousActivityChanged(ActivityConflict):
 
 class PreviousActivityNotFound(ActivityConflict):
     pass
-
-if __name__ == "__main__":
-    unittest.main()
@@ -31,12 +31,23 @@
 # Alf Lervåg.
 
 import datetime
+import pickle
+import re
+import socket
+import time
 import urllib
 import urllib2
 import cookielib
 
+from instrumentation import InstrumentedResponse
+from limiter import get_limiter
+from transport import ConnectionPool, TransferCounter
+from transport import KeepAliveHTTPHandler, KeepAliveHTTPSHandler
+
 __all__ = ["CurrentTimeBrowser"]
 
+LOGIN_PAGE = re.compile(r'<body[^>]*class=["\']?login\b', re.IGNORECASE)
+
 
 def updates_current_page(meth):
     def decorate(self, *args, **kwargs):
@@ -55,6 +66,12 @@ class CurrentTimeBrowser(object):
         'goto_prev_year': 'caltimesheet=1,1',
     }
 
+    # These move the calendar from wherever it is, so sending one twice
+    # moves it twice.  Every other GET command shows the same page
+    # however often it is sent.
+    RELATIVE_COMMANDS = ('goto_next_month', 'goto_prev_month',
+                         'goto_next_year', 'goto_prev_year')
+
     URLS = {
         'login': 'login.asp',
         'rpc': 'Timesheet/default.asp',
@@ -76,17 +93,50 @@ class CurrentTimeBrowser(object):
 
         return {
             'server': self._server,
-            'cookies': cookies
+            'cookies': cookies,
+            'pool_size': self._pool_size,
+            'idle_timeout': self._idle_timeout,
+            'last_good': getattr(self, 'last_good', None),
         }
 
     def __setstate__(self, state):
         self._server = state['server']
+        self._pool_size = state.get('pool_size', self.POOL_SIZE)
+        self._idle_timeout = state.get('idle_timeout', self.IDLE_TIMEOUT)
+        self.last_good = state.get('last_good')
         if 'cookies' in state:
             self._cookie_jar = cookielib.CookieJar()
             self._cookie_jar._cookies = state['cookies']
 
-    def __init__(self, server):
+    POOL_SIZE = 4
+    IDLE_TIMEOUT = 60
+
+    # The server forgets sessions after 20 idle minutes, so one that
+    # answered a few minutes ago is trusted without asking again.
+    TRUST_FOR = 5 * 60
+    PROBE_BYTES = 4096
+    PROBE_DRAIN = 65536
+
+    stats = None
+    retry = None
+    last_good = None
+
+    def __init__(self, server, pool_size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT):
         self._server = server
+        self._pool_size = pool_size
+        self._idle_timeout = idle_timeout
+
+    @property
+    def limiter(self):
+        """The AdaptiveLimiter shared by all browsers for this server."""
+        return get_limiter(self._server)
+
+    @property
+    def transfer(self):
+        """Bytes received by this browser, compressed and decoded."""
+        if getattr(self, '_transfer', None) is None:
+            self._transfer = TransferCounter()
+        return self._transfer
 
     @property
     def current_page(self):
@@ -99,18 +149,102 @@ class CurrentTimeBrowser(object):
         login_url = self._get_url('login')
         data = self._get_login_data(username, password)
 
+        # The response is read and closed even when the login failed,
+        # so that its connection and limiter slot are given back.
         response = self._open(login_url, data)
+        try:
+            page = response.read()
+        finally:
+            response.close()
 
         is_logged_in = response.geturl() != login_url
         if is_logged_in:
-            self._current_page = response.read()
+            self._current_page = page
+            self.last_good = time.time()
 
         return is_logged_in
 
+    def session_state(self, trust_for=TRUST_FOR):
+        """Tell what is known about the session without asking the server.
+
+        Returns False when there is no usable cookie, True when the
+        server accepted the session less than ``trust_for`` seconds ago
+        and None when only the server can tell.
+        """
+        cookies = list(getattr(self, '_cookie_jar', None) or ())
+        now = time.time()
+        if not cookies or any(cookie.is_expired(now) for cookie in cookies):
+            return False
+
+        if self.last_good is not None and now - self.last_good < trust_for:
+            return True
+
+    def probe_session(self):
+        """Ask the server whether the session is valid, as cheaply as possible.
+
+        The project page without a search is the smallest page there is
+        and it doesn't move the calendar.  A redirect to the login page
+        or a login page in the first bytes means the session is gone.
+        """
+        response = self._open(self._get_url('get_projects'))
+        try:
+            if response.geturl().endswith(self.URLS['login']):
+                valid = False
+            else:
+                head = response.read(self.PROBE_BYTES)
+                valid = not LOGIN_PAGE.search(head)
+
+                # Reading a small rest lets the connection be reused.
+                response.read(self.PROBE_DRAIN)
+        finally:
+            response.close()
+
+        self.last_good = valid and time.time() or None
+        return valid
+
     @updates_current_page
     def get(self, command):
         url = self._get_command_url(command)
-        return self._read(url)
+        if self.retry is None:
+            return self._read(url)
+
+        # Relative hops may be retried but never hedged: a retry only
+        # follows a request that failed, and BaseAPI._goto checks where
+        # the calendar ended up anyway.  Saves are POSTs and never get
+        # here.
+        return self.retry.call(lambda timeout: self._read(url, None, timeout),
+                               hedge=not self._is_relative(command),
+                               stats=self.stats)
+
+    def _is_relative(self, command):
+        return command in [self.COMMANDS[name]
+                           for name in self.RELATIVE_COMMANDS]
+
+    def stream(self, command, chunk_size=16384):
+        url = self._get_command_url(command)
+
+        # The server has moved on to the new page, so make sure the old
+        # one isn't used if the stream is abandoned half way.
+        self._current_page = None
+        response = self._open(url)
+        chunks = []
+        try:
+            # The body is read off the wire before anything is yielded,
+            # so the connection and its limiter slot aren't held while
+            # the caller works through the activities.
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            response.close()
+
+        for chunk in chunks:
+            yield chunk
+
+        self._current_page = "".join(chunks)
+        self._check_session(response.geturl(), self._current_page)
 
     def get_current_month(self):
         command = self.COMMANDS.get('get_current_month')
@@ -149,22 +283,44 @@ class CurrentTimeBrowser(object):
 
     @updates_current_page
     def update(self, session_id, activity):
-        project_id = activity.full_project_id
-        day = activity.date.day
-        hours = str(activity.duration).replace(".", ",")
-        comment = activity.comment
+        url = self._get_url('rpc')
+        data = self._get_save_data(session_id, [activity])
+        return self._read(url, data)
 
+    @updates_current_page
+    def update_many(self, session_id, activities):
         url = self._get_url('rpc')
-        data = urllib.urlencode({
-            "activityrow": "1",
-            "activityrow_1": project_id,
-            "cell_1_%s_duration" % day: hours,
-            "cell_1_%s_note" % day: comment,
+        data = self._get_save_data(session_id, activities)
+        return self._read(url, data)
+
+    def _get_save_data(self, session_id, activities):
+        rows = []
+        cells = {}
+        for activity in activities:
+            project_id = activity.full_project_id
+            if project_id not in rows:
+                rows.append(project_id)
+            row = rows.index(project_id) + 1
+
+            day = activity.date.day
+            if (row, day) in cells:
+                raise ValueError("Only one activity per project and day "
+                                 "can be saved at a time.")
+            cells[row, day] = activity
+
+        data = {
+            "activityrow": str(len(rows)),
             "useraction": "save",
             "sessionid": session_id,
-        })
+        }
+        for i, project_id in enumerate(rows):
+            data["activityrow_%s" % (i + 1)] = project_id
+        for (row, day), activity in cells.items():
+            hours = str(activity.duration).replace(".", ",")
+            data["cell_%s_%s_duration" % (row, day)] = hours
+            data["cell_%s_%s_note" % (row, day)] = activity.comment
 
-        return self._read(url, data)
+        return urllib.urlencode(data)
 
     @updates_current_page
     def delete_project(self, session_id, full_project_id, salary_id):
@@ -181,18 +337,104 @@ class CurrentTimeBrowser(object):
 
     def _read(self, *args):
         response = self._open(*args)
-        return response.read()
-
-    def _open(self, *args):
-        return self._opener.open(*args)
+        try:
+            page = response.read()
+        finally:
+            # A read that fails half way must still give back the
+            # connection and the limiter slot.
+            response.close()
+        self._check_session(response.geturl(), page)
+        return page
+
+    def _check_session(self, url, page):
+        if url.endswith(self.URLS['login']) or LOGIN_PAGE.search(page):
+            self.last_good = None
+        else:
+            self.last_good = time.time()
+
+    def _open(self, url, data=None, timeout=None):
+        if timeout is None:
+            timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+        kind = self._get_kind(url, data)
+        started = time.time()
+        try:
+            response = self._opener.open(url, data, timeout)
+        except urllib2.HTTPError, e:
+            # Nothing reads error pages, and the connection and its slot
+            # in the limiter are only given back once the body is done.
+            e.close()
+            if self.stats is not None:
+                self.stats.record_request(
+                    kind, url, e.code, time.time() - started, 0)
+            raise
+        except EnvironmentError:
+            if self.stats is not None:
+                self.stats.record_request(
+                    kind, url, 'error', time.time() - started, 0)
+            raise
+
+        if self.stats is None:
+            return response
+        return InstrumentedResponse(
+            response, self.stats, kind, started, response.getcode())
+
+    def _get_kind(self, url, data=None):
+        url, _, command = url.partition("?")
+        for name, rest in self.URLS.items():
+            if url.endswith(rest) and name != 'rpc':
+                return name
+
+        if data is not None:
+            return 'save'
+        for name, known in self.COMMANDS.items():
+            if command == known:
+                return name
+        return 'get'
+
+    def restore(self, state):
+        """Continue the session in ``state``, as saved by __getstate__."""
+        self.close()
+        self._keep_alive_opener = None
+        self._current_page = None
+        self.__setstate__(state)
+
+    def clone(self, session=True):
+        """Copy the browser, in the same server side session by default.
+
+        Copies in one session share the displayed calendar on the
+        server.  With ``session`` False the copy has no cookies and has
+        to log in on its own.
+        """
+        browser = pickle.loads(pickle.dumps(self))
+        if not session:
+            browser._cookie_jar = cookielib.CookieJar()
+            browser.last_good = None
+        browser.stats = self.stats
+        browser.retry = self.retry
+        return browser
+
+    def close(self):
+        pool = getattr(self, '_pool', None)
+        if pool is not None:
+            pool.close()
 
     @property
     def _opener(self):
         if not hasattr(self, '_cookie_jar'):
             self._cookie_jar = cookielib.CookieJar()
 
-        return urllib2.build_opener(
-            urllib2.HTTPCookieProcessor(self._cookie_jar))
+        # The pool isn't part of the pickled state, so it's created
+        # again on first use after unpickling.
+        if getattr(self, '_keep_alive_opener', None) is None:
+            self._pool = ConnectionPool(self._pool_size, self._idle_timeout)
+            self._keep_alive_opener = urllib2.build_opener(
+                urllib2.HTTPCookieProcessor(self._cookie_jar),
+                KeepAliveHTTPHandler(self._pool, self.transfer,
+                                     limiter=self.limiter),
+                KeepAliveHTTPSHandler(self._pool, self.transfer,
+                                      limiter=self.limiter))
+
+        return self._keep_alive_opener
 
     def _get_login_data(self, username, password):
         return urllib.urlencode({
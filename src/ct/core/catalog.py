@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Copyright 2011 Alf Lervåg. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY ALF LERVÅG ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL ALF LERVÅG OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be interpreted
+# as representing official policies, either expressed or implied, of
+# Alf Lervåg.
+
+import bisect
+import json
+import os
+import time
+
+from ct.core.project import Project
+
+__all__ = ["ProjectCatalog"]
+
+
+class ProjectCatalog(object):
+    """Projects indexed by id, by id hierarchy and by name."""
+
+    def __init__(self, projects, fetched_at=None):
+        if fetched_at is None:
+            fetched_at = time.time()
+
+        self.fetched_at = fetched_at
+        self._projects = list(projects)
+        self._by_id = {}
+        self._by_parent = {}
+        for project in self._projects:
+            self._by_id[project.id] = project
+            ids = project.ids
+            for depth in range(1, 4):
+                self._by_parent.setdefault(ids[:depth], []).append(project)
+
+        self._names = sorted(
+            (p.name.lower(), i) for i, p in enumerate(self._projects))
+
+    def __iter__(self):
+        return iter(self._projects)
+
+    def __len__(self):
+        return len(self._projects)
+
+    def __contains__(self, project_id):
+        return project_id in self._by_id
+
+    @property
+    def age(self):
+        return time.time() - self.fetched_at
+
+    def get(self, project_id, default=None):
+        """Look up a project by its id, e.g. ``"1,2,3,4"``."""
+        return self._by_id.get(project_id, default)
+
+    def find(self, projectid, taskid=None, subtaskid=None):
+        """All projects below the given project, task and subtask ids."""
+        if subtaskid is not None and taskid is None:
+            raise ValueError("A subtask id needs a task id.")
+        key = tuple(int(x) for x in (projectid, taskid, subtaskid)
+                    if x is not None)
+        return list(self._by_parent.get(key, []))
+
+    def search(self, prefix):
+        """All projects whose name starts with ``prefix``, ignoring case."""
+        prefix = prefix.lower()
+        result = []
+        start = bisect.bisect_left(self._names, (prefix,))
+        for name, i in self._names[start:]:
+            if not name.startswith(prefix):
+                break
+            result.append(self._projects[i])
+        return result
+
+    def save(self, path):
+        data = {
+            'fetched_at': self.fetched_at,
+            'projects': [
+                [[p.project_name, p.task_name, p.subtask_name, p.activity_name],
+                 list(p.ids)]
+                for p in self._projects],
+        }
+
+        # Write to a temporary file first so that readers never see a
+        # partially written catalog.
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+
+        projects = [Project(names, ids) for names, ids in data['projects']]
+        return cls(projects, data['fetched_at'])
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# Copyright 2011 Alf Lervåg. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY ALF LERVÅG ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL ALF LERVÅG OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be interpreted
+# as representing official policies, either expressed or implied, of
+# Alf Lervåg.
+
+"""Request and parse statistics.
+
+Instrumentation is off unless a Stats object, or anything else with the
+same ``record_*`` and ``incr`` methods, is handed to ``instrument`` on
+an API.  Disabled hooks cost one attribute lookup.
+"""
+
+import bisect
+import threading
+import time
+
+__all__ = ["Stats", "Histogram", "InstrumentedResponse", "timed"]
+
+LATENCY_BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+SIZE_BOUNDS = (1024, 10240, 102400, 1048576)
+
+
+def timed(name):
+    """Record the time spent in a parser method under ``parse.name``."""
+    def decorator(meth):
+        def decorate(self, *args, **kwargs):
+            stats = self.stats
+            if stats is None:
+                return meth(self, *args, **kwargs)
+
+            started = time.time()
+            try:
+                return meth(self, *args, **kwargs)
+            finally:
+                stats.record_parse(name, time.time() - started)
+        return decorate
+    return decorator
+
+
+class Histogram(object):
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        if self.count:
+            return float(self.total) / self.count
+
+    def export(self):
+        bounds = list(self.bounds) + [None]
+        return {
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            'buckets': zip(bounds, self.buckets),
+        }
+
+
+class Stats(object):
+    """Counters and histograms for requests and parsing.
+
+    Requests are recorded per kind, which is the browser command name
+    (``goto_next_month``, ``save``, ``login`` ...), as
+    ``request.<kind>.latency`` and ``request.<kind>.bytes``.  Parser
+    timings are recorded as ``parse.<name>``.  Safe to share between
+    threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_request(self, kind, url, status, elapsed, size):
+        with self._lock:
+            self._incr('request.%s.count' % kind)
+            self._incr('request.status.%s' % status)
+            self._incr('request.bytes', size)
+            self._histogram('request.%s.latency' % kind, LATENCY_BOUNDS).add(elapsed)
+            self._histogram('request.%s.bytes' % kind, SIZE_BOUNDS).add(size)
+
+    def record_parse(self, name, elapsed):
+        with self._lock:
+            self._histogram('parse.%s' % name, LATENCY_BOUNDS).add(elapsed)
+
+    def export(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': dict((name, h.export())
+                                   for name, h in self.histograms.items()),
+            }
+
+    def _incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def _histogram(self, name, bounds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(bounds)
+        return histogram
+
+
+class InstrumentedResponse(object):
+    """Wraps a response and records it once it has been read or closed."""
+
+    def __init__(self, response, stats, kind, started, status=200):
+        self._response = response
+        self._stats = stats
+        self._kind = kind
+        self._started = started
+        self._status = status
+        self._size = 0
+        self._recorded = False
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        self._size += len(data)
+        if not data or not args:
+            self._record()
+        return data
+
+    def close(self):
+        self._record()
+        self._response.close()
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def _record(self):
+        if not self._recorded:
+            self._recorded = True
+            self._stats.record_request(
+                self._kind, self._response.geturl(), self._status,
+                time.time() - self._started, self._size)
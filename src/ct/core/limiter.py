@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# Copyright 2011 Alf Lervåg. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY ALF LERVÅG ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL ALF LERVÅG OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be interpreted
+# as representing official policies, either expressed or implied, of
+# Alf Lervåg.
+
+"""Pacing of requests to a CurrentTime server.
+
+Every browser talking to the same server shares one AdaptiveLimiter.
+A token bucket caps the request rate and the number of requests in
+flight follows AIMD: it grows by one per window of fast, successful
+requests and is halved when requests turn slow or fail.
+"""
+
+import threading
+import time
+
+__all__ = ["AdaptiveLimiter", "LimiterTimeout", "TokenBucket", "get_limiter",
+           "set_limiter"]
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(server):
+    """The limiter shared by everything talking to ``server``."""
+    with _limiters_lock:
+        if server not in _limiters:
+            _limiters[server] = AdaptiveLimiter()
+        return _limiters[server]
+
+
+def set_limiter(server, limiter):
+    with _limiters_lock:
+        _limiters[server] = limiter
+
+
+class LimiterTimeout(IOError):
+    """No slot came free in time, most likely because one was leaked."""
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self._clock = clock
+        self._updated = clock()
+
+    def take(self):
+        """Take a token and return how long to wait before using it.
+
+        Tokens are handed out in advance, so concurrent callers get
+        increasing waits instead of racing for the next token.
+        """
+        now = self._clock()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class AdaptiveLimiter(object):
+    RATE = 25
+    BURST = 25
+    LIMIT = 4
+    MINIMUM = 1
+    MAXIMUM = 16
+    TARGET_LATENCY = 2.0
+    BACKOFF = 0.5
+    TIMEOUT = 60.0
+
+    def __init__(self, rate=RATE, burst=BURST, limit=LIMIT, minimum=MINIMUM,
+                 maximum=MAXIMUM, target_latency=TARGET_LATENCY,
+                 backoff=BACKOFF, timeout=TIMEOUT, clock=time.time,
+                 sleep=time.sleep):
+        self.bucket = None
+        if rate:
+            self.bucket = TokenBucket(rate, burst, clock)
+        self.limit = float(limit)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.timeout = timeout
+        self.in_flight = 0
+        self.increases = 0
+        self.decreases = 0
+        self.waited = 0.0
+        self._clock = clock
+        self._sleep = sleep
+        self._last_decrease = None
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a slot and a token, return the time the request starts.
+
+        Raises LimiterTimeout if no slot comes free within ``timeout``
+        seconds.
+        """
+        started = self._clock()
+        deadline = None
+        if self.timeout:
+            # Condition.wait() runs on the wall clock, whatever the
+            # clock the latencies are measured with.
+            deadline = time.time() + self.timeout
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                if deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise LimiterTimeout(
+                        "no request slot came free in %g seconds"
+                        % self.timeout)
+                self._condition.wait(remaining)
+            self.in_flight += 1
+            delay = self.bucket and self.bucket.take() or 0
+
+        if delay:
+            self._sleep(delay)
+
+        now = self._clock()
+        with self._condition:
+            self.waited += now - started
+        return now
+
+    def try_acquire(self):
+        """Take a slot and a token without blocking.
+
+        Returns None when every slot is taken.  Otherwise returns how
+        long to wait for the token and the time the request starts,
+        which is what release() wants back.  For event loops, which
+        can't block in acquire().
+        """
+        with self._condition:
+            if self.in_flight >= int(self.limit):
+                return None
+            self.in_flight += 1
+            delay = self.bucket and self.bucket.take() or 0
+            self.waited += delay
+        return delay, self._clock() + delay
+
+    def release(self, started, ok=True):
+        now = self._clock()
+        with self._condition:
+            self.in_flight -= 1
+            if ok and now - started <= self.target_latency:
+                # Additive increase: one more slot per limit successes.
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self.increases += 1
+            elif self._last_decrease is None or \
+                    self._last_decrease <= started:
+                # Multiplicative decrease, once for every burst of slow
+                # requests that were already in flight together.
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                self.decreases += 1
+                self._last_decrease = now
+            self._condition.notify_all()
+
+    def set_maximum(self, maximum):
+        with self._condition:
+            self.maximum = maximum
+            self.limit = min(self.limit, maximum)
+            self._condition.notify_all()
+
+    def metrics(self):
+        with self._condition:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'rate': self.bucket and self.bucket.rate or None,
+                'tokens': self.bucket and self.bucket.tokens or None,
+                'increases': self.increases,
+                'decreases': self.decreases,
+                'waited': self.waited,
+            }
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+# Copyright 2011 Alf Lervåg. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY ALF LERVÅG ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL ALF LERVÅG OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be interpreted
+# as representing official policies, either expressed or implied, of
+# Alf Lervåg.
+
+import calendar
+import collections
+import datetime
+
+__all__ = ["NavigationPlan", "NavigationError", "FetchPlan", "FetchStep",
+           "is_month_view", "check_month_view", "check_range"]
+
+
+class NavigationError(Exception):
+    def __init__(self, target, current):
+        Exception.__init__(self, "Could not navigate to %s, stuck at %s" % (
+            target.strftime("%Y-%m"), current.strftime("%Y-%m")))
+        self.target = target
+        self.current = current
+
+
+def is_month_view(start, end, year=None, month=None):
+    """Whether a page showing ``start`` to ``end`` is a whole month view.
+
+    With ``year`` and ``month`` it must also be that month.
+    """
+    if year is not None and (start.year, start.month) != (year, month):
+        return False
+    return start.day == 1 and end.day >= 28
+
+
+def check_month_view(start, end, year, month):
+    """Raise NavigationError unless the page shows all of year-month."""
+    if not is_month_view(start, end, year, month):
+        raise NavigationError(datetime.date(year, month, 1), start)
+
+
+def check_range(start, end, dates):
+    """Raise NavigationError unless the page shows every one of ``dates``."""
+    for date in dates:
+        if date < start or end < date:
+            raise NavigationError(date, start)
+
+
+class NavigationPlan(object):
+    """The cheapest sequence of calendar hops from one month to another.
+
+    The calendar only offers relative navigation (one year or one month
+    back or forward), so a plan mixes year and month hops to minimize
+    the number of round-trips, e.g. December to the following January is
+    a single month hop rather than a year hop and eleven month hops back.
+    """
+
+    def __init__(self, current, target):
+        self.current = datetime.date(current.year, current.month, 1)
+        self.target = datetime.date(target.year, target.month, 1)
+        self.fallback_steps = 0
+        self._fallback_limit = None
+
+        months = ((self.target.year - self.current.year) * 12
+                  + self.target.month - self.current.month)
+        candidates = [(years, months - years * 12)
+                      for years in (months // 12, months // 12 + 1)]
+        years, months = min(candidates, key=lambda c: abs(c[0]) + abs(c[1]))
+
+        self.steps = []
+        self.steps.extend([years > 0 and 'goto_next_year' or 'goto_prev_year']
+                          * abs(years))
+        self.steps.extend([months > 0 and 'goto_next_month' or 'goto_prev_month']
+                          * abs(months))
+
+    @property
+    def round_trips(self):
+        return len(self.steps) + self.fallback_steps
+
+    def fallback_step(self, current):
+        """The month hop to take from ``current`` after the planned steps.
+
+        Returns None once the calendar is on the target month.  If the
+        calendar did not end up where the plan said, it is stepped a
+        month at a time, at most as many times as it was months away
+        after the plan, before giving up with NavigationError.
+        """
+        months = ((self.target.year - current.year) * 12
+                  + self.target.month - current.month)
+        if not months:
+            return None
+
+        if self._fallback_limit is None:
+            self._fallback_limit = abs(months)
+        if self.fallback_steps >= self._fallback_limit:
+            raise NavigationError(self.target, current)
+
+        self.fallback_steps += 1
+        return months > 0 and 'goto_next_month' or 'goto_prev_month'
+
+    @property
+    def stepping_round_trips(self):
+        """Round-trips needed by stepping years first, then months."""
+        return (abs(self.target.year - self.current.year)
+                + abs(self.target.month - self.current.month))
+
+    @property
+    def saved(self):
+        return self.stepping_round_trips - self.round_trips
+
+    def __repr__(self):
+        return "<NavigationPlan %s -> %s: %s>" % (
+            self.current.strftime("%Y-%m"),
+            self.target.strftime("%Y-%m"),
+            ", ".join(self.steps) or "stay")
+
+
+FetchStep = collections.namedtuple("FetchStep", "view date dates round_trips days")
+
+
+class FetchPlan(object):
+    """The cheapest mix of timesheet views showing a set of dates.
+
+    The timesheet shows a month, a calendar week or a single day of the
+    month the calendar is on, and the page already displayed is free.
+    Each view costs its round-trips, calendar hops included, plus the
+    days it shows, weighted by ``round_trip_cost`` and ``day_cost``.
+    Steps are views of ``view`` ``'displayed'``, ``'month'``, ``'week'``
+    or ``'day'``, identified by ``date`` and used for ``dates``.
+    """
+
+    ROUND_TRIP_COST = 1.0
+    DAY_COST = 0.02
+
+    def __init__(self, dates, current, displayed=None,
+                 round_trip_cost=ROUND_TRIP_COST, day_cost=DAY_COST):
+        self.round_trip_cost = round_trip_cost
+        self.day_cost = day_cost
+        self.steps = []
+
+        needed = sorted(set(dates))
+        if displayed is not None:
+            start, end = displayed
+            shown = [d for d in needed if start <= d and d <= end]
+            if shown:
+                days = (end - start).days + 1
+                self.steps.append(FetchStep('displayed', start, shown, 0, days))
+                needed = [d for d in needed if not (start <= d and d <= end)]
+
+        months = collections.OrderedDict()
+        for date in needed:
+            months.setdefault((date.year, date.month), []).append(date)
+
+        current = datetime.date(current.year, current.month, 1)
+        for (year, month), month_dates in months.items():
+            target = datetime.date(year, month, 1)
+            hops = NavigationPlan(current, target).round_trips
+            self.steps.extend(self._plan_month(target, month_dates, hops))
+            current = target
+
+    @property
+    def round_trips(self):
+        return sum(step.round_trips for step in self.steps)
+
+    @property
+    def days(self):
+        return sum(step.days for step in self.steps)
+
+    @property
+    def cost(self):
+        return self._cost(self.steps)
+
+    def _plan_month(self, first, dates, hops):
+        days = calendar.monthrange(first.year, first.month)[1]
+        month = [FetchStep('month', first, dates, hops + 1, days)]
+
+        # Calendar rows are weeks starting on Monday.
+        weeks = collections.OrderedDict()
+        for date in dates:
+            monday = date - datetime.timedelta(days=date.weekday())
+            weeks.setdefault(monday, []).append(date)
+
+        views = []
+        for monday, week_dates in weeks.items():
+            week = [FetchStep('week', week_dates[0], week_dates, 1, 7)]
+            single = [FetchStep('day', d, [d], 1, 1) for d in week_dates]
+            views.extend(min(week, single, key=self._cost))
+
+        # Getting to the month is paid by the first view.
+        first_view = views[0]
+        views[0] = first_view._replace(round_trips=first_view.round_trips + hops)
+        return min(month, views, key=self._cost)
+
+    def _cost(self, steps):
+        return sum(step.round_trips * self.round_trip_cost
+                   + step.days * self.day_cost for step in steps)
+
+    def __repr__(self):
+        return "<FetchPlan %s: %d round-trips, %d days>" % (
+            ", ".join("%s %s" % (s.view, s.date) for s in self.steps) or "nothing",
+            self.round_trips, self.days)
@@ -30,33 +30,84 @@
 # as representing official policies, either expressed or implied, of
 # Alf Lervåg.
 
-from lxml import html
 import calendar
 import datetime
+import hashlib
 from decimal import Decimal
 
+from ct.core.cache import LRUCache
+from ct.core.instrumentation import timed
 from ct.core.project import Project
 from ct.core.activity import Activity
+from ct.core.xpaths import select
+
+__all__ = ["CurrentTimeParser", "IncrementalParser", "ParsedPage",
+           "ActivityStream"]
+
+
+class ParsedPage(object):
+    """A response parsed once, along with anything derived from it."""
+
+    def __init__(self, response):
+        # lxml is only imported once there is a page to parse.
+        from lxml import html
+        self.response = response
+        self.root = html.fromstring(response)
+        self._memo = {}
+
+    def memoize(self, key, func):
+        if key not in self._memo:
+            self._memo[key] = func(self)
+        return self._memo[key]
+
+
+def accepts_page(meth):
+    def decorate(self, response, *args, **kwargs):
+        return meth(self, self.page(response), *args, **kwargs)
+    return decorate
 
 
 class CurrentTimeParser(object):
-    def _parse_response(self, response):
-        return html.fromstring(response)
+    stats = None
+
+    def __init__(self, cache_size=8):
+        self._pages = LRUCache(cache_size)
+
+    def page(self, response):
+        if isinstance(response, ParsedPage):
+            return response
 
-    def parse_session_id(self, response):
-        root = self._parse_response(response)
+        page = self._pages.get(response)
+        if page is None:
+            page = self._parse_page(response)
+            self._pages.put(response, page)
+        return page
+
+    @timed('html')
+    def _parse_page(self, response):
+        return ParsedPage(response)
+
+    def _parse_response(self, response):
+        return self.page(response).root
 
-        elements = root.cssselect("input[name='sessionid']")
+    @accepts_page
+    @timed('session_id')
+    def parse_session_id(self, page):
+        elements = select('session_id', page.root)
         for el in elements:
             return el.value
 
-    def valid_session(self, response):
-        root = self._parse_response(response)
-        return len(root.cssselect("body[class=login]")) == 0
+    @accepts_page
+    def valid_session(self, page):
+        return len(select('login_body', page.root)) == 0
 
-    def _parse_navigation(self, response):
-        root = self._parse_response(response)
-        script = root.cssselect("table table script")[0].text_content()
+    @accepts_page
+    def _parse_navigation(self, page):
+        return page.memoize('navigation', self._read_navigation)
+
+    @timed('navigation')
+    def _read_navigation(self, page):
+        script = select('navigation_script', page.root)[0].text_content()
         parts = script.split("'")
         date = datetime.datetime.strptime(parts[1], "%Y%m").date()
         calname = parts[3]
@@ -68,10 +119,9 @@ class CurrentTimeParser(object):
     def parse_navigation(self, response):
         return self._parse_navigation(response)['date']
 
-    def get_day_command(self, response, day):
-        root = self._parse_response(response)
-        days = root.cssselect("td[class=date]")
-        for el in days:
+    @accepts_page
+    def get_day_command(self, page, day):
+        for el in select('day_cell', page.root, day=day):
             if int(el.text_content()) == day:
                 url = el[0][0].get("href")
                 _, command = url.split("?")
@@ -84,10 +134,9 @@ class CurrentTimeParser(object):
                 command += "caltimesheet=%s,%s" % (row.strip(), column.strip())
                 return command
 
-    def get_week_command(self, response, week):
-        root = self._parse_response(response)
-        weeks = root.cssselect("td[class=week]")
-        for el in weeks:
+    @accepts_page
+    def get_week_command(self, page, week):
+        for el in select('week_cell', page.root, week=week):
             if int(el.text_content()) == week:
                 url = el[0][0].get("href")
                 _, command = url.split("?")
@@ -96,11 +145,17 @@ class CurrentTimeParser(object):
     def _parse_date(self, s):
         return datetime.datetime.strptime(s,"%d.%m.%Y").date()
 
-    def _get_current_range(self, response):
-        root = self._parse_response(response)
+    @accepts_page
+    def _get_current_range(self, page):
+        return page.memoize('range', self._read_current_range)
+
+    @timed('range')
+    def _read_current_range(self, page):
+        el = select('range', page.root)[0]
+        return self._parse_range(el.text_content())
 
-        el = root.cssselect("td[class=accept]")[0]
-        parts = el.text_content().strip().split(" ")
+    def _parse_range(self, text):
+        parts = text.strip().split(" ")
         if len(parts) > 3:
             start = parts[1]
             end = parts[3]
@@ -108,66 +163,60 @@ class CurrentTimeParser(object):
             start, end = parts[1], parts[1]
         return self._parse_date(start), self._parse_date(end)
 
-    def parse_projects(self, response):
-        root = self._parse_response(response)
+    @accepts_page
+    @timed('projects')
+    def parse_projects(self, page):
+        root = page.root
 
         projects = []
-        for tr in root.xpath("/html/body/table/tr/td[2]/form[2]/table[3]/tr"):
-            if not tr.get("name"):
-                continue
-
+        for tr in select('project_rows', root):
             values = []
-            for el in tr.cssselect("input[type=hidden]"):
+            for el in select('project_values', tr):
                 values = el.value.split(",")
             if not values:
                 continue
 
-            names = [(x.text or '') for x in tr.cssselect("td[class=text]")]
+            names = [(x.text or '') for x in select('project_names', tr)]
             project = Project(names, values)
             projects.append(project)
 
         return projects
 
-    def parse_activities(self, response):
-        activities = []
+    @accepts_page
+    def parse_activities(self, page):
+        return list(page.memoize('activities', self._read_activities))
+
+    def iter_activities(self, chunks):
+        return ActivityStream(self, chunks)
 
-        root = self._parse_response(response)
-        start, end = self._get_current_range(response)
+    @accepts_page
+    def parse_activity_index(self, page):
+        return page.memoize('activity_index', self._index_activities)
 
-        rows = root.cssselect("input[name=activityrow]")[0].value
-        for i in range(1, int(rows) + 1):
-            row = self._parse_row(start, end, root, i)
-            activities.extend(row)
+    @timed('activity_index')
+    def _index_activities(self, page):
+        index = {}
+        for activity in self.parse_activities(page):
+            key = (activity.date, activity.project_id)
+            index.setdefault(key, []).append(activity)
+        return index
+
+    @timed('activities')
+    def _read_activities(self, page):
+        start, end = self._get_current_range(page)
+        dates = list(self._dates(start, end))
+
+        activities = []
+        for value, cells in self._iter_rows(page.root, len(dates)):
+            activities.extend(self._row_activities(value, dates, cells))
         return sorted(activities)
 
-    def _parse_row(self, start, end, root, i):
-        result = []
-
-        projectel = root.cssselect("input[name=activityrow_%s]" % i)[0]
-        project_id = self._parse_project_id(projectel.value)
-        salary_id = self._parse_salary_id(projectel.value)
-
-        row = projectel.getparent().getparent()
-        row_root = root.getroottree().getpath(row)
-        ro_classes = [
-            "@class='datacol'",
-            "@class='lastcol'",
-            "@class='holiday'",
-            "@class='readonly'"
-        ]
-        tds = root.xpath("%s/td[%s]" % (row_root, " or ".join(ro_classes)))
-
-        for n, date in enumerate(self._dates(start, end)):
-            i = n * 2
-            duration_cell = tds[i][0]
-            comment_cell = tds[i+1][0]
-            if duration_cell.tag == "div" and len(duration_cell) > 0:
-                duration, comment = self._parse_div(duration_cell, comment_cell)
-                read_only = False
-            else:
-                duration, comment = self._parse_text(duration_cell, comment_cell)
-                read_only = True
+    def _row_activities(self, value, dates, cells):
+        project_id = self._parse_project_id(value)
+        salary_id = self._parse_salary_id(value)
 
+        activities = []
+        for date, (duration, comment, read_only) in zip(dates, cells):
             activity = Activity(
                 date,
                 project_id,
@@ -175,8 +224,50 @@ class CurrentTimeParser(object):
                 comment,
                 read_only=read_only,
                 salary_id=salary_id)
-            result.append(activity)
-        return result
+            activities.append(activity)
+        return activities
+
+    CELL_CLASSES = frozenset(["datacol", "lastcol", "holiday", "readonly"])
+
+    def _iter_rows(self, root, days):
+        for value, row in self._iter_row_elements(root):
+            yield value, self._parse_cells(row, days)
+
+    def _iter_row_elements(self, root):
+        count, inputs = self._find_rows(root)
+        for i in range(1, count + 1):
+            projectel = inputs[str(i)]
+            yield projectel.value, projectel.getparent().getparent()
+
+    def _parse_cells(self, row, days=None):
+        tds = [td for td in row if td.get("class") in self.CELL_CLASSES]
+        if days is None:
+            days = len(tds) // 2
+
+        cells = []
+        for n in range(days):
+            duration_cell = tds[n * 2][0]
+            comment_cell = tds[n * 2 + 1][0]
+            if duration_cell.tag == "div" and len(duration_cell) > 0:
+                duration, comment = self._parse_div(duration_cell, comment_cell)
+                read_only = False
+            else:
+                duration, comment = self._parse_text(duration_cell, comment_cell)
+                read_only = True
+            cells.append((duration, comment, read_only))
+        return cells
+
+    def _find_rows(self, root):
+        count = None
+        inputs = {}
+        for el in root.iter("input"):
+            name = el.get("name") or ""
+            if name == "activityrow":
+                if count is None:
+                    count = int(el.value)
+            elif name.startswith("activityrow_"):
+                inputs.setdefault(name[len("activityrow_"):], el)
+        return count, inputs
 
     def _parse_div(self, duration_cell, comment_cell):
         hours = self._parse_hours(duration_cell[0].value)
@@ -206,3 +297,185 @@ class CurrentTimeParser(object):
     def _parse_salary_id(self, value):
         parts = value.strip().split(",")[4:]
         return ",".join(parts)
+
+
+class IncrementalParser(CurrentTimeParser):
+    """A parser that remembers the timesheets it has seen.
+
+    A page with the same content as an earlier one gets the earlier
+    activities back without being parsed.  On a changed page only the
+    rows whose markup differs are turned into activities again.  Meant
+    for polling the same months over and over.
+    """
+
+    def __init__(self, cache_size=8, page_cache_size=64, row_cache_size=4096):
+        CurrentTimeParser.__init__(self, cache_size)
+        self._activities = LRUCache(page_cache_size)
+        self._rows = LRUCache(row_cache_size)
+        self.page_hits = 0
+        self.page_misses = 0
+        self.row_hits = 0
+        self.row_misses = 0
+
+    @property
+    def page_hit_rate(self):
+        return _rate(self.page_hits, self.page_misses)
+
+    @property
+    def row_hit_rate(self):
+        return _rate(self.row_hits, self.row_misses)
+
+    def parse_activities(self, response):
+        if isinstance(response, ParsedPage):
+            response = response.response
+        if isinstance(response, unicode):
+            response = response.encode("utf-8")
+
+        key = hashlib.sha1(response).digest()
+        activities = self._activities.get(key)
+        if activities is None:
+            self._count('page_misses')
+            page = self.page(response)
+            activities = page.memoize('activities', self._read_activities)
+            self._activities.put(key, activities)
+        else:
+            self._count('page_hits')
+        return list(activities)
+
+    @timed('activities')
+    def _read_activities(self, page):
+        from lxml import etree
+        start, end = self._get_current_range(page)
+        dates = None
+
+        activities = []
+        for value, row in self._iter_row_elements(page.root):
+            # The cells don't carry their dates, so the same markup
+            # means the same activities only within the same range.
+            key = (start, end, etree.tostring(row, with_tail=False))
+            row_activities = self._rows.get(key)
+            if row_activities is None:
+                self._count('row_misses')
+                if dates is None:
+                    dates = list(self._dates(start, end))
+                cells = self._parse_cells(row, len(dates))
+                row_activities = self._row_activities(value, dates, cells)
+                self._rows.put(key, row_activities)
+            else:
+                self._count('row_hits')
+            activities.extend(row_activities)
+        return sorted(activities)
+
+    def _count(self, name):
+        setattr(self, name, getattr(self, name) + 1)
+        if self.stats is not None:
+            self.stats.incr('parse.%s' % name)
+
+
+def _rate(hits, misses):
+    if hits or misses:
+        return float(hits) / (hits + misses)
+
+
+class ActivityStream(object):
+    """Activities parsed from a timesheet that arrives in chunks.
+
+    Each chunk is fed to lxml as it arrives and activities are yielded
+    one timesheet row at a time, in page order rather than sorted.  Only
+    the row being parsed is kept as a tree, so memory use does not grow
+    with the size of the page.
+    """
+
+    def __init__(self, parser, chunks):
+        self._parser = parser
+        self._chunks = chunks
+        self._dates = None
+        self.range = None
+
+    def __iter__(self):
+        from lxml import etree
+        target = _TimesheetTarget()
+        feed_parser = etree.HTMLParser(target=target)
+        for chunk in self._chunks:
+            feed_parser.feed(chunk)
+            for activity in self._parse_rows(target):
+                yield activity
+
+        feed_parser.close()
+        for activity in self._parse_rows(target):
+            yield activity
+
+    def _parse_rows(self, target):
+        # The displayed range may come after the rows, in which case
+        # they are held back until it has been seen.
+        if self.range is None:
+            if target.range_text is None:
+                return
+            self.range = self._parser._parse_range(target.range_text)
+            self._dates = list(self._parser._dates(*self.range))
+
+        rows, target.rows = target.rows, []
+        for number, value, row in rows:
+            if target.count is not None and number > target.count:
+                continue
+            cells = self._parser._parse_cells(row, len(self._dates))
+            for activity in self._parser._row_activities(value, self._dates, cells):
+                yield activity
+
+
+class _TimesheetTarget(object):
+    """lxml parser target that only builds trees for single table rows."""
+
+    def __init__(self):
+        from lxml import etree, html
+        self._new_builder = lambda: etree.TreeBuilder(parser=html.html_parser)
+        self.count = None
+        self.range_text = None
+        self.rows = []
+        self._builder = None
+        self._row = None
+        self._accept = None
+
+    def start(self, tag, attrib):
+        if tag == "tr":
+            # Only innermost rows are kept, so a row containing a nested
+            # table is dropped when the nested row starts.
+            self._builder = self._new_builder()
+            self._row = None
+        elif tag == "input":
+            name = attrib.get("name") or ""
+            if name == "activityrow" and self.count is None:
+                self.count = int(attrib.get("value"))
+            elif name.startswith("activityrow_") and self._builder is not None:
+                self._row = (int(name[len("activityrow_"):]), attrib.get("value"))
+        elif tag == "td" and attrib.get("class") == "accept":
+            self._accept = []
+
+        if self._builder is not None:
+            self._builder.start(tag, attrib)
+
+    def end(self, tag):
+        if self._builder is not None:
+            self._builder.end(tag)
+
+        if tag == "tr" and self._builder is not None:
+            row = self._builder.close()
+            if self._row is not None:
+                self.rows.append(self._row + (row,))
+            self._builder = None
+            self._row = None
+        elif tag == "td" and self._accept is not None:
+            self.range_text = "".join(self._accept)
+            self._accept = None
+
+    def data(self, data):
+        if self._builder is not None:
+            self._builder.data(data)
+        if self._accept is not None:
+            self._accept.append(data)
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        pass
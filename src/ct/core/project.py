@@ -32,18 +32,29 @@
 
 
 class Project(object):
+    __slots__ = ("_names", "_ids", "_name", "_id")
+
     def __init__(self, names, values):
-        # Use an internal dict so we're immutable
-        self._dict = {
-            "project": names[0],
-            "task": names[1],
-            "subtask": names[2],
-            "activity": names[3],
-            "projectid": int(values[0]),
-            "taskid": int(values[1]),
-            "subtaskid": int(values[2]),
-            "activityid": int(values[3])
-            }
+        # Everything is computed up front and never changed, so we're
+        # immutable
+        init = super(Project, self).__setattr__
+        init("_names", tuple(names[:4]))
+        init("_ids", tuple(int(v) for v in values[:4]))
+
+        parts = list(self._names[:3])
+        if self._names[3]:
+            parts.append(self._names[3])
+        init("_name", " - ".join(parts))
+        init("_id", "%s,%s,%s,%s" % self._ids)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Project objects are immutable")
+
+    def __getstate__(self):
+        return (self._names, self._ids)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
 
     def __str__(self):
         return self.id
@@ -53,34 +64,28 @@ class Project(object):
 
     @property
     def name(self):
-        parts = [
-            "%(project)s",
-            "%(task)s",
-            "%(subtask)s"
-        ]
-
-        if self._dict.get("activity"):
-            parts.append("%(activity)s")
-
-        return " - ".join(parts) % self._dict
+        return self._name
 
     @property
     def id(self):
-        s = "%(projectid)s,%(taskid)s,%(subtaskid)s,%(activityid)s"
-        return s % self._dict
+        return self._id
+
+    @property
+    def ids(self):
+        return self._ids
 
     @property
     def project_name(self):
-        return self._dict.get("project")
+        return self._names[0]
 
     @property
     def task_name(self):
-        return self._dict.get("task")
+        return self._names[1]
 
     @property
     def subtask_name(self):
-        return self._dict.get("subtask")
+        return self._names[2]
 
     @property
     def activity_name(self):
-        return self._dict.get("activity")
+        return self._names[3]
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+# Copyright 2011 Alf Lervåg. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY ALF LERVÅG ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL ALF LERVÅG OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be interpreted
+# as representing official policies, either expressed or implied, of
+# Alf Lervåg.
+
+"""A local SQLite copy of CurrentTime activities and projects.
+
+Replica stores activities per user and month.  ReplicaSync keeps it up
+to date through a RangeAPI, fetching only the months that may have
+changed, and writes reported activities through to both.
+"""
+
+import datetime
+import sqlite3
+import time
+from decimal import Decimal
+
+from activity import Activity
+from project import Project
+
+__all__ = ["Replica", "ReplicaSync"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS activities (
+    user TEXT NOT NULL,
+    date TEXT NOT NULL,
+    project_id TEXT NOT NULL,
+    salary_id TEXT NOT NULL,
+    centihours INTEGER NOT NULL,
+    comment TEXT NOT NULL,
+    read_only INTEGER NOT NULL,
+    PRIMARY KEY (user, date, project_id, salary_id)
+);
+CREATE TABLE IF NOT EXISTS months (
+    user TEXT NOT NULL,
+    month TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    read_only INTEGER NOT NULL,
+    PRIMARY KEY (user, month)
+);
+CREATE TABLE IF NOT EXISTS projects (
+    user TEXT NOT NULL,
+    id TEXT NOT NULL,
+    names TEXT NOT NULL,
+    PRIMARY KEY (user, id)
+);
+"""
+
+GROUPS = {
+    'project_id': "project_id",
+    'salary_id': "salary_id",
+    'date': "date",
+    'month': "substr(date, 1, 7)",
+    'user': "user",
+}
+
+
+class Replica(object):
+    def __init__(self, path=":memory:"):
+        self._db = sqlite3.connect(path)
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def store_month(self, user, year, month, activities, synced_at=None):
+        """Replace everything stored for a month with ``activities``."""
+        if synced_at is None:
+            synced_at = time.time()
+
+        first = datetime.date(year, month, 1)
+        key = _month_key(first)
+        read_only = bool(activities) and all(a.is_read_only for a in activities)
+        with self._db:
+            self._db.execute(
+                "DELETE FROM activities WHERE user = ? AND date LIKE ?",
+                (user, key + "-%"))
+            self._db.executemany(
+                "INSERT OR REPLACE INTO activities VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [_row(user, a) for a in activities
+                 if (a.date.year, a.date.month) == (year, month)])
+            self._db.execute(
+                "INSERT OR REPLACE INTO months VALUES (?, ?, ?, ?)",
+                (user, key, synced_at, read_only))
+
+    def store_activity(self, user, activity):
+        """Store a reported activity and mark its month for a refetch.
+
+        A report may leave out the salary id the server fills in, so the
+        activity replaces whatever is stored for its date and project.
+        """
+        with self._db:
+            self._db.execute(
+                "DELETE FROM activities "
+                "WHERE user = ? AND date = ? AND project_id = ?",
+                (user, activity.date.isoformat(), activity.project_id))
+            self._db.execute(
+                "INSERT OR REPLACE INTO activities VALUES (?, ?, ?, ?, ?, ?, ?)",
+                _row(user, activity))
+            self._db.execute(
+                "DELETE FROM months WHERE user = ? AND month = ?",
+                (user, _month_key(activity.date)))
+
+    def store_projects(self, user, projects):
+        with self._db:
+            self._db.execute("DELETE FROM projects WHERE user = ?", (user,))
+            self._db.executemany(
+                "INSERT INTO projects VALUES (?, ?, ?)",
+                [(user, p.id, u"\t".join([p.project_name, p.task_name,
+                                          p.subtask_name, p.activity_name]))
+                 for p in projects])
+
+    def get_month_state(self, user, year, month):
+        """Return ``(synced_at, read_only)`` for a stored month, or None."""
+        key = _month_key(datetime.date(year, month, 1))
+        row = self._db.execute(
+            "SELECT synced_at, read_only FROM months WHERE user = ? AND month = ?",
+            (user, key)).fetchone()
+        if row is not None:
+            return row[0], bool(row[1])
+
+    def get_activities(self, user, from_date, to_date):
+        rows = self._db.execute(
+            "SELECT date, project_id, salary_id, centihours, comment, read_only "
+            "FROM activities WHERE user = ? AND date BETWEEN ? AND ? "
+            "ORDER BY date, project_id",
+            (user, from_date.isoformat(), to_date.isoformat()))
+        return [_activity(row) for row in rows]
+
+    def get_projects(self, user):
+        rows = self._db.execute(
+            "SELECT id, names FROM projects WHERE user = ? ORDER BY id", (user,))
+        return [Project(names.split(u"\t"), id.split(",")) for id, names in rows]
+
+    def get_totals(self, from_date, to_date, group_by='project_id', users=None):
+        """Sum the hours between two dates, grouped by ``group_by``.
+
+        ``group_by`` is one of ``project_id``, ``salary_id``, ``date``,
+        ``month`` (as ``"YYYY-MM"``) and ``user``.  Returns a dict
+        mapping each group to its total as a Decimal.
+        """
+        expression = GROUPS[group_by]
+        query = ("SELECT %s, SUM(centihours) FROM activities "
+                 "WHERE date BETWEEN ? AND ?" % expression)
+        params = [from_date.isoformat(), to_date.isoformat()]
+        if users is not None:
+            users = list(users)
+            query += " AND user IN (%s)" % ", ".join("?" * len(users))
+            params.extend(users)
+        query += " GROUP BY %s" % expression
+
+        totals = {}
+        for key, centihours in self._db.execute(query, params):
+            if group_by == 'date':
+                key = _parse_date(key)
+            totals[key] = Decimal(centihours) / 100
+        return totals
+
+
+class ReplicaSync(object):
+    """Keeps a Replica up to date for one user of a RangeAPI.
+
+    Months that have never been synced are always fetched.  Months where
+    every activity is read only have been approved and are never fetched
+    again.  The ``recent_months`` before today are fetched when they are
+    older than ``recent_age`` seconds and any other month when it is
+    older than ``max_age`` seconds.
+    """
+
+    def __init__(self, api, replica, user, recent_months=2, recent_age=0,
+                 max_age=24 * 3600, clock=time.time, today=None):
+        self.api = api
+        self.replica = replica
+        self.user = user
+        self.recent_months = recent_months
+        self.recent_age = recent_age
+        self.max_age = max_age
+        self._clock = clock
+        self._today = today
+
+    @property
+    def today(self):
+        return self._today or datetime.date.today()
+
+    def sync(self, from_date, to_date, force=False):
+        """Fetch the stale months between two dates, return which they were."""
+        now = self._clock()
+        stale = [m for m in _months(from_date, to_date)
+                 if force or self._is_stale(m, now)]
+
+        # Neighbouring months are fetched together, so that the API
+        # can navigate and parallelise as it sees fit.
+        for run in _runs(stale):
+            first = datetime.date(run[0][0], run[0][1], 1)
+            last = _last_day(*run[-1])
+            by_month = dict((m, []) for m in run)
+            for activity in self.api.get_activities(first, last):
+                by_month[activity.date.year, activity.date.month].append(activity)
+            for (year, month), activities in sorted(by_month.items()):
+                self.replica.store_month(self.user, year, month, activities, now)
+
+        return stale
+
+    def sync_projects(self):
+        projects = self.api.get_projects()
+        self.replica.store_projects(self.user, projects)
+        return projects
+
+    def get_activities(self, from_date, to_date):
+        self.sync(from_date, to_date)
+        return self.replica.get_activities(self.user, from_date, to_date)
+
+    def report_activity(self, activity, previous=None):
+        response = self.api.report_activity(activity, previous)
+        self._write_through([activity])
+        return response
+
+    def report_activities(self, activities, previous=None):
+        results = self.api.report_activities(activities, previous)
+        self._write_through([r.activity for r in results if r.saved])
+        return results
+
+    def _write_through(self, activities):
+        # The response to a save shows the whole month when it was
+        # displayed, which also picks up changes made elsewhere.
+        displayed = self.api.get_displayed_month()
+        if displayed is not None:
+            (year, month), month_activities = displayed
+            self.replica.store_month(self.user, year, month, month_activities)
+
+        for activity in activities:
+            if displayed is None or \
+                    (activity.date.year, activity.date.month) != displayed[0]:
+                self.replica.store_activity(self.user, activity)
+
+    def _is_stale(self, month, now):
+        state = self.replica.get_month_state(self.user, *month)
+        if state is None:
+            return True
+
+        synced_at, read_only = state
+        if read_only:
+            return False
+
+        today = self.today
+        age = (today.year * 12 + today.month) - (month[0] * 12 + month[1])
+        if age < self.recent_months:
+            return now - synced_at >= self.recent_age
+        return now - synced_at >= self.max_age
+
+
+def _row(user, activity):
+    return (user, activity.date.isoformat(), activity.project_id,
+            activity.salary_id, activity.centihours, activity.comment,
+            activity.is_read_only)
+
+
+def _activity(row):
+    date, project_id, salary_id, centihours, comment, read_only = row
+    activity = Activity.__new__(Activity)
+    activity.__setstate__((_parse_date(date), project_id, salary_id,
+                           centihours, comment, bool(read_only)))
+    return activity
+
+
+def _parse_date(value):
+    return datetime.date(int(value[:4]), int(value[5:7]), int(value[8:10]))
+
+
+def _month_key(date):
+    return "%04d-%02d" % (date.year, date.month)
+
+
+def _months(from_date, to_date):
+    year, month = from_date.year, from_date.month
+    while (year, month) <= (to_date.year, to_date.month):
+        yield year, month
+        month += 1
+        if month > 12:
+            year, month = year + 1, 1
+
+
+def _runs(months):
+    runs = []
+    for year, month in months:
+        if runs:
+            last_year, last_month = runs[-1][-1]
+            if last_year * 12 + last_month + 1 == year * 12 + month:
+                runs[-1].append((year, month))
+                continue
+        runs.append([(year, month)])
+    return runs
+
+
+def _last_day(year, month):
+    if month == 12:
+        return datetime.date(year, 12, 31)
+    return datetime.date(year, month + 1, 1) - datetime.timedelta(days=1)
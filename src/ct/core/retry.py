@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Copyright 2011 Alf Lervåg. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY ALF LERVÅG ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL ALF LERVÅG OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be interpreted
+# as representing official policies, either expressed or implied, of
+# Alf Lervåg.
+
+"""Retries and hedging for requests that are safe to send again."""
+
+import Queue
+import collections
+import httplib
+import random
+import threading
+import time
+import urllib2
+
+__all__ = ["RetryPolicy"]
+
+
+class RetryPolicy(object):
+    """Time out, retry and optionally hedge a request.
+
+    Only requests that leave the server in the same state however many
+    times they are sent may be passed to call().  Hedging sends a second
+    copy of a request that is slower than most recent ones and uses
+    whichever answer comes first, so it is only for requests whose
+    answer doesn't depend on how many copies arrive.
+    """
+
+    ATTEMPTS = 3
+    BACKOFF = 0.1
+    JITTER = 0.5
+    QUANTILE = 0.95
+    WINDOW = 100
+    MIN_SAMPLES = 20
+
+    def __init__(self, attempts=ATTEMPTS, timeout=None, backoff=BACKOFF,
+                 jitter=JITTER, hedge=False, quantile=QUANTILE,
+                 window=WINDOW, min_samples=MIN_SAMPLES,
+                 sleep=time.sleep, random=random.random):
+        self.attempts = attempts
+        self.timeout = timeout
+        self.backoff = backoff
+        self.jitter = jitter
+        self.hedge = hedge
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self._sleep = sleep
+        self._random = random
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    @property
+    def hedge_after(self):
+        """Seconds to wait before hedging, or None while too little is known."""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1,
+                             int(len(latencies) * self.quantile))]
+
+    def delay(self, attempt):
+        """Time to wait before retry number ``attempt``, counting from 1."""
+        base = self.backoff * 2 ** (attempt - 1)
+        return base * (1 + self.jitter * self._random())
+
+    def call(self, fetch, hedge=False, stats=None):
+        """Return ``fetch(timeout)``, retrying failures that may pass.
+
+        ``hedge`` allows a second copy of the request when hedging is
+        turned on for the policy.
+        """
+        for attempt in range(1, self.attempts + 1):
+            try:
+                if hedge and self.hedge:
+                    return self._hedged(fetch, stats)
+                return self._timed(fetch)
+            except Exception, e:
+                if attempt == self.attempts or not self.retryable(e):
+                    raise
+            if stats is not None:
+                stats.incr('retry.attempts')
+            self._sleep(self.delay(attempt))
+
+    def retryable(self, error):
+        if isinstance(error, urllib2.HTTPError):
+            return error.code >= 500
+        return isinstance(error, (EnvironmentError, httplib.HTTPException))
+
+    def _timed(self, fetch):
+        started = time.time()
+        result = fetch(self.timeout)
+        with self._lock:
+            self._latencies.append(time.time() - started)
+        return result
+
+    def _hedged(self, fetch, stats):
+        hedge_after = self.hedge_after
+        if hedge_after is None:
+            return self._timed(fetch)
+
+        results = Queue.Queue()
+
+        def send(copy):
+            try:
+                results.put((copy, self._timed(fetch), None))
+            except Exception, e:
+                results.put((copy, None, e))
+
+        def start(copy):
+            thread = threading.Thread(target=send, args=(copy,))
+            thread.daemon = True
+            thread.start()
+
+        start(0)
+        try:
+            copy, result, error = results.get(timeout=hedge_after)
+            sent = 1
+        except Queue.Empty:
+            if stats is not None:
+                stats.incr('retry.hedged')
+            start(1)
+            copy, result, error = results.get()
+            sent = 2
+
+        if error is not None and sent == 2:
+            # The other copy may still succeed.
+            copy, result, error = results.get()
+        if error is not None:
+            raise error
+        if copy == 1 and stats is not None:
+            stats.incr('retry.hedge_wins')
+        return result
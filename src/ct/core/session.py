@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+# Copyright 2011 Alf Lervåg. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY ALF LERVÅG ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL ALF LERVÅG OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be interpreted
+# as representing official policies, either expressed or implied, of
+# Alf Lervåg.
+
+import Queue
+import collections
+import cookielib
+import hashlib
+import json
+import os
+import threading
+import time
+
+from apis import BaseAPI
+from limiter import get_limiter
+
+__all__ = ["SessionStore", "SessionPool", "FetchResult", "LoginFailed",
+           "set_server_limit"]
+
+FetchResult = collections.namedtuple("FetchResult", "user month activities error")
+
+COOKIE_FIELDS = ("version", "name", "value", "port", "port_specified",
+                 "domain", "domain_specified", "domain_initial_dot", "path",
+                 "path_specified", "secure", "expires", "discard", "comment",
+                 "comment_url")
+
+
+def set_server_limit(server, limit):
+    """Never have more than ``limit`` requests in flight to ``server``."""
+    get_limiter(server).set_maximum(limit)
+
+
+class LoginFailed(Exception):
+    def __init__(self, user):
+        Exception.__init__(self, "Could not log in as %s" % user)
+        self.user = user
+
+
+class SessionStore(object):
+    """Authenticated browser sessions saved per server and user.
+
+    Each session is kept in its own file below ``directory``, so that
+    processes sharing the store only ever replace whole sessions.  A
+    session is dropped once a cookie has expired or it has been idle for
+    longer than ``max_age`` seconds.
+    """
+
+    # The session timeout IIS uses for ASP unless it is configured.
+    MAX_AGE = 20 * 60
+
+    def __init__(self, directory, max_age=MAX_AGE, clock=time.time):
+        self.directory = directory
+        self.max_age = max_age
+        self._clock = clock
+
+    def load(self, server, username):
+        path = self._path(server, username)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except IOError:
+            return None
+
+        # Anything that isn't a session as save() writes it is treated
+        # as no session at all, and removed so it's written afresh.
+        try:
+            entry = json.loads(data)
+            state = _load_state(entry['state'])
+            used_at = float(entry['used_at'])
+            expires = entry['expires']
+            if expires is not None:
+                expires = float(expires)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.discard(server, username)
+            return None
+
+        now = self._clock()
+        if now - used_at > self.max_age or (expires and now >= expires):
+            self.discard(server, username)
+            return None
+
+        return state
+
+    def save(self, server, username, state):
+        entry = {
+            'state': _dump_state(state),
+            'used_at': self._clock(),
+            'expires': _cookie_expiry(state),
+        }
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, 0700)
+
+        # The cookies are as good as a password, so only the owner may
+        # read them.  Renaming keeps other processes from seeing a
+        # partially written session.
+        path = self._path(server, username)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, "wb") as f:
+            json.dump(entry, f)
+        os.rename(tmp, path)
+
+    def discard(self, server, username):
+        try:
+            os.remove(self._path(server, username))
+        except OSError:
+            pass
+
+    def _path(self, server, username):
+        key = hashlib.sha1("%s\0%s" % (server, username)).hexdigest()
+        return os.path.join(self.directory, key + ".session")
+
+
+def _dump_state(state):
+    """The browser state with its cookies as plain dicts, for JSON."""
+    state = dict(state)
+    cookies = []
+    for paths in state.get('cookies', {}).values():
+        for named in paths.values():
+            for cookie in named.values():
+                fields = dict((name, getattr(cookie, name))
+                              for name in COOKIE_FIELDS)
+                fields['rest'] = cookie._rest
+                fields['rfc2109'] = cookie.rfc2109
+                cookies.append(fields)
+    state['cookies'] = cookies
+    return state
+
+
+def _load_state(data):
+    """Turn what _dump_state() wrote back into a browser state."""
+    if not isinstance(data, dict):
+        raise TypeError("session state is not a dict")
+
+    state = dict((str(key), _text(value)) for key, value in data.items())
+    cookies = {}
+    for fields in state.get('cookies', []):
+        cookie = cookielib.Cookie(
+            rest=dict((str(key), _text(value))
+                      for key, value in fields['rest'].items()),
+            rfc2109=fields['rfc2109'],
+            **dict((name, _text(fields[name])) for name in COOKIE_FIELDS))
+        paths = cookies.setdefault(cookie.domain, {})
+        paths.setdefault(cookie.path, {})[cookie.name] = cookie
+    state['cookies'] = cookies
+    return state
+
+
+def _text(value):
+    # JSON gives back unicode, but headers are built from byte strings.
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+def _cookie_expiry(state):
+    expiry = None
+    for paths in state.get('cookies', {}).values():
+        for cookies in paths.values():
+            for cookie in cookies.values():
+                if cookie.expires is not None:
+                    if expiry is None or cookie.expires < expiry:
+                        expiry = cookie.expires
+    return expiry
+
+
+class SessionPool(object):
+    """Logged in sessions for many users of one server.
+
+    Sessions are created and logged in when a user is first needed and
+    kept for later jobs, through ``store`` when one is given.
+    ``passwords`` maps users to passwords, or is called with the user.
+    A session is only ever used by one worker at a time, since the
+    server keeps the displayed month per session.
+    """
+
+    def __init__(self, server, passwords, workers=8, store=None):
+        self.server = server
+        self.workers = workers
+        self.store = store
+        self.logins = 0
+        self._passwords = passwords
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+        for api in sessions.values():
+            api.close()
+
+    def get_api(self, user):
+        """Return a logged in BaseAPI for ``user``."""
+        with self._lock:
+            api = self._sessions.get(user)
+            if api is None:
+                api = self._sessions[user] = BaseAPI(self.server)
+
+        if not api.valid_session():
+            self._login(api, user)
+        return api
+
+    def fetch(self, tasks):
+        """Fetch ``(user, year, month)`` tasks, yielding FetchResults.
+
+        Results come in the order they complete.  Each user's months are
+        fetched in order by one worker, so that navigating between them
+        is cheap.  Work stops once the caller stops iterating.
+        """
+        months = collections.OrderedDict()
+        for user, year, month in tasks:
+            months.setdefault(user, []).append((year, month))
+        total = sum(len(m) for m in months.values())
+
+        pending = Queue.Queue()
+        for item in months.items():
+            pending.put(item)
+        results = Queue.Queue()
+        stopped = threading.Event()
+
+        def work():
+            while not stopped.is_set():
+                try:
+                    user, user_months = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                self._fetch_user(user, sorted(user_months), results, stopped)
+
+        threads = [threading.Thread(target=work)
+                   for _ in range(min(self.workers, len(months)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for _ in range(total):
+                yield results.get()
+        finally:
+            stopped.set()
+
+    def _fetch_user(self, user, months, results, stopped):
+        try:
+            api = self.get_api(user)
+        except Exception, e:
+            for month in months:
+                results.put(FetchResult(user, month, None, e))
+            return
+
+        for month in months:
+            if stopped.is_set():
+                return
+            try:
+                activities = api.get_month(*month)
+            except Exception, e:
+                results.put(FetchResult(user, month, None, e))
+            else:
+                results.put(FetchResult(user, month, activities, None))
+
+    def _login(self, api, user):
+        password = self._passwords
+        if callable(password):
+            password = password(user)
+        else:
+            password = password[user]
+
+        if self.store is not None:
+            logged_in = api.resume(user, password, self.store)
+        else:
+            logged_in = api.login(user, password)
+        if not logged_in:
+            raise LoginFailed(user)
+
+        with self._lock:
+            self.logins += 1
@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -*-
+# Copyright 2011 Alf Lervåg. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY ALF LERVÅG ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL ALF LERVÅG OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be interpreted
+# as representing official policies, either expressed or implied, of
+# Alf Lervåg.
+
+"""Builders for CurrentTime pages, used by the tests and benchmarks."""
+
+import BaseHTTPServer
+import SocketServer
+import calendar
+import datetime
+import cgi
+import socket
+import sys
+import threading
+import time
+import urlparse
+import zlib
+
+__all__ = ["timesheet_page", "login_page", "projects_page", "project_value",
+           "FakeCurrentTime"]
+
+
+def project_value(project_id, salary_id="1"):
+    ids = project_id.split(",")
+    names = ["projectid", "taskid", "subtaskid", "activityid"]
+    parts = ["%s=%s" % pair for pair in zip(names, ids)]
+    if salary_id:
+        parts.append(salary_id)
+    return ",".join(parts)
+
+
+def login_page():
+    return ('<html><body class="login"><form method="post">'
+            '<input name="ctusername"><input name="ctpassword" type="password">'
+            '</form></body></html>')
+
+
+def projects_page(projects):
+    """Render the project search result for ``(names, ids)`` pairs."""
+    parts = ['<html><body><table><tr><td>&nbsp;</td><td>'
+             '<form name="menu"></form><form name="search">'
+             '<table></table><table></table><table>']
+    for i, (names, ids) in enumerate(projects):
+        parts.append('<tr name="row%d"><td>' % i)
+        parts.append('<input type="hidden" name="project" value="%s">'
+                     % ",".join(str(x) for x in ids))
+        parts.append('</td>')
+        for name in names:
+            parts.append('<td class="text">%s</td>' % cgi.escape(name))
+        parts.append('</tr>')
+    parts.append('</table></form></td></tr></table></body></html>')
+    return "".join(parts)
+
+
+def timesheet_page(start, end, rows=(), session_id="1234", month=None,
+                   read_only=()):
+    """Render a timesheet showing ``start`` to ``end``.
+
+    ``rows`` is a list of ``(project_value, cells)`` where ``cells`` maps
+    dates to ``(hours, comment)``.  Dates in ``read_only`` are rendered
+    as plain text instead of input fields.
+    """
+    if month is None:
+        month = (start.year, start.month)
+
+    parts = ['<html><body><table><tr><td>']
+    parts.append(_calendar(month[0], month[1]))
+    parts.append('</td><td><form method="post" action="default.asp">')
+    parts.append('<input type="hidden" name="sessionid" value="%s">' % session_id)
+    parts.append('<input type="hidden" name="activityrow" value="%d">' % len(rows))
+    parts.append('<table><tr><td class="accept">')
+    if start == end:
+        parts.append(' Godkjenn %s ' % start.strftime("%d.%m.%Y"))
+    else:
+        parts.append(' Godkjenn %s - %s ' % (
+            start.strftime("%d.%m.%Y"), end.strftime("%d.%m.%Y")))
+    parts.append('</td></tr></table><table class="timesheet">')
+
+    dates = []
+    current = start
+    while current <= end:
+        dates.append(current)
+        current += datetime.timedelta(days=1)
+
+    for i, (value, cells) in enumerate(rows):
+        parts.append('<tr><td class="project">')
+        parts.append('<input type="hidden" name="activityrow_%d" value="%s">'
+                     % (i + 1, cgi.escape(value, True)))
+        parts.append('</td>')
+        for n, date in enumerate(dates):
+            hours, comment = cells.get(date, ("", ""))
+            if date in read_only:
+                parts.append('<td class="readonly"><span>%s&nbsp;</span></td>' % hours)
+                parts.append('<td class="readonly"><span>%s&nbsp;</span></td>'
+                             % cgi.escape(comment))
+                continue
+
+            if date.weekday() >= 5:
+                css = "holiday"
+            elif n == len(dates) - 1:
+                css = "lastcol"
+            else:
+                css = "datacol"
+            parts.append('<td class="%s"><div><input name="cell_%d_%d_duration" '
+                         'value="%s"></div></td>' % (css, i + 1, date.day, hours))
+            parts.append('<td class="%s"><div><input name="cell_%d_%d_note" '
+                         'value="%s"></div></td>'
+                         % (css, i + 1, date.day, cgi.escape(comment, True)))
+        parts.append('<td class="sum">&nbsp;</td></tr>')
+
+    parts.append('</table></form></td></tr></table></body></html>')
+    return "".join(parts)
+
+
+def _calendar(year, month):
+    parts = ['<table class="calendar"><tr><td>']
+    parts.append("<script>initCalendar('%04d%02d','caltimesheet');</script>"
+                 % (year, month))
+    parts.append('</td></tr>')
+    weeks = calendar.Calendar().monthdatescalendar(year, month)
+    for row, week in enumerate(weeks):
+        number = week[0].isocalendar()[1]
+        parts.append('<tr><td class="week"><div><a href="default.asp?'
+                     'caltimesheet=%d,0">%d</a></div></td>' % (row + 2, number))
+        for column, date in enumerate(week):
+            if date.month != month:
+                parts.append('<td class="other">&nbsp;</td>')
+                continue
+            parts.append('<td class="date"><div><a href="default.asp?" '
+                         'onclick="calClick(\'caltimesheet\', this, %d, %d)">'
+                         '%d</a></div></td>' % (row + 2, column + 1, date.day))
+        parts.append('</tr>')
+    parts.append('</table>')
+    return "".join(parts)
+
+
+class FakeCurrentTime(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A local stand-in for a CurrentTime server.
+
+    Serves ``login.asp``, ``Timesheet/default.asp`` and
+    ``Timesheet/projects.asp`` on a free port.  Every login gets its own
+    session with its own calendar, while the timesheet is shared like it
+    is for one user on the real server.  ``rows`` is the number of
+    projects on the timesheet and ``latency`` is added to every request.
+    Pages are compressed with the first of ``encodings`` the client
+    accepts.  Days before ``approved_before`` are shown read only.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, rows=1, latency=0.0, today=None, users=None,
+                 encodings=(), approved_before=None):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ("127.0.0.1", 0), _FakeCurrentTimeHandler)
+        self.url = "http://127.0.0.1:%d" % self.server_address[1]
+        self.latency = latency
+        self.today = today or datetime.date.today()
+        self.users = users
+        self.encodings = encodings
+        self.approved_before = approved_before
+        self.projects = ["%d,1,0,0" % (i + 1) for i in range(rows)]
+        self.cells = {}
+        self.sessions = {}
+        self.faults = []
+        self._lock = threading.Lock()
+        self._connections = set()
+        self._threads = set()
+        self.reset_stats()
+
+    def start(self):
+        thread = threading.Thread(
+            target=self.serve_forever, kwargs={"poll_interval": 0.05})
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+        # Hang up on kept alive connections, so that their threads are
+        # gone before the caller moves on or the interpreter exits.
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        deadline = time.time() + self.STOP_TIMEOUT
+        with self._lock:
+            threads = list(self._threads)
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+
+    # How long stop() waits for requests still being answered, such as
+    # ones held up by a fault.
+    STOP_TIMEOUT = 2.0
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self._process_request_thread,
+                                  args=(request, client_address))
+        thread.daemon = True
+        with self._lock:
+            self._threads.add(thread)
+        thread.start()
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.process_request_thread(request, client_address)
+        finally:
+            with self._lock:
+                self._threads.discard(threading.current_thread())
+
+    def handle_error(self, request, client_address, exc_info=sys.exc_info,
+                     socket_error=socket.error):
+        # Clients closing kept alive connections is not an error here.
+        # The defaults keep this working in a thread that outlives
+        # stop(), when the module globals are gone at interpreter exit.
+        if not isinstance(exc_info()[1], socket_error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def reset_stats(self):
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "max_in_flight": self.max_in_flight,
+        }
+
+    def get_cell(self, project_id, date):
+        """Return the saved ``(hours, comment)`` for a cell."""
+        if (project_id, date) in self.cells:
+            return self.cells[project_id, date]
+
+        # Every weekday has a full day on one of the projects.
+        index = date.toordinal() % len(self.projects)
+        if date.weekday() < 5 and self.projects[index] == project_id:
+            return ("7,5", "")
+        return ("", "")
+
+    def add_fault(self, status=None, delay=0.0, body_delay=0.0,
+                  body_bytes=10):
+        """Answer the next request with ``status`` or ``delay`` seconds late.
+
+        With ``body_delay`` the response stalls for that long after the
+        first ``body_bytes`` bytes of its body instead.  Faults are used
+        up in the order they are added.  A request that gets a status is
+        not carried out.
+        """
+        with self._lock:
+            self.faults.append((status, delay, body_delay, body_bytes))
+
+    def _next_fault(self):
+        with self._lock:
+            if self.faults:
+                return self.faults.pop(0)
+        return None, 0.0, 0.0, 0
+
+    def _begin(self):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def _end(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _count(self, received, sent):
+        with self._lock:
+            self.requests += 1
+            self.bytes_received += received
+            self.bytes_sent += sent
+
+    def _login(self, form):
+        username = form.get("ctusername", [""])[0]
+        password = form.get("ctpassword", [""])[0]
+        if self.users is not None and self.users.get(username) != password:
+            return None
+
+        with self._lock:
+            session_id = str(len(self.sessions) + 1)
+            self.sessions[session_id] = _FakeSession(self, session_id)
+        return session_id
+
+
+class _FakeSession(object):
+    """The calendar and view of one logged in user."""
+
+    def __init__(self, server, session_id):
+        self.server = server
+        self.session_id = session_id
+        self.month = server.today.replace(day=1)
+        self.dates = self._month_dates()
+
+    def command(self, query):
+        value = urlparse.parse_qs(query).get("caltimesheet", [None])[0]
+        if value is None:
+            return self.render()
+
+        row, column = [int(x) for x in value.split(",")]
+        if row == 1:
+            months = {1: -12, 4: 12, 5: -1, 8: 1}.get(column, 0)
+            months += self.month.year * 12 + self.month.month - 1
+            self.month = datetime.date(months // 12, months % 12 + 1, 1)
+            self.dates = self._month_dates()
+        else:
+            weeks = calendar.Calendar().monthdatescalendar(
+                self.month.year, self.month.month)
+            week = weeks[row - 2]
+            if column == 0:
+                self.dates = week
+            else:
+                self.dates = [week[column - 1]]
+        return self.render()
+
+    def save(self, form):
+        if form.get("sessionid", [None])[0] != self.session_id:
+            return self.render()
+
+        rows = {}
+        for name, values in form.items():
+            if name.startswith("activityrow_"):
+                ids = [part.split("=")[-1] for part in values[0].split(",")]
+                rows[name[len("activityrow_"):]] = ",".join(ids[:4])
+
+        by_day = dict((date.day, date) for date in self.dates)
+        with self.server._lock:
+            for name, values in form.items():
+                if not (name.startswith("cell_") and name.endswith("_duration")):
+                    continue
+                _, row, day, _ = name.split("_")
+                note = form.get("cell_%s_%s_note" % (row, day), [""])[0]
+                project_id = rows[row]
+                if project_id not in self.server.projects:
+                    self.server.projects.append(project_id)
+                date = by_day[int(day)]
+                self.server.cells[project_id, date] = (values[0], note)
+        return self.render()
+
+    def render(self):
+        rows = []
+        for project_id in self.server.projects:
+            cells = dict((date, self.server.get_cell(project_id, date))
+                         for date in self.dates)
+            rows.append((project_value(project_id), cells))
+        approved = self.server.approved_before
+        read_only = [date for date in self.dates if approved and date < approved]
+        return timesheet_page(self.dates[0], self.dates[-1], rows,
+                              session_id=self.session_id,
+                              month=(self.month.year, self.month.month),
+                              read_only=read_only)
+
+    def _month_dates(self):
+        days = calendar.monthrange(self.month.year, self.month.month)[1]
+        return [self.month.replace(day=day) for day in range(1, days + 1)]
+
+
+class _FakeCurrentTimeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Send each response in one go instead of a write per header, which
+    # would otherwise wait on delayed acknowledgements.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server._lock:
+            self.server._connections.add(self.connection)
+
+    def finish(self):
+        try:
+            BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        finally:
+            with self.server._lock:
+                self.server._connections.discard(self.connection)
+
+    def do_GET(self):
+        self._handle("")
+
+    def do_POST(self):
+        length = int(self.headers.getheader("content-length") or 0)
+        self._handle(self.rfile.read(length))
+
+    def _handle(self, body):
+        self.server._begin()
+        self._finished = False
+        try:
+            status, delay, self._body_delay, self._body_bytes = \
+                self.server._next_fault()
+            if self.server.latency or delay:
+                time.sleep(self.server.latency + delay)
+            if status is not None:
+                return self._send(body, "", status)
+            self._respond(body)
+        finally:
+            self._finish()
+
+    def _finish(self):
+        if not self._finished:
+            self._finished = True
+            self.server._end()
+
+    def _respond(self, body):
+        path, _, query = self.path.partition("?")
+        form = urlparse.parse_qs(body, keep_blank_values=True)
+        session = self._get_session()
+
+        if path.endswith("/login.asp"):
+            if self.command != "POST":
+                return self._send(body, login_page())
+            session_id = self.server._login(form)
+            if session_id is None:
+                return self._send(body, login_page())
+            return self._send(body, "", 302, [
+                ("Set-Cookie", "ASPSESSIONID=%s; path=/" % session_id),
+                ("Location", "/Timesheet/default.asp")])
+
+        if session is None:
+            return self._send(body, "", 302, [("Location", "/login.asp")])
+
+        if path.endswith("/Timesheet/projects.asp"):
+            projects = []
+            if form.get("search", [None])[0] == "true":
+                projects = [((u"Project %s" % ids.split(",")[0], u"Task",
+                              u"Subtask", u"Activity"), ids.split(","))
+                            for ids in self.server.projects]
+            return self._send(body, projects_page(projects))
+
+        if form.get("useraction", [None])[0] == "save":
+            return self._send(body, session.save(form))
+        self._send(body, session.command(query))
+
+    def _get_session(self):
+        cookie = self.headers.getheader("cookie") or ""
+        for part in cookie.split(";"):
+            name, _, value = part.strip().partition("=")
+            if name == "ASPSESSIONID":
+                return self.server.sessions.get(value)
+
+    def _send(self, body, page, status=200, headers=()):
+        if isinstance(page, unicode):
+            page = page.encode("utf-8")
+        accepted = self.headers.getheader("accept-encoding") or ""
+        for encoding in self.server.encodings:
+            if encoding in accepted:
+                page = _compress(page, encoding)
+                headers = list(headers) + [("Content-Encoding", encoding)]
+                break
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(page)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        # Counted before writing so that the client never sees a
+        # response the counters don't include yet.
+        self.server._count(len(self.requestline) + len(body), len(page))
+        self._finish()
+        if self._body_delay:
+            self.wfile.write(page[:self._body_bytes])
+            self.wfile.flush()
+            time.sleep(self._body_delay)
+            page = page[self._body_bytes:]
+        self.wfile.write(page)
+
+    def log_message(self, *args):
+        pass
+
+
+def _compress(data, encoding):
+    if encoding == "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj()
+    return compressor.compress(data) + compressor.flush()
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+# Copyright 2011 Alf Lervåg. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY ALF LERVÅG ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL ALF LERVÅG OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be interpreted
+# as representing official policies, either expressed or implied, of
+# Alf Lervåg.
+
+"""Keep-alive HTTP transport for urllib2.
+
+urllib2 closes the connection after every request, so each navigation
+step pays for a new TCP and TLS handshake.  The handlers below keep
+connections open in a ConnectionPool and hand them back once the
+response body has been read.  Responses are asked for with gzip or
+deflate and decompressed while they are read.
+"""
+
+import httplib
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import zlib
+
+__all__ = ["ConnectionPool", "TransferCounter", "KeepAliveHTTPHandler",
+           "KeepAliveHTTPSHandler"]
+
+ACCEPT_ENCODING = "gzip, deflate"
+CHUNK_SIZE = 16384
+IDEMPOTENT_METHODS = ("GET", "HEAD")
+
+
+class ConnectionPool(object):
+    def __init__(self, maxsize=4, idle_timeout=60):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        expired = []
+        try:
+            with self._lock:
+                idle = self._idle.get(key, [])
+                while idle:
+                    conn, released = idle.pop()
+                    if time.time() - released <= self.idle_timeout:
+                        return conn
+                    expired.append(conn)
+        finally:
+            for conn in expired:
+                conn.close()
+
+    def release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(conns) for conns in self._idle.values())
+
+
+class TransferCounter(object):
+    """Bytes received on the wire and after decompression."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.wire = 0
+        self.decoded = 0
+
+    def add(self, wire=0, decoded=0):
+        with self._lock:
+            self.wire += wire
+            self.decoded += decoded
+
+    @property
+    def ratio(self):
+        if self.wire:
+            return float(self.decoded) / self.wire
+
+
+class PooledResponseBody(object):
+    """Response body that returns its connection to the pool once read."""
+
+    def __init__(self, response, release, discard, counter=None):
+        self._response = response
+        self._release = release
+        self._discard = discard
+        self._counter = counter
+        self._done = False
+        self._check_done()
+
+    def read(self, amt=None):
+        if self._done:
+            return ""
+
+        if amt is None:
+            data = self._response.read()
+        else:
+            data = self._response.read(amt)
+        if self._counter is not None:
+            self._counter.add(wire=len(data))
+        self._check_done()
+        return data
+
+    def readline(self):
+        chars = []
+        while not chars or chars[-1] != "\n":
+            char = self.read(1)
+            if not char:
+                break
+            chars.append(char)
+        return "".join(chars)
+
+    def close(self):
+        if not self._done:
+            # The rest of the body is still on the wire, so the
+            # connection can't be reused.
+            self._done = True
+            self._response.close()
+            self._discard()
+
+    def _check_done(self):
+        if self._done or not self._response.isclosed():
+            return
+
+        self._done = True
+        if self._response.will_close:
+            self._discard()
+        else:
+            self._release()
+
+
+class DecodedResponseBody(object):
+    """Response body that is decompressed as it is read."""
+
+    def __init__(self, body, encoding=None, counter=None):
+        self._body = body
+        self._counter = counter
+        self._decoder = None
+        self._raw_fallback = False
+        if encoding == "gzip":
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            # Some servers send raw deflate data without the zlib header.
+            self._decoder = zlib.decompressobj()
+            self._raw_fallback = True
+        self._buffer = []
+        self._buffered = 0
+        self._eof = False
+
+    def read(self, amt=None):
+        if self._decoder is None:
+            if amt is None:
+                data = self._body.read()
+            else:
+                data = self._body.read(amt)
+        else:
+            while not self._eof and (amt is None or self._buffered < amt):
+                self._fill()
+            data = "".join(self._buffer)
+            if amt is not None and len(data) > amt:
+                data, rest = data[:amt], data[amt:]
+                self._buffer = [rest]
+            else:
+                self._buffer = []
+            self._buffered -= len(data)
+
+        if self._counter is not None:
+            self._counter.add(decoded=len(data))
+        return data
+
+    def readline(self):
+        chars = []
+        while not chars or chars[-1] != "\n":
+            char = self.read(1)
+            if not char:
+                break
+            chars.append(char)
+        return "".join(chars)
+
+    def close(self):
+        self._body.close()
+
+    def _fill(self):
+        chunk = self._body.read(CHUNK_SIZE)
+        if chunk:
+            data = self._decode(chunk)
+        else:
+            data = self._decoder.flush()
+            self._eof = True
+        if data:
+            self._buffer.append(data)
+            self._buffered += len(data)
+
+    def _decode(self, chunk):
+        if self._raw_fallback:
+            self._raw_fallback = False
+            try:
+                return self._decoder.decompress(chunk)
+            except zlib.error:
+                self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decoder.decompress(chunk)
+
+
+class KeepAliveMixin(object):
+    def __init__(self, pool, counter=None, accept_encoding=ACCEPT_ENCODING,
+                 limiter=None, **kwargs):
+        super(KeepAliveMixin, self).__init__(**kwargs)
+        self._pool = pool
+        self._counter = counter
+        self._accept_encoding = accept_encoding
+        self._limiter = limiter
+
+    def _open_pooled(self, http_class, req, **http_conn_args):
+        finished = None
+        if self._limiter is not None:
+            # The slot is held until the body has been read, so the
+            # limiter sees the whole time the server spends on it.
+            started = self._limiter.acquire()
+            finished = lambda ok: self._limiter.release(started, ok)
+
+        try:
+            return self._open_connection(
+                http_class, req, True, finished, **http_conn_args)
+        except:
+            if finished is not None:
+                finished(False)
+            raise
+
+    def _open_connection(self, http_class, req, reuse, finished=None,
+                         **http_conn_args):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        key = (req.get_type(), host)
+        conn = reuse and self._pool.acquire(key) or None
+        reused = conn is not None
+        if not reused:
+            conn = http_class(host, timeout=req.timeout, **http_conn_args)
+        elif conn.sock is not None and conn.timeout != req.timeout:
+            # The pooled socket still has the timeout of the request
+            # that opened it.
+            conn.timeout = req.timeout
+            if req.timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                conn.sock.settimeout(socket.getdefaulttimeout())
+            else:
+                conn.sock.settimeout(req.timeout)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers["Connection"] = "keep-alive"
+        headers = dict(
+            (name.title(), val) for name, val in headers.items())
+        if self._accept_encoding:
+            headers.setdefault("Accept-Encoding", self._accept_encoding)
+
+        method = req.get_method()
+        sent = False
+        try:
+            conn.request(method, req.get_selector(), req.data, headers)
+            sent = True
+            response = conn.getresponse()
+        except (socket.error, httplib.HTTPException), err:
+            conn.close()
+            # The server has most likely closed the idle connection.  A
+            # request that was never fully sent can't have been acted on,
+            # but once it was, only those that are safe to repeat are.  A
+            # timeout means it got the request, so sending it again is
+            # left to the caller.
+            if reused and not isinstance(err, socket.timeout) and \
+                    (not sent or method in IDEMPOTENT_METHODS):
+                return self._open_connection(
+                    http_class, req, False, finished, **http_conn_args)
+            raise urllib2.URLError(err)
+
+        def release():
+            self._pool.release(key, conn)
+            if finished is not None:
+                finished(response.status < 500)
+
+        def discard():
+            conn.close()
+            if finished is not None:
+                finished(response.status < 500)
+
+        body = PooledResponseBody(response, release, discard, self._counter)
+
+        # The rest of urllib2 and the parser only ever see the decoded
+        # body, so the headers describing the encoded one are dropped.
+        msg = response.msg
+        encoding = (msg.getheader("content-encoding") or "").strip().lower()
+        if encoding in ("gzip", "deflate"):
+            del msg["content-encoding"]
+            del msg["content-length"]
+        else:
+            encoding = None
+        body = DecodedResponseBody(body, encoding, self._counter)
+
+        resp = urllib.addinfourl(body, msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+
+class KeepAliveHTTPHandler(KeepAliveMixin, urllib2.HTTPHandler):
+    def http_open(self, req):
+        return self._open_pooled(httplib.HTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(KeepAliveMixin, urllib2.HTTPSHandler):
+    def https_open(self, req):
+        return self._open_pooled(
+            httplib.HTTPSConnection, req, context=self._context)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Copyright 2011 Alf Lervåg. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY ALF LERVÅG ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL ALF LERVÅG OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and
+# documentation are those of the authors and should not be interpreted
+# as representing official policies, either expressed or implied, of
+# Alf Lervåg.
+
+"""XPath expressions for the CurrentTime pages, compiled once.
+
+Passing CSS to cssselect() translates it to XPath and compiles that on
+every call.  Here each expression is written out as XPath and compiled
+the first time it is used, which also keeps lxml from being imported
+until a page is actually parsed.  Expressions that depend on a value
+take it as an XPath variable instead of being formatted per call.
+"""
+
+import threading
+
+__all__ = ["XPATHS", "select"]
+
+XPATHS = {
+    # input[name='sessionid']
+    'session_id': "descendant-or-self::input[@name = 'sessionid']",
+    # body[class=login]
+    'login_body': "descendant-or-self::body[@class = 'login']",
+    # table table script
+    'navigation_script': "descendant-or-self::table//table//script",
+    # td[class=accept]
+    'range': "descendant-or-self::td[@class = 'accept']",
+    # td[class=date] holding the day number $day
+    'day_cell': "descendant-or-self::td[@class = 'date']"
+                "[number(normalize-space(.)) = $day]",
+    # td[class=week] holding the week number $week
+    'week_cell': "descendant-or-self::td[@class = 'week']"
+                 "[number(normalize-space(.)) = $week]",
+    'project_rows': "/html/body/table/tr/td[2]/form[2]/table[3]/tr[@name != '']",
+    # input[type=hidden], relative to a project row
+    'project_values': "descendant-or-self::input[@type = 'hidden']",
+    # td[class=text], relative to a project row
+    'project_names': "descendant-or-self::td[@class = 'text']",
+}
+
+_compiled = {}
+_lock = threading.Lock()
+
+
+def get(name):
+    """Return the compiled XPath for ``name``."""
+    try:
+        return _compiled[name]
+    except KeyError:
+        pass
+
+    from lxml import etree
+    with _lock:
+        if name not in _compiled:
+            _compiled[name] = etree.XPath(XPATHS[name])
+        return _compiled[name]
+
+
+def select(name, element, **variables):
+    """Evaluate the expression ``name`` on ``element``."""
+    return get(name)(element, **variables)
@@ -33,18 +33,56 @@
 
 import unittest
 
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import calendar
 import datetime
-from browser import CurrentTimeBrowser
-from parser import CurrentTimeParser
+import os
+import pickle
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+import zlib
+from decimal import Decimal
+
+from ct.core import aio, testing, transport
+from ct.core.activity import Activity
+from ct.core.apis import BaseAPI, RangeAPI
+from ct.core.apis import ActivityAlreadyExists
+from ct.core.apis import PreviousActivityNotFound
+from ct.core.catalog import ProjectCatalog
+from ct.core.instrumentation import Histogram, Stats
+from ct.core.limiter import AdaptiveLimiter, LimiterTimeout, TokenBucket
+from ct.core.limiter import get_limiter, set_limiter
+from ct.core.navigation import FetchPlan, NavigationError, NavigationPlan
+from ct.core.navigation import check_month_view, is_month_view
+from ct.core.project import Project
+from ct.core.replica import Replica, ReplicaSync
+from ct.core.retry import RetryPolicy
+from ct.core.session import LoginFailed, SessionPool, SessionStore
+from ct.core.session import set_server_limit
+from ct.core.browser import CurrentTimeBrowser
+from ct.core.parser import CurrentTimeParser, IncrementalParser
+from ct.core.transport import DecodedResponseBody
+from ct.core import xpaths
 
 
 class CurrentTimeParserTestCase(unittest.TestCase):
     def setUp(self):
-        self.browser = CurrentTimeBrowser()
+        self.server = testing.FakeCurrentTime().start()
+        self.addCleanup(self.server.stop)
+        self.browser = CurrentTimeBrowser(self.server.url)
+        self.addCleanup(self.browser.close)
+        self.assertTrue(self.browser.login("user", "secret"))
         self.parser = CurrentTimeParser()
 
     def test_that_we_get_current_month_on_login(self):
-        current_date = self.parser.current_month(self.browser.current_page)
+        current_date = self.parser.parse_navigation(self.browser.current_page)
 
         now = datetime.datetime.now()
         expected_date = datetime.date(now.year, now.month, 1)
@@ -54,7 +92,7 @@ class CurrentTimeParserTestCase(unittest.TestCase):
     def test_that_current_date_is_previous_month_after_navigation(self):
         self.browser.goto_prev_month()
 
-        current_date = self.parser.current_month(self.browser.current_page)
+        current_date = self.parser.parse_navigation(self.browser.current_page)
 
         now = datetime.datetime.now()
         expected_year = now.year
@@ -69,12 +107,2238 @@ class CurrentTimeParserTestCase(unittest.TestCase):
     def test_that_current_date_is_previous_year_after_navigation(self):
         self.browser.goto_prev_year()
 
-        current_date = self.parser.current_month(self.browser.current_page)
+        current_date = self.parser.parse_navigation(self.browser.current_page)
 
         now = datetime.datetime.now()
         expected_date = datetime.date(now.year - 1, now.month, 1)
 
         self.assertEquals(expected_date, current_date)
 
+    def test_that_day_and_week_commands_narrow_the_timesheet(self):
+        api = BaseAPI(None)
+        api._browser = self.browser
+        today = self.server.today
+
+        activities = api.get_day(today.year, today.month, today.day)
+        self.assertEquals([today], [a.date for a in activities])
+
+        week = today.isocalendar()[1]
+        command = self.parser.get_week_command(self.browser.current_page, week)
+        page = self.browser.get(command)
+        start, end = self.parser._get_current_range(page)
+        self.assertEquals(6, (end - start).days)
+        self.assertTrue(start <= today <= end)
+
+    def test_that_saved_cells_are_kept_by_the_server(self):
+        today = self.server.today.replace(day=1)
+        page = self.browser.get_current_month()
+        session_id = self.parser.parse_session_id(page)
+        activity = Activity(today, "1,1,0,0", Decimal("3.5"), "saved", "1")
+
+        page = self.browser.update(session_id, activity)
+
+        saved = [a for a in self.parser.parse_activities(page) if a.date == today]
+        self.assertEquals([(Decimal("3.5"), "saved")],
+                          [(a.duration, a.comment) for a in saved])
+
+    def test_that_wrong_passwords_are_refused(self):
+        server = testing.FakeCurrentTime(users={"user": "secret"}).start()
+        self.addCleanup(server.stop)
+        browser = CurrentTimeBrowser(server.url)
+        self.addCleanup(browser.close)
+
+        self.assertFalse(browser.login("user", "wrong"))
+        self.assertTrue(browser.login("user", "secret"))
+
+
+class ParsedPageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.parser = CurrentTimeParser()
+        date = datetime.date(2011, 6, 1)
+        rows = [(testing.project_value("1,2,3,4"), {date: ("7,5", "work")})]
+        self.response = testing.timesheet_page(
+            datetime.date(2011, 6, 1), datetime.date(2011, 6, 30), rows)
+
+    def test_that_the_same_response_is_parsed_once(self):
+        page = self.parser.page(self.response)
+
+        self.assertTrue(page is self.parser.page(self.response))
+        self.assertTrue(page is self.parser.page(page))
+
+    def test_that_parser_methods_accept_a_parsed_page(self):
+        page = self.parser.page(self.response)
+
+        self.assertEquals("1234", self.parser.parse_session_id(page))
+        self.assertTrue(self.parser.valid_session(page))
+        self.assertEquals(datetime.date(2011, 6, 1),
+                          self.parser.parse_navigation(page))
+        self.assertEquals("caltimesheet=2,3",
+                          self.parser.get_day_command(page, 1))
+        self.assertEquals(
+            self.parser.parse_activities(self.response),
+            self.parser.parse_activities(page))
+
+    def test_that_activities_are_parsed(self):
+        activities = self.parser.parse_activities(self.response)
+
+        self.assertEquals(30, len(activities))
+        self.assertEquals(Decimal("7.5"), activities[0].duration)
+        self.assertEquals("work", activities[0].comment)
+        self.assertEquals("1,2,3,4", activities[0].project_id)
+
+    def test_that_the_page_cache_is_bounded(self):
+        parser = CurrentTimeParser(cache_size=1)
+        page = parser.page(self.response)
+        parser.page(testing.login_page())
+
+        self.assertFalse(page is parser.page(self.response))
+
+
+class RowByRowParser(CurrentTimeParser):
+    """The original per-row implementation of parse_activities."""
+
+    def _read_activities(self, page):
+        activities = []
+
+        root = page.root
+        start, end = self._get_current_range(page)
+
+        rows = root.cssselect("input[name=activityrow]")[0].value
+        for i in range(1, int(rows) + 1):
+            row = self._parse_row(start, end, root, i)
+            activities.extend(row)
+        return sorted(activities)
+
+    def _parse_row(self, start, end, root, i):
+        result = []
+
+        projectel = root.cssselect("input[name=activityrow_%s]" % i)[0]
+        project_id = self._parse_project_id(projectel.value)
+        salary_id = self._parse_salary_id(projectel.value)
+
+        row = projectel.getparent().getparent()
+        row_root = root.getroottree().getpath(row)
+        ro_classes = [
+            "@class='datacol'",
+            "@class='lastcol'",
+            "@class='holiday'",
+            "@class='readonly'"
+        ]
+        tds = root.xpath("%s/td[%s]" % (row_root, " or ".join(ro_classes)))
+
+        for n, date in enumerate(self._dates(start, end)):
+            i = n * 2
+            duration_cell = tds[i][0]
+            comment_cell = tds[i+1][0]
+            if duration_cell.tag == "div" and len(duration_cell) > 0:
+                duration, comment = self._parse_div(duration_cell, comment_cell)
+                read_only = False
+            else:
+                duration, comment = self._parse_text(duration_cell, comment_cell)
+                read_only = True
+
+            activity = Activity(
+                date,
+                project_id,
+                duration,
+                comment,
+                read_only=read_only,
+                salary_id=salary_id)
+            result.append(activity)
+        return result
+
+
+class SinglePassExtractionTestCase(unittest.TestCase):
+    def _page(self, start, end, rows=40):
+        read_only = set()
+        cells = []
+        for i in range(rows):
+            values = {}
+            current = start
+            while current <= end:
+                if (current.day + i) % 3 == 0:
+                    values[current] = ("%d,%d" % (i % 8, i % 10), "note %d" % i)
+                if current.day < 8:
+                    read_only.add(current)
+                current += datetime.timedelta(days=1)
+            project_id = "%d,%d,0,%d" % (100 + i, i % 4, i % 2)
+            cells.append((testing.project_value(project_id, str(i % 3)), values))
+        return testing.timesheet_page(start, end, cells, read_only=read_only)
+
+    def assertSameAsRowByRow(self, response):
+        expected = RowByRowParser().parse_activities(response)
+        actual = CurrentTimeParser().parse_activities(response)
+
+        self.assertEquals(len(expected), len(actual))
+        for e, a in zip(expected, actual):
+            self.assertEquals(e._dict, a._dict)
+
+    def test_month_page_matches_row_by_row_parser(self):
+        self.assertSameAsRowByRow(self._page(
+            datetime.date(2011, 5, 1), datetime.date(2011, 5, 31)))
+
+    def test_week_page_matches_row_by_row_parser(self):
+        self.assertSameAsRowByRow(self._page(
+            datetime.date(2011, 5, 2), datetime.date(2011, 5, 8)))
+
+    def test_day_page_matches_row_by_row_parser(self):
+        self.assertSameAsRowByRow(self._page(
+            datetime.date(2011, 5, 9), datetime.date(2011, 5, 9), rows=3))
+
+
+class IncrementalParserTestCase(unittest.TestCase):
+    def setUp(self):
+        self.parser = IncrementalParser()
+        self.start = datetime.date(2011, 3, 1)
+        self.end = datetime.date(2011, 3, 31)
+
+    def _page(self, changed=None, start=None, end=None):
+        start = start or self.start
+        end = end or self.end
+        rows = []
+        for i in range(10):
+            cells = {start: ("%d" % i, "row %d" % i)}
+            if i == changed:
+                cells[start] = ("7,5", "changed")
+            rows.append((testing.project_value("%d,1,0,0" % (i + 1)), cells))
+        return testing.timesheet_page(start, end, rows)
+
+    def test_that_identical_pages_are_not_parsed_again(self):
+        first = self.parser.parse_activities(self._page())
+        second = self.parser.parse_activities("%s" % self._page())
+
+        self.assertEquals(first, second)
+        self.assertEquals((1, 1), (self.parser.page_hits, self.parser.page_misses))
+        self.assertEquals(0.5, self.parser.page_hit_rate)
+        self.assertEquals(1, len(self.parser._pages))
+
+    def test_that_only_changed_rows_are_rebuilt(self):
+        self.parser.parse_activities(self._page())
+
+        activities = self.parser.parse_activities(self._page(changed=3))
+
+        self.assertEquals(CurrentTimeParser().parse_activities(self._page(changed=3)),
+                          activities)
+        self.assertEquals((9, 11), (self.parser.row_hits, self.parser.row_misses))
+        changed = [a for a in activities if a.comment == "changed"]
+        self.assertEquals([("4,1,0,0", Decimal("7.5"))],
+                          [(a.project_id, a.duration) for a in changed])
+
+    def test_that_rows_are_not_shared_between_ranges(self):
+        # Both weeks start on a Tuesday, so the rows look the same.
+        march = self.parser.parse_activities(self._page(
+            start=datetime.date(2011, 3, 1), end=datetime.date(2011, 3, 7)))
+        november = self.parser.parse_activities(self._page(
+            start=datetime.date(2011, 11, 1), end=datetime.date(2011, 11, 7)))
+
+        self.assertEquals(0, self.parser.row_hits)
+        self.assertEquals(set([3]), set(a.date.month for a in march))
+        self.assertEquals(set([11]), set(a.date.month for a in november))
+
+    def test_that_hits_are_reported_to_the_stats(self):
+        stats = Stats()
+        self.parser.stats = stats
+
+        self.parser.parse_activities(self._page())
+        self.parser.parse_activities(self._page())
+        self.parser.parse_activities(self._page(changed=0))
+
+        self.assertEquals({'parse.page_hits': 1, 'parse.page_misses': 2,
+                           'parse.row_hits': 9, 'parse.row_misses': 11},
+                          stats.counters)
+
+    def test_that_polling_the_same_month_is_a_page_hit(self):
+        server = testing.FakeCurrentTime(
+            rows=5, today=datetime.date(2011, 6, 15)).start()
+        self.addCleanup(server.stop)
+        api = RangeAPI(server.url, incremental=True)
+        self.addCleanup(api.close)
+        api.login("user", "secret")
+        parser = api._ct._ct._parser
+
+        first = api.get_activities(datetime.date(2011, 5, 1), datetime.date(2011, 5, 31))
+        api.get_activities(datetime.date(2011, 6, 1), datetime.date(2011, 6, 30))
+        second = api.get_activities(datetime.date(2011, 5, 1), datetime.date(2011, 5, 31))
+
+        self.assertEquals(first, second)
+        self.assertTrue(parser.page_hits >= 1)
+
+
+class ActivityTestCase(unittest.TestCase):
+    def _activity(self, duration="7.5", comment="work"):
+        return Activity(datetime.date(2011, 6, 1), "1,2,3,4",
+                        Decimal(duration), comment, "1")
+
+    def test_that_duration_is_kept_in_centihours(self):
+        activity = self._activity("7.50")
+
+        self.assertEquals(750, activity.centihours)
+        self.assertEquals(Decimal("7.5"), activity.duration)
+        self.assertEquals("7.5", str(activity.duration))
+
+    def test_that_finer_durations_are_rejected(self):
+        self.assertRaises(ValueError, self._activity, "7.125")
+
+    def test_that_equality_and_hashing_are_unchanged(self):
+        self.assertEquals(self._activity("7.5"), self._activity("7.50"))
+        self.assertNotEquals(self._activity(comment="a"), self._activity())
+        self.assertEquals(hash(self._activity(comment="a")),
+                          hash(self._activity()))
+
+    def test_that_activities_are_immutable(self):
+        activity = self._activity()
+
+        self.assertRaises(AttributeError, setattr, activity, "comment", "x")
+
+    def test_that_project_ids_are_shared(self):
+        first = Activity(datetime.date(2011, 6, 1), "".join("1,2,3,4"),
+                         Decimal(1), "")
+        second = self._activity()
+
+        self.assertTrue(first.project_id is second.project_id)
+        self.assertTrue(first.full_project_id is second.full_project_id)
+        self.assertEquals("projectid=1,taskid=2,subtaskid=3,activityid=4",
+                          first.full_project_id)
+
+    def test_that_activities_can_be_pickled(self):
+        activity = self._activity()
+
+        self.assertEquals(activity, pickle.loads(pickle.dumps(activity)))
+
+
+class ProjectTestCase(unittest.TestCase):
+    def test_that_name_and_id_are_formatted(self):
+        project = Project([u"Project", u"Task", u"Sub", u""], ["1", "2", "3", "4"])
+
+        self.assertEquals(u"Project - Task - Sub", project.name)
+        self.assertEquals("1,2,3,4", project.id)
+        self.assertEquals(u"Task", project.task_name)
+
+    def test_that_activity_is_part_of_the_name(self):
+        project = Project([u"P", u"T", u"S", u"A"], ["1", "2", "3", "4"])
+
+        self.assertEquals(u"P - T - S - A", project.name)
+        self.assertEquals(project.id, pickle.loads(pickle.dumps(project)).id)
+
+
+class ProjectCatalogTestCase(unittest.TestCase):
+    PROJECTS = [
+        ((u"Internal", u"Admin", u"Meetings", u""), (1, 1, 0, 0)),
+        ((u"Internal", u"Admin", u"Travel", u""), (1, 1, 1, 0)),
+        ((u"Internal", u"Courses", u"Python", u""), (1, 2, 0, 0)),
+        ((u"Customer", u"Support", u"Phone", u"Night"), (2, 1, 0, 3)),
+    ]
+
+    def setUp(self):
+        self.catalog = ProjectCatalog(
+            [Project(names, ids) for names, ids in self.PROJECTS])
+
+    def test_that_projects_are_found_by_id(self):
+        self.assertEquals(u"Customer - Support - Phone - Night",
+                          self.catalog.get("2,1,0,3").name)
+        self.assertTrue("1,2,0,0" in self.catalog)
+        self.assertEquals(None, self.catalog.get("9,9,9,9"))
+
+    def test_that_projects_are_found_by_hierarchy(self):
+        self.assertEquals(3, len(self.catalog.find(1)))
+        self.assertEquals(["1,1,0,0", "1,1,1,0"],
+                          [p.id for p in self.catalog.find(1, 1)])
+        self.assertEquals([], self.catalog.find(3))
+
+    def test_that_a_subtask_needs_a_task(self):
+        self.assertRaises(ValueError, self.catalog.find, 1, subtaskid=1)
+
+    def test_that_projects_are_found_by_name_prefix(self):
+        self.assertEquals(["1,1,0,0", "1,1,1,0"],
+                          [p.id for p in self.catalog.search(u"internal - ad")])
+        self.assertEquals(4, len(self.catalog.search(u"")))
+
+    def test_that_a_saved_catalog_can_be_loaded(self):
+        path = tempfile.mktemp()
+        self.addCleanup(os.remove, path)
+        self.catalog.save(path)
+
+        loaded = ProjectCatalog.load(path)
+
+        self.assertEquals([p.name for p in self.catalog],
+                          [p.name for p in loaded])
+        self.assertEquals(self.catalog.fetched_at, loaded.fetched_at)
+
+    def test_that_the_api_reuses_a_fresh_catalog(self):
+        path = tempfile.mktemp()
+        self.addCleanup(os.remove, path)
+        browser = FakeBrowser(2011, 6)
+        api = BaseAPI("no-server")
+        api._browser = browser
+        api.get_catalog(path=path)
+
+        other = BaseAPI("no-server")
+        other._browser = FakeBrowser(2011, 6)
+        catalog = other.get_catalog(path=path)
+        api.get_catalog(path=path)
+
+        self.assertEquals(1, browser.requests.count('get_projects'))
+        self.assertEquals([], other._browser.requests)
+        self.assertEquals(["1,2,3,4"], [p.id for p in catalog])
+
+    def test_that_a_broken_catalog_file_is_replaced(self):
+        path = tempfile.mktemp()
+        self.addCleanup(os.remove, path)
+        for content in ('{"fetched_at": 1', '{"projects": []}',
+                        '{"fetched_at": 1, "projects": [[["a"]]]}'):
+            with open(path, "w") as f:
+                f.write(content)
+            browser = FakeBrowser(2011, 6)
+            api = BaseAPI("no-server")
+            api._browser = browser
+
+            catalog = api.get_catalog(path=path)
+
+            self.assertEquals(1, browser.requests.count('get_projects'))
+            self.assertEquals(["1,2,3,4"], [p.id for p in catalog])
+            self.assertEquals(1, len(ProjectCatalog.load(path)))
+
+    def test_that_an_old_catalog_is_fetched_again(self):
+        browser = FakeBrowser(2011, 6)
+        api = BaseAPI("no-server")
+        api._browser = browser
+        api.get_catalog()
+        api.get_catalog(max_age=-1)
+
+        self.assertEquals(2, browser.requests.count('get_projects'))
+
+
+class ActivityStreamTestCase(unittest.TestCase):
+    def _chunks(self, response, size):
+        return [response[i:i + size] for i in range(0, len(response), size)]
+
+    def test_that_streamed_activities_match_parsed_activities(self):
+        response = SinglePassExtractionTestCase("run")._page(
+            datetime.date(2011, 5, 1), datetime.date(2011, 5, 31))
+        parser = CurrentTimeParser()
+        expected = parser.parse_activities(response)
+
+        for size in (64, 4096, len(response)):
+            stream = parser.iter_activities(self._chunks(response, size))
+            actual = sorted(stream)
+
+            self.assertEquals([a._dict for a in expected],
+                              [a._dict for a in actual])
+            self.assertEquals((datetime.date(2011, 5, 1),
+                               datetime.date(2011, 5, 31)), stream.range)
+
+    def test_that_rows_are_yielded_before_the_page_ends(self):
+        response = SinglePassExtractionTestCase("run")._page(
+            datetime.date(2011, 5, 1), datetime.date(2011, 5, 31), rows=10)
+        chunks = self._chunks(response, 64)
+        fed = []
+
+        def feed():
+            for chunk in chunks:
+                fed.append(chunk)
+                yield chunk
+
+        stream = iter(CurrentTimeParser().iter_activities(feed()))
+        stream.next()
+
+        self.assertTrue(len(fed) < len(chunks) / 2)
+
+    def test_that_a_month_can_be_streamed_from_the_api(self):
+        browser = FakeBrowser(2011, 6)
+        api = BaseAPI("no-server")
+        api._browser = browser
+
+        activities = list(api.iter_month(2011, 3))
+
+        self.assertEquals(31, len(activities))
+        self.assertEquals(datetime.date(2011, 3, 1), browser.displayed)
+        self.assertEquals((2011, 3), api.get_displayed_month()[0])
+
+
+class FakeBrowser(object):
+    """Keeps the displayed month in memory instead of on a server."""
+
+    COMMANDS = CurrentTimeBrowser.COMMANDS
+
+    def __init__(self, year, month, year_hops=True):
+        self.displayed = datetime.date(year, month, 1)
+        self.year_hops = year_hops
+        self.requests = []
+        self.cells = {}
+        self.day = None
+        self._current_page = self._render()
+
+    def clone(self, session=True):
+        # Copies in one session share the calendar, like on the server.
+        if session:
+            return self
+        return FakeBrowser(self.displayed.year, self.displayed.month,
+                           self.year_hops)
+
+    def close(self):
+        pass
+
+    def login(self, username, password):
+        self.requests.append('login')
+        return True
+
+    @property
+    def current_page(self):
+        return self._current_page
+
+    def get_current_month(self):
+        return self._request('get_current_month', 0)
+
+    def goto_next_month(self):
+        return self._request('goto_next_month', 1)
+
+    def goto_prev_month(self):
+        return self._request('goto_prev_month', -1)
+
+    def goto_next_year(self):
+        return self._request('goto_next_year', self.year_hops and 12 or 0)
+
+    def goto_prev_year(self):
+        return self._request('goto_prev_year', self.year_hops and -12 or 0)
+
+    def stream(self, command):
+        page = self.get_current_month()
+        for i in range(0, len(page), 100):
+            yield page[i:i + 100]
+
+    def get_projects(self):
+        self.requests.append('get_projects')
+        return testing.projects_page([((u"P", u"T", u"S", u""), (1, 2, 3, 4))])
+
+    def get(self, command):
+        row, column = command.split("=")[1].split(",")
+        weeks = calendar.Calendar().monthdatescalendar(
+            self.displayed.year, self.displayed.month)
+        self._request('get', 0)
+        week = weeks[int(row) - 2]
+        if int(column) == 0:
+            self.day = (week[0], week[-1])
+        else:
+            self.day = (week[int(column) - 1],) * 2
+        self._current_page = self._render()
+        return self._current_page
+
+    def update(self, session_id, activity):
+        hours = str(activity.duration).replace(".", ",")
+        self.cells[activity.date] = (hours, activity.comment)
+        return self._request('update', 0)
+
+    def update_many(self, session_id, activities):
+        for activity in activities:
+            hours = str(activity.duration).replace(".", ",")
+            self.cells[activity.date] = (hours, activity.comment)
+        return self._request('update_many', 0)
+
+    def _request(self, name, months):
+        self.requests.append(name)
+        months += self.displayed.year * 12 + self.displayed.month - 1
+        self.displayed = datetime.date(months // 12, months % 12 + 1, 1)
+        if not name.startswith('update'):
+            self.day = None
+        self._current_page = self._render()
+        return self._current_page
+
+    def _render(self):
+        first = self.displayed
+        days = calendar.monthrange(first.year, first.month)[1]
+        start, end = first, first.replace(day=days)
+        if self.day is not None:
+            start, end = self.day
+
+        cells = {first: ("1", "first")}
+        cells.update(self.cells)
+        row = (testing.project_value("1,2,3,4"), cells)
+        month = (first.year, first.month)
+        return testing.timesheet_page(start, end, [row], month=month)
+
+
+class NavigationPlanTestCase(unittest.TestCase):
+    def _plan(self, current, target):
+        return NavigationPlan(datetime.date(*current), datetime.date(*target))
+
+    def test_that_staying_in_the_same_month_costs_nothing(self):
+        plan = self._plan((2011, 6, 15), (2011, 6, 1))
+
+        self.assertEquals([], plan.steps)
+        self.assertEquals(0, plan.saved)
+
+    def test_that_crossing_new_year_uses_a_single_month_hop(self):
+        plan = self._plan((2011, 12, 1), (2012, 1, 1))
+
+        self.assertEquals(['goto_next_month'], plan.steps)
+        self.assertEquals(11, plan.saved)
+
+    def test_that_years_and_months_are_mixed(self):
+        plan = self._plan((2011, 6, 1), (2008, 11, 1))
+
+        self.assertEquals(['goto_prev_year'] * 3 + ['goto_next_month'] * 5,
+                          plan.steps)
+
+    def test_that_nearby_months_use_month_hops(self):
+        plan = self._plan((2011, 2, 1), (2010, 11, 1))
+
+        self.assertEquals(['goto_prev_month'] * 3, plan.steps)
+        self.assertEquals(7, plan.saved)
+
+
+class FallbackStepTestCase(unittest.TestCase):
+    def setUp(self):
+        self.plan = NavigationPlan(datetime.date(2011, 6, 1),
+                                   datetime.date(2011, 3, 1))
+
+    def test_that_no_step_is_needed_on_the_target(self):
+        self.assertEquals(None, self.plan.fallback_step(datetime.date(2011, 3, 1)))
+        self.assertEquals(0, self.plan.fallback_steps)
+
+    def test_that_steps_go_towards_the_target(self):
+        other = NavigationPlan(datetime.date(2011, 6, 1),
+                               datetime.date(2011, 3, 1))
+
+        self.assertEquals('goto_prev_month',
+                          self.plan.fallback_step(datetime.date(2011, 4, 1)))
+        self.assertEquals('goto_next_month',
+                          other.fallback_step(datetime.date(2011, 2, 1)))
+        self.assertEquals(1, self.plan.fallback_steps)
+
+    def test_that_stepping_gives_up_after_the_distance(self):
+        current = datetime.date(2011, 5, 1)
+        self.plan.fallback_step(current)
+        self.plan.fallback_step(current)
+
+        self.assertRaises(NavigationError, self.plan.fallback_step, current)
+
+    def test_that_month_views_are_recognized(self):
+        june = (datetime.date(2011, 6, 1), datetime.date(2011, 6, 30))
+        week = (datetime.date(2011, 6, 6), datetime.date(2011, 6, 12))
+
+        self.assertTrue(is_month_view(*june))
+        self.assertTrue(is_month_view(*june + (2011, 6)))
+        self.assertFalse(is_month_view(*june + (2011, 7)))
+        self.assertFalse(is_month_view(*week))
+        self.assertRaises(NavigationError, check_month_view, *week + (2011, 6))
+
+
+class GotoTestCase(unittest.TestCase):
+    def _api(self, browser):
+        api = BaseAPI("no-server")
+        api._browser = browser
+        return api
+
+    def test_that_goto_follows_the_plan(self):
+        browser = FakeBrowser(2011, 12)
+        api = self._api(browser)
+
+        api._goto(2012, 1)
+
+        self.assertEquals(datetime.date(2012, 1, 1), browser.displayed)
+        self.assertEquals(['goto_next_month'], browser.requests)
+        self.assertEquals(11, api.round_trips_saved)
+
+    def test_that_goto_falls_back_to_stepping(self):
+        browser = FakeBrowser(2011, 6, year_hops=False)
+        api = self._api(browser)
+
+        plan = api._goto(2010, 6)
+
+        self.assertEquals(datetime.date(2010, 6, 1), browser.displayed)
+        self.assertEquals(12, plan.fallback_steps)
+        self.assertEquals(13, plan.round_trips)
+
+    def test_that_get_month_reads_the_target_month(self):
+        browser = FakeBrowser(2011, 6)
+        api = self._api(browser)
+
+        activities = api.get_month(2009, 2)
+
+        self.assertEquals(datetime.date(2009, 2, 1), browser.displayed)
+        self.assertEquals(28, len(activities))
+        self.assertEquals(datetime.date(2009, 2, 1), activities[0].date)
+
+
+class SharedFakeBrowser(FakeBrowser):
+    """Clones share the displayed month, like clones of one real session."""
+
+    def clone(self, session=True):
+        return self
+
+
+class MonthsInRangeTestCase(unittest.TestCase):
+    def test_1_month_in_same_month_and_year(self):
+        api = RangeAPI("no-server")
+        from_date = to_date = datetime.date(2011, 6, 1)
+        months = list(api._get_months_in_range(from_date, to_date))
+
+        self.assertEquals(1, len(months))
+
+    def test_2_months_in_same_year_and_following_month(self):
+        api = RangeAPI("no-server")
+        from_date = datetime.date(2011, 6, 1)
+        to_date = datetime.date(2011, 7, 1)
+        months = list(api._get_months_in_range(from_date, to_date))
+
+        self.assertEquals(2, len(months))
+
+    def test_13_months_in_same_month_and_following_year(self):
+        api = RangeAPI("no-server")
+        from_date = datetime.date(2011, 6, 1)
+        to_date = datetime.date(2012, 6, 1)
+        months = list(api._get_months_in_range(from_date, to_date))
+
+        self.assertEquals(13, len(months))
+
+
+class ParallelRangeAPITestCase(unittest.TestCase):
+    def _api(self, browser, concurrency):
+        api = RangeAPI("no-server", concurrency=concurrency)
+        api._ct._ct._browser = browser
+        api.login("user", "secret")
+        return api
+
+    def _nonzero(self, activities):
+        return [(a.date, a.duration) for a in activities if a.duration]
+
+    def test_that_parallel_fetch_matches_sequential_fetch(self):
+        from_date = datetime.date(2010, 11, 15)
+        to_date = datetime.date(2011, 10, 15)
+        sequential = self._api(FakeBrowser(2011, 6), 1)
+        parallel = self._api(FakeBrowser(2011, 6), 4)
+
+        expected = sequential.get_activities(from_date, to_date)
+        actual = parallel.get_activities(from_date, to_date)
+
+        self.assertEquals([a._dict for a in expected], [a._dict for a in actual])
+        self.assertEquals(11, len(self._nonzero(actual)))
+
+    def test_that_concurrency_can_be_given_per_call(self):
+        from_date = datetime.date(2011, 1, 1)
+        to_date = datetime.date(2011, 12, 31)
+        api = self._api(FakeBrowser(2011, 6), 1)
+
+        activities = api.get_activities(from_date, to_date, concurrency=3)
+
+        self.assertEquals(365, len(activities))
+        self.assertEquals(sorted(activities), activities)
+
+    def test_that_months_from_a_shared_session_are_fetched_again(self):
+        from_date = datetime.date(2011, 1, 1)
+        to_date = datetime.date(2011, 12, 31)
+        api = self._api(SharedFakeBrowser(2011, 6), 4)
+
+        activities = api.get_activities(from_date, to_date)
+
+        self.assertEquals(
+            [datetime.date(2011, m, 1) for m in range(1, 13)],
+            [date for date, _ in self._nonzero(activities)])
+
+
+class ParallelSessionsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = testing.FakeCurrentTime(
+            today=datetime.date(2011, 6, 15)).start()
+        self.addCleanup(self.server.stop)
+        self.from_date = datetime.date(2010, 7, 1)
+        self.to_date = datetime.date(2011, 6, 30)
+
+    def _fetch(self, concurrency):
+        api = RangeAPI(self.server.url, concurrency=concurrency)
+        self.addCleanup(api.close)
+        self.assertTrue(api.login("user", "secret"))
+        self.server.reset_stats()
+        return api.get_activities(self.from_date, self.to_date)
+
+    def test_that_each_worker_has_its_own_session(self):
+        expected = self._fetch(1)
+        sessions = len(self.server.sessions)
+
+        actual = self._fetch(4)
+
+        self.assertEquals(expected, actual)
+        self.assertEquals(sessions + 1 + 4, len(self.server.sessions))
+
+    def test_that_workers_dont_fetch_months_twice(self):
+        self._fetch(4)
+
+        # A login and its redirect per worker, then at most a couple of
+        # hops and a month view per month.
+        self.assertTrue(self.server.requests <= 4 * 2 + 12 * 3,
+                        self.server.requests)
+
+    def test_that_without_credentials_months_are_fetched_in_order(self):
+        api = RangeAPI(self.server.url, concurrency=4)
+        self.addCleanup(api.close)
+        api._ct._ct._browser.login("user", "secret")
+
+        api.get_activities(self.from_date, self.to_date)
+
+        self.assertEquals(1, len(self.server.sessions))
+
+
+class IterActivitiesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.browser = FakeBrowser(2011, 6)
+        self.api = RangeAPI("no-server")
+        self.api._ct._ct._browser = self.browser
+
+    def test_that_the_same_activities_are_yielded(self):
+        from_date = datetime.date(2010, 11, 15)
+        to_date = datetime.date(2011, 2, 10)
+
+        expected = self.api.get_activities(from_date, to_date)
+        self.assertEquals(expected, list(self.api.iter_activities(from_date, to_date)))
+
+    def test_that_months_are_fetched_as_they_are_consumed(self):
+        activities = self.api.iter_activities(
+            datetime.date(2006, 1, 1), datetime.date(2010, 12, 31))
+
+        first = activities.next()
+        self.assertEquals(datetime.date(2006, 1, 1), first.date)
+        requests = len(self.browser.requests)
+        for _ in range(30):
+            activities.next()
+        self.assertEquals(requests, len(self.browser.requests))
+
+        activities.next()
+        self.assertTrue(len(self.browser.requests) > requests)
+
+    def test_that_fetching_stops_with_the_consumer(self):
+        activities = self.api.iter_activities(
+            datetime.date(2006, 1, 1), datetime.date(2010, 12, 31))
+        for activity in activities:
+            if activity.date.month == 3:
+                break
+        activities.close()
+
+        self.assertEquals(datetime.date(2006, 3, 1), self.browser.displayed)
+
+    def test_that_cached_months_are_reused(self):
+        api = RangeAPI("no-server", cache_ttl=60)
+        api._ct._ct._browser = self.browser
+        from_date = datetime.date(2011, 1, 1)
+        to_date = datetime.date(2011, 3, 31)
+        list(api.iter_activities(from_date, to_date))
+        requests = len(self.browser.requests)
+
+        list(api.iter_activities(from_date, to_date))
+
+        self.assertEquals(requests, len(self.browser.requests))
+
+
+class FetchPlanTestCase(unittest.TestCase):
+    def setUp(self):
+        self.june = datetime.date(2011, 6, 1)
+
+    def _dates(self, start, count):
+        return [start + datetime.timedelta(days=n) for n in range(count)]
+
+    def test_that_a_single_day_uses_the_day_view(self):
+        plan = FetchPlan([datetime.date(2011, 6, 14)], self.june)
+
+        self.assertEquals(['day'], [s.view for s in plan.steps])
+        self.assertEquals((1, 1), (plan.round_trips, plan.days))
+
+    def test_that_a_few_days_in_one_week_use_the_week_view(self):
+        plan = FetchPlan(self._dates(datetime.date(2011, 6, 14), 3), self.june)
+
+        self.assertEquals([('week', datetime.date(2011, 6, 14))],
+                          [(s.view, s.date) for s in plan.steps])
+
+    def test_that_most_of_a_month_uses_the_month_view(self):
+        plan = FetchPlan(self._dates(datetime.date(2011, 6, 3), 20), self.june)
+
+        self.assertEquals([('month', self.june)],
+                          [(s.view, s.date) for s in plan.steps])
+
+    def test_that_the_displayed_page_is_free(self):
+        displayed = (datetime.date(2011, 6, 13), datetime.date(2011, 6, 19))
+        dates = self._dates(datetime.date(2011, 6, 15), 7)
+
+        plan = FetchPlan(dates, self.june, displayed)
+
+        self.assertEquals(['displayed', 'week'], [s.view for s in plan.steps])
+        self.assertEquals(dates[:5], plan.steps[0].dates)
+        self.assertEquals(1, plan.round_trips)
+
+    def test_that_calendar_hops_are_counted_once_per_month(self):
+        dates = [datetime.date(2011, 3, 1), datetime.date(2011, 3, 2),
+                 datetime.date(2011, 4, 5)]
+
+        plan = FetchPlan(dates, self.june, day_cost=1)
+
+        self.assertEquals(['day', 'day', 'day'], [s.view for s in plan.steps])
+        self.assertEquals([4, 1, 2], [s.round_trips for s in plan.steps])
+
+    def test_that_costs_can_be_weighted(self):
+        dates = self._dates(datetime.date(2011, 6, 14), 3)
+        plan = FetchPlan(dates, self.june, round_trip_cost=1, day_cost=1)
+
+        self.assertEquals(['day'] * 3, [s.view for s in plan.steps])
+
+
+class PlannedRangeAPITestCase(unittest.TestCase):
+    def setUp(self):
+        self.browser = FakeBrowser(2011, 6)
+        self.api = RangeAPI("no-server")
+        self.api._ct._ct._browser = self.browser
+
+    def test_that_one_day_is_fetched_with_one_request(self):
+        date = datetime.date(2011, 5, 17)
+
+        activities = self.api.get_activities(date, date)
+
+        self.assertEquals([date], [a.date for a in activities])
+        self.assertEquals(['goto_prev_month', 'get'], self.browser.requests)
+        self.assertEquals(['day'], [s.view for s in self.api.last_plan.steps])
+
+    def test_that_the_displayed_month_needs_no_requests(self):
+        activities = self.api.get_activities(
+            datetime.date(2011, 6, 10), datetime.date(2011, 6, 12))
+
+        self.assertEquals(3, len(activities))
+        self.assertEquals([], self.browser.requests)
+
+    def test_that_planned_results_match_whole_months(self):
+        from_date = datetime.date(2011, 3, 29)
+        to_date = datetime.date(2011, 6, 3)
+        whole = RangeAPI("no-server")
+        whole._ct._ct._browser = FakeBrowser(2011, 6)
+        expected = [a for a in whole.iter_activities(from_date, to_date)]
+
+        activities = self.api.get_activities(from_date, to_date)
+
+        self.assertEquals(expected, activities)
+        self.assertEquals(['displayed', 'week', 'month', 'month'],
+                          [s.view for s in self.api.last_plan.steps])
+
+    def _expected(self, from_date, to_date):
+        whole = RangeAPI("no-server")
+        whole._ct._ct._browser = FakeBrowser(2011, 6)
+        return list(whole.iter_activities(from_date, to_date))
+
+    def test_that_a_missing_week_link_falls_back_to_the_month(self):
+        from_date = datetime.date(2011, 5, 17)
+        to_date = datetime.date(2011, 5, 19)
+        parser = self.api._ct._ct._parser
+        parser.get_week_command = lambda page, week: None
+
+        activities = self.api.get_activities(from_date, to_date)
+
+        self.assertEquals(['week'], [s.view for s in self.api.last_plan.steps])
+        self.assertEquals(self._expected(from_date, to_date), activities)
+        # The calendar hop already shows the month.
+        self.assertEquals(['goto_prev_month'], self.browser.requests)
+
+    def test_that_a_view_missing_dates_falls_back_to_the_month(self):
+        date = datetime.date(2011, 5, 17)
+        get = self.browser.get
+
+        def get_wrong_day(command):
+            # Shows the day before the one asked for.
+            row, column = command.split("=")[1].split(",")
+            return get("caltimesheet=%s,%d" % (row, int(column) - 1))
+        self.browser.get = get_wrong_day
+
+        activities = self.api.get_activities(date, date)
+
+        self.assertEquals(['day'], [s.view for s in self.api.last_plan.steps])
+        self.assertEquals(self._expected(date, date), activities)
+        self.assertEquals('get_current_month', self.browser.requests[-1])
+
+    def test_that_get_week_of_checks_the_displayed_week(self):
+        self.api._ct._ct._parser.get_week_command = lambda page, week: None
+
+        self.assertRaises(NavigationError, self.api._ct._ct.get_week_of,
+                          datetime.date(2011, 6, 8))
+
+    def test_that_plans_can_be_inspected_without_fetching(self):
+        plan = self.api.plan_fetch(datetime.date(2011, 5, 1), datetime.date(2011, 5, 31))
+
+        self.assertEquals(['month'], [s.view for s in plan.steps])
+        self.assertEquals([], self.browser.requests)
+
+
+class CachedRangeAPITestCase(unittest.TestCase):
+    def setUp(self):
+        self.browser = FakeBrowser(2011, 6)
+        self.api = RangeAPI("no-server", cache_ttl=60)
+        self.api._ct._ct._browser = self.browser
+
+    def test_that_cached_months_are_not_fetched_again(self):
+        from_date = datetime.date(2011, 5, 1)
+        to_date = datetime.date(2011, 6, 30)
+        first = self.api.get_activities(from_date, to_date)
+        requests = len(self.browser.requests)
+
+        second = self.api.get_activities(from_date, to_date)
+
+        self.assertEquals(requests, len(self.browser.requests))
+        self.assertEquals(first, second)
+        self.assertEquals(2, self.api.cache.hits)
+        self.assertEquals(2, self.api.cache.misses)
+
+    def test_that_months_expire(self):
+        now = [0]
+        self.api.cache._clock = lambda: now[0]
+        date = datetime.date(2011, 6, 1)
+        self.api.get_activities(date, date)
+
+        now[0] = 61
+        self.api.get_activities(date, date)
+
+        self.assertEquals(0, self.api.cache.hits)
+        self.assertEquals(2, self.api.cache.misses)
+
+    def test_that_the_cache_is_bounded(self):
+        api = RangeAPI("no-server", cache_ttl=60, cache_size=2)
+        api._ct._ct._browser = self.browser
+        api.get_activities(datetime.date(2011, 1, 1), datetime.date(2011, 3, 31))
+
+        self.assertEquals(2, len(api.cache))
+        self.assertEquals(1, api.cache.evictions)
+
+    def test_that_reported_activity_updates_the_cached_month(self):
+        date = datetime.date(2011, 6, 14)
+        activity = Activity(date, "1,2,3,4", Decimal("7.5"), "new", "1")
+        previous = Activity(date, "1,2,3,4", Decimal(0), "", "1")
+        self.api.get_activities(date, date)
+
+        self.api.report_activity(activity, previous)
+        requests = len(self.browser.requests)
+        activities = self.api.get_activities(date, date)
+
+        self.assertEquals(requests, len(self.browser.requests))
+        self.assertEquals([activity._dict], [a._dict for a in activities])
+
+
+class BulkReportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.browser = FakeBrowser(2011, 6)
+        self.api = RangeAPI("no-server")
+        self.api._ct._ct._browser = self.browser
+
+    def _activity(self, month, day, hours="7.5", comment="work"):
+        date = datetime.date(2011, month, day)
+        return Activity(date, "1,2,3,4", Decimal(hours), comment, "1")
+
+    def _empty(self, activities):
+        return [self._activity(a.date.month, a.date.day, "0", "")
+                for a in activities]
+
+    def test_that_each_month_is_saved_in_one_post(self):
+        activities = [self._activity(6, d) for d in range(6, 11)]
+        activities.append(self._activity(7, 4))
+
+        results = self.api.report_activities(
+            activities, self._empty(activities))
+
+        self.assertEquals(2, self.browser.requests.count('update_many'))
+        self.assertEquals(activities, [r.activity for r in results])
+        self.assertEquals([True] * 6, [r.saved for r in results])
+        self.assertEquals([None] * 6, [r.error for r in results])
+
+    def test_that_conflicts_are_reported_per_activity(self):
+        existing = Activity(datetime.date(2011, 6, 1), "1,2,3,4",
+                            Decimal("1"), "first", "1")
+        activities = [existing, self._activity(6, 2)]
+        previous = [None] + self._empty(activities[1:])
+
+        results = self.api.report_activities(activities, previous)
+
+        self.assertFalse(results[0].saved)
+        self.assertTrue(isinstance(results[0].error, ActivityAlreadyExists))
+        self.assertTrue(results[1].saved)
+
+    def test_that_a_failing_month_keeps_the_other_results(self):
+        activities = [self._activity(6, 6), self._activity(7, 4)]
+
+        def fail():
+            raise IOError("connection reset")
+        self.browser.goto_next_month = fail
+
+        results = self.api.report_activities(
+            activities, self._empty(activities))
+
+        self.assertEquals([True, False], [r.saved for r in results])
+        self.assertEquals(None, results[0].error)
+        self.assertTrue(isinstance(results[1].error, IOError))
+
+    def test_that_a_failing_validation_fails_only_its_activity(self):
+        activities = [self._activity(6, 6), self._activity(6, 7)]
+        get_cell = self.api._ct.get_cell
+        calls = []
+
+        def flaky(date, project_id):
+            calls.append(date)
+            if len(calls) == 1:
+                raise IOError("timed out")
+            return get_cell(date, project_id)
+        self.api._ct.get_cell = flaky
+
+        results = self.api.report_activities(
+            activities, self._empty(activities))
+
+        self.assertEquals([False, True], [r.saved for r in results])
+        self.assertTrue(isinstance(results[0].error, IOError))
+
+    def test_that_duplicate_cells_are_split_into_separate_posts(self):
+        batches = self.api._ct._ct._get_batches([
+            self._activity(6, 6, "1"),
+            self._activity(6, 7, "1"),
+            self._activity(6, 6, "2"),
+        ])
+
+        self.assertEquals([2, 1], [len(batch) for batch in batches])
+
+
+class ConcurrencyValidationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.browser = FakeBrowser(2011, 6)
+        self.api = RangeAPI("no-server")
+        self.api._ct._ct._browser = self.browser
+
+    def _activity(self, day, hours="0", comment="", month=6):
+        date = datetime.date(2011, month, day)
+        return Activity(date, "1,2,3,4", Decimal(hours), comment, "1")
+
+    def test_that_the_displayed_page_is_used(self):
+        self.api.report_activity(self._activity(9, "7.5"), self._activity(9))
+
+        self.assertEquals(['update'], self.browser.requests)
+
+    def test_that_only_the_day_is_fetched_outside_the_displayed_page(self):
+        self.api.report_activity(
+            self._activity(9, "7.5", month=8), self._activity(9, month=8))
+
+        self.assertEquals(['goto_next_month', 'goto_next_month', 'get', 'update'],
+                          self.browser.requests)
+        self.assertEquals(("7,5", ""),
+                          self.browser.cells[datetime.date(2011, 8, 9)])
+
+    def test_that_an_existing_activity_is_not_reported_again(self):
+        existing = self._activity(1, "1", "first")
+
+        self.assertRaises(ActivityAlreadyExists,
+                          self.api.report_activity, existing)
+
+    def test_that_a_stale_previous_activity_is_not_found(self):
+        activity = self._activity(1, "2", "second")
+        stale = self._activity(1, "3", "first")
+
+        self.assertRaises(PreviousActivityNotFound,
+                          self.api.report_activity, activity, stale)
+
+    def test_that_a_previous_activity_on_another_day_is_not_found(self):
+        self.assertRaises(PreviousActivityNotFound, self.api.report_activity,
+                          self._activity(9, "7.5"), self._activity(10))
+
+    def test_that_a_missing_previous_activity_is_not_found(self):
+        self.assertRaises(PreviousActivityNotFound, self.api.report_activity,
+                          self._activity(9, "7.5"))
+
+
+class CountingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.methods.append(self.command)
+        if self.server.drop:
+            # Read the request and hang up, like a server that has just
+            # closed the idle connection.
+            self.server.drop -= 1
+            self.close_connection = 1
+            return
+
+        body = testing.login_page()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class CountingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), CountingHandler)
+        self.connections = 0
+        self.methods = []
+        self.drop = 0
+        self.url = "http://127.0.0.1:%d" % self.server_address[1]
+        thread = threading.Thread(
+            target=self.serve_forever, kwargs={"poll_interval": 0.05})
+        thread.daemon = True
+        thread.start()
+
+
+class KeepAliveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = CountingServer()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_that_requests_share_one_connection(self):
+        browser = CurrentTimeBrowser(self.server.url)
+        self.addCleanup(browser.close)
+        for _ in range(3):
+            browser.goto_next_month()
+        browser.get_projects()
+
+        self.assertEquals(1, self.server.connections)
+
+    def test_that_unpickled_browser_reconnects(self):
+        browser = CurrentTimeBrowser(self.server.url, pool_size=2)
+        browser.goto_next_month()
+
+        clone = pickle.loads(pickle.dumps(browser))
+        self.addCleanup(browser.close)
+        self.addCleanup(clone.close)
+        clone.goto_next_month()
+        clone.goto_next_month()
+
+        self.assertEquals(2, clone._pool_size)
+        self.assertEquals(2, self.server.connections)
+
+    def test_that_idle_connections_expire(self):
+        browser = CurrentTimeBrowser(self.server.url, idle_timeout=-1)
+        self.addCleanup(browser.close)
+        browser.goto_next_month()
+        browser.goto_next_month()
+
+        self.assertEquals(2, self.server.connections)
+
+    def test_that_gets_are_sent_again_on_a_dropped_connection(self):
+        browser = CurrentTimeBrowser(self.server.url)
+        self.addCleanup(browser.close)
+        browser.goto_next_month()
+        self.server.drop = 1
+
+        self.assertTrue(browser.goto_next_month())
+        self.assertEquals(["GET"] * 3, self.server.methods)
+        self.assertEquals(2, self.server.connections)
+
+    def test_that_posts_are_not_sent_again_on_a_dropped_connection(self):
+        browser = CurrentTimeBrowser(self.server.url)
+        self.addCleanup(browser.close)
+        browser.goto_next_month()
+        self.server.drop = 1
+
+        self.assertRaises(urllib2.URLError, browser._open,
+                          browser._get_url("login"), "user=user")
+        self.assertEquals(["GET", "POST"], self.server.methods)
+
+
+class CompressionTestCase(unittest.TestCase):
+    def _login(self, encodings):
+        server = testing.FakeCurrentTime(rows=20, encodings=encodings).start()
+        self.addCleanup(server.stop)
+        browser = CurrentTimeBrowser(server.url)
+        self.addCleanup(browser.close)
+        self.assertTrue(browser.login("user", "secret"))
+        return server, browser
+
+    def test_that_gzip_pages_are_decoded_transparently(self):
+        plain_server, plain = self._login(())
+        server, browser = self._login(("gzip",))
+        decoded = browser.transfer.decoded
+
+        page = browser.goto_next_month()
+
+        self.assertEquals(plain.goto_next_month(), page)
+        self.assertEquals(len(page), browser.transfer.decoded - decoded)
+        self.assertTrue(browser.transfer.wire < browser.transfer.decoded / 5)
+        self.assertEquals(browser.transfer.wire, server.bytes_sent)
+
+    def test_that_deflate_pages_are_decoded(self):
+        server, browser = self._login(("deflate",))
+        parser = CurrentTimeParser()
+
+        page = browser.goto_next_month()
+
+        self.assertTrue(parser.valid_session(page))
+        self.assertTrue(browser.transfer.ratio > 5)
+
+    def test_that_compressed_connections_are_kept_alive(self):
+        server, browser = self._login(("gzip",))
+        for _ in range(3):
+            browser.goto_next_month()
+
+        self.assertEquals(1, len(browser._pool))
+
+    def test_that_streamed_pages_are_decoded_in_chunks(self):
+        server, browser = self._login(("gzip",))
+        command = browser.COMMANDS['get_current_month']
+
+        chunks = list(browser.stream(command, chunk_size=1024))
+
+        self.assertTrue(len(chunks) > 10)
+        self.assertEquals([1024] * (len(chunks) - 1), map(len, chunks[:-1]))
+        self.assertEquals(browser.get_current_month(), "".join(chunks))
+
+    def test_that_raw_deflate_is_accepted(self):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = "<html>%s</html>" % ("x" * 100000)
+        raw = compressor.compress(data) + compressor.flush()
+
+        body = DecodedResponseBody(StringIO.StringIO(raw), "deflate")
+
+        self.assertEquals(data[:10], body.read(10))
+        self.assertEquals(data[10:], body.read())
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = testing.FakeCurrentTime(
+            rows=3, today=datetime.date(2011, 6, 15)).start()
+        self.addCleanup(self.server.stop)
+        self.stats = Stats()
+
+    def _login(self, api):
+        self.addCleanup(api.close)
+        self.assertTrue(api.login("user", "secret"))
+        self.server.reset_stats()
+        return api
+
+    def test_that_requests_are_recorded_per_kind(self):
+        api = self._login(RangeAPI(self.server.url))
+        api.instrument(self.stats)
+
+        api.get_activities(datetime.date(2011, 3, 1), datetime.date(2011, 4, 30))
+
+        exported = self.stats.export()
+        counters = exported['counters']
+        self.assertEquals(self.server.requests,
+                          counters['request.status.200'])
+        self.assertEquals(self.server.bytes_sent, counters['request.bytes'])
+        self.assertEquals(3, counters['request.goto_prev_month.count'])
+        self.assertEquals(1, counters['request.goto_next_month.count'])
+        self.assertEquals(4, counters['navigation.steps'])
+        latency = exported['histograms']['request.goto_prev_month.latency']
+        self.assertEquals(3, latency['count'])
+        self.assertEquals(3, sum(count for _, count in latency['buckets']))
+
+    def test_that_parse_timings_are_recorded(self):
+        api = self._login(BaseAPI(self.server.url))
+        api.instrument(self.stats)
+
+        api.get_month(2011, 6)
+
+        histograms = self.stats.export()['histograms']
+        self.assertTrue(histograms['parse.html']['count'] >= 1)
+        self.assertEquals(1, histograms['parse.activities']['count'])
+        self.assertEquals(1, histograms['parse.range']['count'])
+
+    def test_that_clones_share_the_stats(self):
+        api = self._login(RangeAPI(self.server.url, concurrency=2))
+        api.instrument(self.stats)
+
+        api.get_activities(datetime.date(2011, 1, 1), datetime.date(2011, 4, 30))
+
+        # Each of the two workers logs in, and its redirect after the
+        # login is part of the same recorded request.
+        self.assertEquals(self.server.requests - 2,
+                          self.stats.counters['request.status.200'])
+        self.assertEquals(2, self.stats.counters['request.login.count'])
+
+    def test_that_saves_and_projects_have_their_own_kinds(self):
+        api = self._login(BaseAPI(self.server.url))
+        api.instrument(self.stats)
+        date = datetime.date(2011, 6, 11)
+
+        api.get_projects()
+        api.report_activity(Activity(date, "1,1,0,0", Decimal(2), "", "1"))
+
+        self.assertEquals(1, self.stats.counters['request.get_projects.count'])
+        self.assertEquals(1, self.stats.counters['request.save.count'])
+
+    def test_that_nothing_is_wrapped_when_disabled(self):
+        api = self._login(BaseAPI(self.server.url))
+        api.instrument(self.stats)
+        api.instrument(None)
+
+        api.get_month(2011, 6)
+
+        self.assertEquals({}, self.stats.counters)
+        self.assertEquals({}, self.stats.histograms)
+
+    def test_that_histograms_bucket_by_upper_bound(self):
+        histogram = Histogram((1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.add(value)
+
+        exported = histogram.export()
+        self.assertEquals([(1, 2), (10, 1), (None, 1)], exported['buckets'])
+        self.assertEquals((4, 0.5, 50), (exported['count'], exported['min'],
+                                          exported['max']))
+        self.assertEquals(56.5 / 4, histogram.mean)
+
+
+class SessionStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = testing.FakeCurrentTime().start()
+        self.addCleanup(self.server.stop)
+        self.directory = tempfile.mkdtemp()
+        self.now = 1000000.0
+        self.store = SessionStore(self.directory, clock=lambda: self.now)
+
+    def tearDown(self):
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+    def _resume(self, password="secret"):
+        api = RangeAPI(self.server.url)
+        self.addCleanup(api.close)
+        return api.resume("user", password, self.store), api
+
+    def test_that_a_saved_session_is_reused_without_login(self):
+        self.assertTrue(self._resume()[0])
+        self.server.reset_stats()
+
+        resumed, api = self._resume()
+
+        self.assertTrue(resumed)
+        self.assertEquals(1, len(self.server.sessions))
+        self.assertEquals(0, self.server.requests)
+        self.assertTrue(api.get_activities(self.server.today, self.server.today))
+        self.assertEquals(1, self.server.requests)
+
+    def test_that_idle_sessions_expire(self):
+        self._resume()
+        self.now += SessionStore.MAX_AGE + 1
+
+        self.assertTrue(self._resume()[0])
+        self.assertEquals(2, len(self.server.sessions))
+
+    def test_that_using_a_session_keeps_it_alive(self):
+        self._resume()
+        for i in range(3):
+            self.now += SessionStore.MAX_AGE - 1
+            self._resume()
+
+        self.assertEquals(1, len(self.server.sessions))
+
+    def _forget_last_good(self):
+        state = self.store.load(self.server.url, "user")
+        state['last_good'] = None
+        self.store.save(self.server.url, "user", state)
+
+    def test_that_rejected_sessions_log_in_again(self):
+        self._resume()
+        self.server.sessions.clear()
+        self._forget_last_good()
+
+        self.assertTrue(self._resume()[0])
+        self.assertEquals(1, len(self.server.sessions))
+
+        self.server.reset_stats()
+        self._forget_last_good()
+        self._resume()
+        self.assertEquals(1, self.server.requests)
+
+    def test_that_failed_logins_are_not_saved(self):
+        self.server.users = {"user": "secret"}
+
+        self.assertFalse(self._resume("wrong")[0])
+        self.assertEquals(None, self.store.load(self.server.url, "user"))
+
+    def test_that_cookie_expiry_is_honoured(self):
+        browser = CurrentTimeBrowser(self.server.url)
+        self.addCleanup(browser.close)
+        browser.login("user", "secret")
+        state = browser.__getstate__()
+        for paths in state['cookies'].values():
+            for cookies in paths.values():
+                for cookie in cookies.values():
+                    cookie.expires = int(self.now) + 10
+
+        self.store.save(self.server.url, "user", state)
+        self.assertTrue(self.store.load(self.server.url, "user"))
+        self.now += 10
+        self.assertEquals(None, self.store.load(self.server.url, "user"))
+
+    def test_that_sessions_are_private_to_the_owner(self):
+        self._resume()
+
+        for name in os.listdir(self.directory):
+            mode = os.stat(os.path.join(self.directory, name)).st_mode
+            self.assertEquals(0600, mode & 0777)
+
+    def test_that_corrupt_sessions_are_discarded(self):
+        path = self.store._path(self.server.url, "user")
+        for data in ["\x80\x02}q\x01.", "{\"state\": ", "[]",
+                     '{"state": {"cookies": [{}]}, "used_at": 0, "expires": null}',
+                     '{"state": {}, "used_at": "never", "expires": null}']:
+            self._resume()
+            with open(path, "wb") as f:
+                f.write(data)
+
+            self.assertEquals(None, self.store.load(self.server.url, "user"))
+            self.assertFalse(os.path.exists(path))
+
+    def test_that_resumed_cookies_are_byte_strings(self):
+        self._resume()
+
+        state = self.store.load(self.server.url, "user")
+
+        self.assertTrue(isinstance(state['server'], str))
+        for paths in state['cookies'].values():
+            for cookies in paths.values():
+                for name, cookie in cookies.items():
+                    self.assertTrue(isinstance(name, str))
+                    self.assertTrue(isinstance(cookie.value, str))
+
+
+class SessionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.users = dict(("user%d" % i, "secret%d" % i) for i in range(6))
+        self.server = testing.FakeCurrentTime(
+            today=datetime.date(2011, 6, 15), users=self.users,
+            latency=0.01).start()
+        self.addCleanup(self.server.stop)
+        set_server_limit(self.server.url, 2)
+        self.pool = SessionPool(self.server.url, self.users, workers=4)
+        self.addCleanup(self.pool.close)
+        self.tasks = [(user, 2011, month)
+                      for user in sorted(self.users) for month in (3, 4, 5)]
+
+    def test_that_every_task_gets_a_result(self):
+        results = list(self.pool.fetch(self.tasks))
+
+        self.assertEquals(sorted(self.tasks),
+                          sorted((r.user,) + r.month for r in results))
+        for result in results:
+            self.assertEquals(None, result.error)
+            self.assertEquals(set([result.month]),
+                              set((a.date.year, a.date.month)
+                                  for a in result.activities))
+        self.assertEquals(6, len(self.server.sessions))
+
+    def test_that_sessions_are_reused_across_jobs(self):
+        list(self.pool.fetch(self.tasks))
+        list(self.pool.fetch(self.tasks))
+
+        self.assertEquals(6, self.pool.logins)
+        self.assertEquals(6, len(self.server.sessions))
+
+    def test_that_the_server_limit_is_respected(self):
+        list(self.pool.fetch(self.tasks))
+
+        self.assertTrue(self.server.max_in_flight <= 2)
+
+    def test_that_failed_logins_fail_only_that_user(self):
+        users = dict(self.users, user0="wrong")
+        pool = SessionPool(self.server.url, users.get, workers=4)
+        self.addCleanup(pool.close)
+
+        results = list(pool.fetch(self.tasks))
+
+        failed = [r for r in results if r.error is not None]
+        self.assertEquals(3, len(failed))
+        self.assertEquals(set(["user0"]), set(r.user for r in failed))
+        self.assertTrue(isinstance(failed[0].error, LoginFailed))
+
+    def test_that_work_stops_with_the_consumer(self):
+        tasks = [("user0", year, month)
+                 for year in range(2000, 2011) for month in range(1, 13)]
+        results = self.pool.fetch(tasks)
+        results.next()
+        results.close()
+        time.sleep(0.1)
+        requests = self.server.requests
+
+        time.sleep(0.1)
+        self.assertEquals(requests, self.server.requests)
+
+
+class SessionValidityTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = testing.FakeCurrentTime(rows=50).start()
+        self.addCleanup(self.server.stop)
+        self.api = BaseAPI(self.server.url)
+        self.addCleanup(self.api.close)
+
+    def test_that_no_cookies_means_no_session(self):
+        self.assertFalse(self.api.valid_session())
+        self.assertEquals(0, self.server.requests)
+
+    def test_that_a_recent_answer_is_trusted(self):
+        self.api.login("user", "secret")
+        self.server.reset_stats()
+
+        self.assertTrue(self.api.valid_session())
+        self.assertEquals(0, self.server.requests)
+
+    def test_that_an_old_answer_is_probed_with_a_small_request(self):
+        self.api.login("user", "secret")
+        self.server.reset_stats()
+
+        self.assertTrue(self.api.valid_session(trust_for=0))
+
+        self.assertEquals(1, self.server.requests)
+        self.assertTrue(self.server.bytes_sent < 1024)
+
+    def test_that_a_forgotten_session_is_detected(self):
+        self.api.login("user", "secret")
+        self.server.sessions.clear()
+
+        self.assertTrue(self.api.valid_session())
+        self.assertFalse(self.api.valid_session(trust_for=0))
+        self.assertFalse(self.api.valid_session())
+
+    def test_that_expired_cookies_are_not_sent(self):
+        self.api.login("user", "secret")
+        for cookie in self.api._browser._cookie_jar:
+            cookie.expires = int(time.time()) - 1
+        self.server.reset_stats()
+
+        self.assertFalse(self.api.valid_session())
+        self.assertEquals(0, self.server.requests)
+
+    def test_that_login_pages_in_the_first_bytes_are_detected(self):
+        browser = self.api._browser
+        self.api.login("user", "secret")
+        browser._check_session(self.server.url, testing.login_page())
+        self.assertEquals(None, browser.last_good)
+
+        browser._check_session(self.server.url, browser.get_current_month())
+        self.assertNotEquals(None, browser.last_good)
+
+
+class ReplicaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.today = datetime.date(2011, 6, 15)
+        self.server = testing.FakeCurrentTime(
+            rows=2, today=self.today,
+            approved_before=datetime.date(2011, 3, 1)).start()
+        self.addCleanup(self.server.stop)
+        self.api = RangeAPI(self.server.url)
+        self.addCleanup(self.api.close)
+        self.api.login("user", "secret")
+        self.replica = Replica()
+        self.addCleanup(self.replica.close)
+        self.now = 1000000.0
+        self.sync = ReplicaSync(self.api, self.replica, "user",
+                                clock=lambda: self.now, today=self.today)
+        self.from_date = datetime.date(2011, 1, 1)
+        self.to_date = datetime.date(2011, 6, 30)
+
+    def test_that_the_first_sync_mirrors_every_month(self):
+        months = self.sync.sync(self.from_date, self.to_date)
+
+        self.assertEquals([(2011, m) for m in range(1, 7)], months)
+        self.assertEquals(
+            self.api.get_activities(self.from_date, self.to_date),
+            self.replica.get_activities("user", self.from_date, self.to_date))
+
+    def test_that_only_recent_months_are_fetched_again(self):
+        self.sync.sync(self.from_date, self.to_date)
+        self.server.reset_stats()
+
+        months = self.sync.sync(self.from_date, self.to_date)
+
+        self.assertEquals([(2011, 5), (2011, 6)], months)
+        self.assertTrue(self.server.requests <= 4)
+
+    def test_that_approved_months_are_never_fetched_again(self):
+        self.sync.sync(self.from_date, self.to_date)
+        self.now += 2 * self.sync.max_age
+
+        months = self.sync.sync(self.from_date, self.to_date)
+
+        self.assertEquals([(2011, m) for m in range(3, 7)], months)
+        self.assertEquals((self.now - 2 * self.sync.max_age, True),
+                          self.replica.get_month_state("user", 2011, 1))
+
+    def test_that_local_reads_need_no_requests(self):
+        self.sync.recent_months = 0
+        self.sync.get_activities(self.from_date, self.to_date)
+        self.server.reset_stats()
+
+        activities = self.sync.get_activities(
+            datetime.date(2011, 2, 1), datetime.date(2011, 2, 28))
+
+        self.assertEquals(0, self.server.requests)
+        self.assertEquals(28, len(activities) / 2)
+
+    def test_that_reports_are_written_through(self):
+        self.sync.sync(self.from_date, self.to_date)
+        date = datetime.date(2011, 4, 9)
+        previous, = [a for a in self.replica.get_activities("user", date, date)
+                     if a.project_id == "1,1,0,0"]
+        activity = Activity(date, "1,1,0,0", Decimal("2.5"), u"saturday", "1")
+
+        self.sync.report_activity(activity, previous)
+
+        saved = self.replica.get_activities("user", date, date)
+        self.assertTrue(activity in saved)
+        self.assertEquals(("2,5", u"saturday"), self.server.get_cell("1,1,0,0", date))
+
+    def test_that_reports_without_a_salary_id_replace_the_stored_row(self):
+        self.sync.sync(self.from_date, self.to_date)
+        date = datetime.date(2011, 4, 11)
+        before = self.replica.get_totals(date, date)
+
+        self.replica.store_activity(
+            "user", Activity(date, "1,1,0,0", Decimal("2.5"), u"monday"))
+
+        totals = self.replica.get_totals(date, date)
+        self.assertEquals(Decimal("2.5"), totals["1,1,0,0"])
+        self.assertEquals(before["2,1,0,0"], totals["2,1,0,0"])
+        self.assertEquals(None, self.replica.get_month_state("user", 2011, 4))
+        self.assertEquals([(2011, 4)], self.sync.sync(
+            datetime.date(2011, 4, 1), datetime.date(2011, 4, 30)))
+
+    def test_that_totals_are_aggregated_locally(self):
+        self.sync.sync(self.from_date, self.to_date)
+        self.replica.store_month("other", 2011, 2, [
+            Activity(datetime.date(2011, 2, 1), "9,1,0,0", Decimal("1.25"), u"")])
+
+        by_month = self.replica.get_totals(self.from_date, self.to_date, 'month',
+                                           users=["user"])
+        by_user = self.replica.get_totals(self.from_date, self.to_date, 'user')
+
+        weekdays = sum(1 for n in range(28)
+                       if datetime.date(2011, 2, n + 1).weekday() < 5)
+        self.assertEquals(Decimal("7.5") * weekdays, by_month["2011-02"])
+        self.assertEquals(6, len(by_month))
+        self.assertEquals(Decimal("1.25"), by_user["other"])
+        self.assertEquals(sum(by_month.values()), by_user["user"])
+
+    def test_that_projects_and_months_survive_reopening(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "replica.db")
+        self.addCleanup(os.rmdir, directory)
+        self.addCleanup(os.remove, path)
+        replica = Replica(path)
+        sync = ReplicaSync(self.api, replica, "user", today=self.today)
+        sync.sync_projects()
+        sync.sync(self.from_date, self.from_date)
+        replica.close()
+
+        replica = Replica(path)
+        self.addCleanup(replica.close)
+        self.assertEquals(["1,1,0,0", "2,1,0,0"],
+                          [p.id for p in replica.get_projects("user")])
+        self.assertEquals(62, len(replica.get_activities(
+            "user", self.from_date, datetime.date(2011, 1, 31))))
+
+
+class AsyncRangeAPITestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = testing.FakeCurrentTime(today=datetime.date(2011, 6, 15))
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.loop = aio.EventLoop()
+
+    def _login(self, count):
+        apis = [aio.AsyncRangeAPI(self.server.url, self.loop) for _ in range(count)]
+        logins = [api.login("user", "secret") for api in apis]
+        self.assertEquals([True] * count,
+                          self.loop.run_until_complete(aio.gather(*logins)))
+        return apis
+
+    def test_that_the_shared_limiter_is_respected(self):
+        limiter = AdaptiveLimiter(rate=None, limit=1, maximum=1)
+        set_limiter(self.server.url, limiter)
+
+        self._login(4)
+
+        self.assertEquals(1, self.server.max_in_flight)
+        self.assertEquals(0, limiter.in_flight)
+        self.assertTrue(limiter.increases >= 4)
+
+    def test_that_many_sessions_are_driven_by_one_loop(self):
+        apis = self._login(5)
+        from_date = datetime.date(2010, 11, 1)
+        to_date = datetime.date(2011, 2, 28)
+
+        results = self.loop.run_until_complete(aio.gather(
+            *[api.get_activities(from_date, to_date) for api in apis]))
+
+        self.assertEquals(5, len(self.server.sessions))
+        for activities in results:
+            self.assertEquals(120, len(activities))
+            self.assertEquals(
+                [a.date for a in activities if a.date.weekday() < 5],
+                [a.date for a in activities if a.duration])
+
+    def test_that_projects_are_parsed(self):
+        api, = self._login(1)
+
+        projects = self.loop.run_until_complete(api.get_projects())
+
+        self.assertEquals(["1,1,0,0"], [p.id for p in projects])
+
+    def test_that_activities_are_reported(self):
+        api, = self._login(1)
+        date = datetime.date(2011, 8, 13)
+        activity = Activity(date, "1,1,0,0", Decimal("7.5"), "work", "1")
+        previous = Activity(date, "1,1,0,0", Decimal(0), "", "1")
+
+        self.loop.run_until_complete(api.report_activity(activity, previous))
+
+        self.assertEquals(("7,5", "work"),
+                          self.server.get_cell("1,1,0,0", date))
+        self.assertRaises(
+            ActivityAlreadyExists, self.loop.run_until_complete,
+            api.report_activity(activity))
+
+    def test_that_a_fresh_session_is_not_valid(self):
+        api = aio.AsyncRangeAPI(self.server.url, self.loop)
+        self.assertFalse(self.loop.run_until_complete(api.valid_session()))
+
+    def test_that_connection_errors_fail_the_future(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        url = "http://127.0.0.1:%d" % sock.getsockname()[1]
+        sock.close()
+        api = aio.AsyncRangeAPI(url, self.loop)
+
+        self.assertRaises(IOError, self.loop.run_until_complete,
+                          api.login("user", "secret"))
+
+
+class LimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.slept = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def _limiter(self, **kwargs):
+        return AdaptiveLimiter(clock=self.clock, sleep=self.sleep, **kwargs)
+
+    def test_that_the_bucket_allows_a_burst(self):
+        bucket = TokenBucket(10, 3, clock=self.clock)
+
+        self.assertEquals([0, 0, 0], [bucket.take() for _ in range(3)])
+
+    def test_that_waits_grow_once_the_bucket_is_empty(self):
+        bucket = TokenBucket(10, 1, clock=self.clock)
+        bucket.take()
+
+        waits = [bucket.take(), bucket.take()]
+
+        self.assertAlmostEquals(0.1, waits[0])
+        self.assertAlmostEquals(0.2, waits[1])
+
+    def test_that_the_bucket_refills_over_time(self):
+        bucket = TokenBucket(4, 1, clock=self.clock)
+        bucket.take()
+        self.now += 0.25
+
+        self.assertEquals(0, bucket.take())
+
+    def test_that_acquire_sleeps_for_tokens(self):
+        limiter = self._limiter(rate=10, burst=1, limit=4)
+        limiter.acquire()
+
+        started = limiter.acquire()
+
+        self.assertEquals(1, len(self.slept))
+        self.assertAlmostEquals(100.1, started)
+        self.assertEquals(2, limiter.in_flight)
+
+    def test_that_fast_responses_raise_the_limit(self):
+        limiter = self._limiter(rate=None, limit=1)
+
+        limiter.release(limiter.acquire())
+
+        self.assertEquals(2, limiter.limit)
+        self.assertEquals(1, limiter.increases)
+
+    def test_that_the_limit_stops_at_the_maximum(self):
+        limiter = self._limiter(rate=None, limit=2, maximum=3)
+
+        for _ in range(20):
+            limiter.release(limiter.acquire())
+
+        self.assertEquals(3, limiter.limit)
+
+    def test_that_slow_responses_halve_the_limit(self):
+        limiter = self._limiter(rate=None, limit=8, target_latency=1.0)
+        started = limiter.acquire()
+        self.now += 2
+
+        limiter.release(started)
+
+        self.assertEquals(4, limiter.limit)
+
+    def test_that_failures_halve_the_limit(self):
+        limiter = self._limiter(rate=None, limit=8)
+
+        limiter.release(limiter.acquire(), ok=False)
+
+        self.assertEquals(4, limiter.limit)
+
+    def test_that_a_burst_of_failures_backs_off_once(self):
+        limiter = self._limiter(rate=None, limit=8)
+        started = [limiter.acquire() for _ in range(4)]
+        self.now += 1
+
+        for value in started:
+            limiter.release(value, ok=False)
+
+        self.assertEquals(4, limiter.limit)
+        self.assertEquals(1, limiter.decreases)
+
+    def test_that_the_limit_stays_above_the_minimum(self):
+        limiter = self._limiter(rate=None, limit=2, minimum=1)
+
+        for _ in range(5):
+            started = limiter.acquire()
+            self.now += 1
+            limiter.release(started, ok=False)
+
+        self.assertEquals(1, limiter.limit)
+
+    def test_that_acquire_blocks_at_the_limit(self):
+        limiter = AdaptiveLimiter(rate=None, limit=1)
+        started = limiter.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.release(limiter.acquire())
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+
+        limiter.release(started)
+        thread.join(1)
+        self.assertTrue(acquired.is_set())
+
+    def test_that_acquire_gives_up_after_the_timeout(self):
+        limiter = AdaptiveLimiter(rate=None, limit=1, timeout=0.05)
+        limiter.acquire()
+
+        self.assertRaises(LimiterTimeout, limiter.acquire)
+        self.assertEquals(1, limiter.in_flight)
+
+    def test_that_try_acquire_never_blocks(self):
+        limiter = self._limiter(rate=10, burst=1, limit=1)
+
+        self.assertEquals((0, 100.0), limiter.try_acquire())
+        self.assertEquals(None, limiter.try_acquire())
+
+        limiter.release(100.0)
+        delay, started = limiter.try_acquire()
+        self.assertAlmostEquals(0.1, delay)
+        self.assertAlmostEquals(100.1, started)
+        self.assertEquals([], self.slept)
+
+    def test_that_set_maximum_lowers_the_limit(self):
+        limiter = self._limiter(rate=None, limit=8)
+
+        limiter.set_maximum(2)
+
+        self.assertEquals(2, limiter.limit)
+
+    def test_that_metrics_are_reported(self):
+        limiter = self._limiter(rate=10, burst=5, limit=2)
+        limiter.release(limiter.acquire())
+
+        metrics = limiter.metrics()
+
+        self.assertEquals(2, metrics['limit'])
+        self.assertEquals(0, metrics['in_flight'])
+        self.assertEquals(10, metrics['rate'])
+        self.assertEquals(4, metrics['tokens'])
+        self.assertEquals(1, metrics['increases'])
+        self.assertEquals(0, metrics['decreases'])
+
+    def test_that_limiters_are_shared_per_server(self):
+        server = "http://limiter.example.com"
+        self.assertTrue(get_limiter(server) is get_limiter(server))
+        self.assertFalse(get_limiter(server) is get_limiter(server + "/"))
+
+        limiter = AdaptiveLimiter()
+        set_limiter(server, limiter)
+        self.assertTrue(get_limiter(server) is limiter)
+
+    def test_that_failed_logins_give_their_slots_back(self):
+        server = testing.FakeCurrentTime(users={"user": "secret"}).start()
+        self.addCleanup(server.stop)
+        limiter = AdaptiveLimiter(rate=None, limit=2, maximum=2)
+        set_limiter(server.url, limiter)
+        browser = CurrentTimeBrowser(server.url)
+        self.addCleanup(browser.close)
+
+        for _ in range(2):
+            self.assertFalse(browser.login("user", "wrong"))
+        self.assertEquals(0, limiter.in_flight)
+
+        self.assertTrue(browser.login("user", "secret"))
+        self.assertTrue(browser.get_current_month())
+
+    def test_that_browsers_send_through_the_limiter(self):
+        server = testing.FakeCurrentTime().start()
+        self.addCleanup(server.stop)
+        limiter = AdaptiveLimiter(rate=None)
+        set_limiter(server.url, limiter)
+        browser = CurrentTimeBrowser(server.url)
+        self.addCleanup(browser.close)
+
+        browser.login("user", "secret")
+
+        self.assertTrue(limiter.increases > 0)
+        self.assertEquals(0, limiter.in_flight)
+
+
+class RetryPolicyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.slept = []
+        self.policy = RetryPolicy(attempts=3, backoff=0.1, jitter=0.5,
+                                  sleep=self.slept.append,
+                                  random=lambda: 1.0)
+
+    def _failing(self, *errors):
+        errors = list(errors)
+        calls = []
+
+        def fetch(timeout):
+            calls.append(timeout)
+            if errors:
+                raise errors.pop(0)
+            return "page"
+        return fetch, calls
+
+    def test_that_failures_are_retried_with_backoff(self):
+        fetch, calls = self._failing(socket.timeout(), urllib2.URLError("x"))
+
+        self.assertEquals("page", self.policy.call(fetch))
+        self.assertEquals(3, len(calls))
+        self.assertEquals([0.15, 0.3], [round(d, 6) for d in self.slept])
+
+    def test_that_the_last_error_is_raised(self):
+        errors = [socket.timeout() for _ in range(3)]
+        fetch, calls = self._failing(*errors)
+
+        self.assertRaises(socket.timeout, self.policy.call, fetch)
+        self.assertEquals(3, len(calls))
+
+    def test_that_client_errors_are_not_retried(self):
+        error = urllib2.HTTPError("http://x/", 404, "Not Found", {}, None)
+        fetch, calls = self._failing(error)
+
+        self.assertRaises(urllib2.HTTPError, self.policy.call, fetch)
+        self.assertEquals(1, len(calls))
+
+    def test_that_server_errors_are_retried(self):
+        error = urllib2.HTTPError("http://x/", 503, "Busy", {}, None)
+        fetch, calls = self._failing(error)
+
+        self.assertEquals("page", self.policy.call(fetch))
+
+    def test_that_programming_errors_are_not_retried(self):
+        fetch, calls = self._failing(ValueError())
+
+        self.assertRaises(ValueError, self.policy.call, fetch)
+        self.assertEquals(1, len(calls))
+
+    def test_that_the_timeout_is_passed_on(self):
+        policy = RetryPolicy(timeout=2.5)
+        fetch, calls = self._failing()
+
+        policy.call(fetch)
+
+        self.assertEquals([2.5], calls)
+
+    def test_that_hedging_waits_for_enough_samples(self):
+        policy = RetryPolicy(hedge=True, min_samples=3)
+        fetch, calls = self._failing()
+
+        policy.call(fetch, hedge=True)
+        policy.call(fetch, hedge=True)
+        self.assertEquals(None, policy.hedge_after)
+        policy.call(fetch, hedge=True)
+        self.assertNotEqual(None, policy.hedge_after)
+
+    def test_that_a_slow_request_is_hedged(self):
+        policy = RetryPolicy(hedge=True, min_samples=1)
+        policy.call(lambda timeout: "warm up")
+        stats = Stats()
+        calls = []
+
+        def fetch(timeout):
+            calls.append(timeout)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return "slow"
+            return "fast"
+
+        self.assertEquals("fast", policy.call(fetch, hedge=True, stats=stats))
+        self.assertEquals(1, stats.counters['retry.hedged'])
+        self.assertEquals(1, stats.counters['retry.hedge_wins'])
+
+    def test_that_requests_are_not_hedged_unless_asked(self):
+        policy = RetryPolicy(hedge=True, min_samples=1)
+        policy.call(lambda timeout: "warm up")
+        calls = []
+
+        def fetch(timeout):
+            calls.append(timeout)
+            time.sleep(0.05)
+            return "page"
+
+        policy.call(fetch)
+        self.assertEquals(1, len(calls))
+
+
+class RetryingBrowserTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = testing.FakeCurrentTime(
+            today=datetime.date(2011, 6, 15)).start()
+        self.addCleanup(self.server.stop)
+        self.api = BaseAPI(self.server.url)
+        self.addCleanup(self.api.close)
+        self.api.login("user", "secret")
+        self.api.set_retry_policy(RetryPolicy(sleep=lambda seconds: None))
+        self.stats = Stats()
+        self.api.instrument(self.stats)
+
+    def test_that_server_errors_are_retried(self):
+        self.server.add_fault(status=503)
+        self.server.add_fault(status=502)
+
+        activities = self.api.get_month(2011, 4)
+
+        self.assertEquals(set([(2011, 4)]),
+                          set((a.date.year, a.date.month) for a in activities))
+        self.assertEquals(2, self.stats.counters['retry.attempts'])
+
+    def test_that_timeouts_are_retried(self):
+        self.api.set_retry_policy(
+            RetryPolicy(timeout=0.2, sleep=lambda seconds: None))
+        self.server.add_fault(delay=0.5)
+
+        activities = self.api.get_week_of(datetime.date(2011, 6, 8))
+
+        self.assertEquals(set(datetime.date(2011, 6, d) for d in range(6, 13)),
+                          set(a.date for a in activities))
+        self.assertEquals(1, self.stats.counters['retry.attempts'])
+
+    def test_that_a_stalled_body_gives_its_slot_back(self):
+        limiter = self.api._browser.limiter
+        self.api.set_retry_policy(
+            RetryPolicy(attempts=3, timeout=0.2, sleep=lambda seconds: None))
+        for _ in range(3):
+            self.server.add_fault(body_delay=0.5)
+
+        self.assertRaises(socket.timeout, self.api._browser.get_current_month)
+        self.assertEquals(0, limiter.in_flight)
+        self.assertEquals(3, self.stats.counters['request.status.200'])
+
+        self.server.add_fault(body_delay=0.5)
+        self.assertTrue(self.api._browser.get_current_month())
+        self.assertEquals(0, limiter.in_flight)
+
+    def test_that_streams_give_their_slot_back_before_yielding(self):
+        limiter = self.api._browser.limiter
+        limiter.timeout = 1.0
+        set_server_limit(self.server.url, 1)
+        # Small reads keep most of the page on the wire at the first chunk.
+        self.addCleanup(setattr, transport, 'CHUNK_SIZE', transport.CHUNK_SIZE)
+        transport.CHUNK_SIZE = 64
+
+        browser = self.api._browser
+        command = browser.COMMANDS['get_current_month']
+
+        chunks = []
+        for chunk in browser.stream(command, chunk_size=256):
+            self.assertEquals(0, limiter.in_flight)
+            self.assertTrue(browser.get_current_month())
+            chunks.append(chunk)
+
+        self.assertTrue(len(chunks) > 1)
+        self.assertEquals(0, limiter.decreases)
+
+    def test_that_stop_waits_for_stalled_requests(self):
+        self.api.set_retry_policy(
+            RetryPolicy(attempts=1, timeout=0.1, sleep=lambda seconds: None))
+        self.server.add_fault(body_delay=0.3)
+        self.assertRaises(socket.timeout, self.api._browser.get_current_month)
+
+        self.server.stop()
+
+        self.assertEquals(set(), self.server._threads)
+
+    def test_that_a_late_relative_hop_still_lands_on_the_month(self):
+        self.api.set_retry_policy(
+            RetryPolicy(timeout=0.2, sleep=lambda seconds: None))
+        self.server.add_fault(delay=0.5)
+
+        activities = self.api.get_month(2011, 5)
+
+        self.assertEquals(set([(2011, 5)]),
+                          set((a.date.year, a.date.month) for a in activities))
+        self.assertEquals(1, self.stats.counters['retry.attempts'])
+
+    def test_that_saves_are_not_retried(self):
+        self.server.add_fault(status=503)
+        session_id = self.api._parser.parse_session_id(self.api._page)
+        activity = Activity(datetime.date(2011, 6, 1), "1,1,0,0",
+                            Decimal("7.5"), "", "1")
+        self.server.reset_stats()
+
+        self.assertRaises(urllib2.HTTPError,
+                          self.api._browser.update, session_id, activity)
+        self.assertEquals(1, self.server.requests)
+
+
+class XPathsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.parser = CurrentTimeParser()
+        self.page = self.parser.page(testing.timesheet_page(
+            datetime.date(2011, 6, 1), datetime.date(2011, 6, 30),
+            month=(2011, 6)))
+
+    def test_that_every_expression_compiles(self):
+        for name in xpaths.XPATHS:
+            xpaths.get(name)
+
+    def test_that_expressions_are_compiled_once(self):
+        self.assertTrue(xpaths.get('range') is xpaths.get('range'))
+
+    def test_that_variables_select_one_cell(self):
+        cells = xpaths.select('day_cell', self.page.root, day=15)
+
+        self.assertEquals(["15"], [el.text_content().strip() for el in cells])
+
+    def test_that_day_and_week_commands_are_found(self):
+        self.assertTrue(self.parser.get_day_command(self.page, 15))
+        self.assertEquals(None, self.parser.get_day_command(self.page, 31))
+        self.assertTrue(self.parser.get_week_command(self.page, 24))
+
+    def test_that_importing_the_api_leaves_out_heavy_modules(self):
+        code = ("import sys, ct.core.apis; "
+                "print sorted(m for m in ('lxml', 'unittest', "
+                "'multiprocessing') if m in sys.modules)")
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.check_output([sys.executable, "-c", code], env=env)
+
+        self.assertEquals("[]", output.strip())
+
+
 if __name__ == '__main__':
     unittest.main()